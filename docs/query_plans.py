@@ -0,0 +1,102 @@
+"""Print query plans and timings of the expiry, audit and lookup queries.
+
+Run with DJANGO_SETTINGS_MODULE pointing at a project using a scratch
+SQLite database, with South migrated to the schema to measure, e.g.:
+
+    ./manage.py migrate subscription 0005 && python docs/query_plans.py
+    ./manage.py migrate subscription 0006 && python docs/query_plans.py
+
+If subscription tables are empty, they are filled with USERS
+UserSubscriptions and TRANSACTIONS Transactions first.  Never run it
+against a production database.  Results are in docs/query-plans.txt.
+"""
+import datetime
+import random
+import time
+
+from django.db.models.loading import get_apps
+get_apps()
+
+from django.db import connection, transaction
+
+from subscription.models import UserSubscription, Transaction, \
+    _lapsed_usersubscriptions
+
+USERS = 200000
+TRANSACTIONS = 1000000
+EVENTS = ('subscription payment', 'subscription expired', 'new usersubscription',
+          'remove subscription (expired)', 'one-time payment', 'subscription cancelled')
+
+
+def populate(cursor):
+    rnd = random.Random(1)
+    today = datetime.date.today()
+    cursor.execute("INSERT INTO auth_group (name) VALUES ('query plans')")
+    group_id = cursor.lastrowid
+    for i in range(20):
+        cursor.execute("INSERT INTO subscription_subscription (name, description, price, group_id) "
+                       "VALUES (%s, '', 1, %s)", ['plan %d' % i, group_id])
+    cursor.executemany("INSERT INTO auth_user (username, first_name, last_name, email, password, "
+                       "is_staff, is_active, is_superuser, last_login, date_joined) "
+                       "VALUES (%s, '', '', '', '', 0, 1, 0, '2013-01-01', '2013-01-01')",
+                       [('user%d' % i,) for i in xrange(USERS)])
+    # most subscriptions are current, as they are after daily expiry runs
+    cursor.executemany("INSERT INTO subscription_usersubscription "
+                       "(user_id, subscription_id, expires, active, cancelled) "
+                       "VALUES (%s, %s, %s, %s, %s)",
+                       [(i + 1, rnd.randrange(1, 21), today + datetime.timedelta(rnd.randrange(-20, 780)),
+                         rnd.random() < 0.95, rnd.random() < 0.5) for i in xrange(USERS)])
+    start = datetime.datetime(2012, 1, 1)
+    cursor.executemany("INSERT INTO subscription_transaction "
+                       "(timestamp, subscription_id, user_id, event, comment) "
+                       "VALUES (%s, %s, %s, %s, '')",
+                       [(start + datetime.timedelta(seconds=rnd.randrange(10 ** 8)), rnd.randrange(1, 21),
+                         rnd.randrange(1, USERS + 1), rnd.choice(EVENTS)) for i in xrange(TRANSACTIONS)])
+    transaction.commit_unless_managed()
+
+
+def queries():
+    today = datetime.date.today()
+    return [
+        ('unsubscribe_expired() chunk',
+         _lapsed_usersubscriptions().order_by('pk').values_list('pk', 'user_id')[:1000]),
+        ('active subscriptions expiring this week',
+         UserSubscription.active_objects.filter(expires__gte=today,
+                                                expires__lt=today + datetime.timedelta(7))),
+        ('admin UserSubscription date_hierarchy (day)',
+         UserSubscription.objects.filter(expires=today)),
+        ("user's active subscriptions",
+         UserSubscription.objects.filter(user=1, active=True)),
+        ('admin Transaction list',
+         Transaction.objects.order_by('-timestamp')[:100]),
+        ("subscription's audit trail",
+         Transaction.objects.filter(subscription=1).order_by('-timestamp')[:100]),
+        ('admin Transaction event search',
+         Transaction.objects.filter(event='subscription expired').order_by('-timestamp')[:100]),
+        ]
+
+
+def main(repeat=5):
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM subscription_usersubscription')
+    if not cursor.fetchone()[0]:
+        populate(cursor)
+    cursor.execute('ANALYZE')
+    for name, queryset in queries():
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '%s: %.2f ms' % (name, best * 1000)
+        for line in plan:
+            print '    ' + line
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 from django import forms
 from django.contrib import admin
+from django.db import transaction
 from django.utils.html import conditional_escape as esc
 
-from models import Subscription, UserSubscription, Transaction
+import signals
+from models import Subscription, UserSubscription, Transaction, IPNJob
+from models import extend_usersubscriptions, fix_usersubscriptions, with_group_membership
 
 
 def _pricing(sub):
@@ -13,29 +16,50 @@ def _trial(sub):
     return sub.get_trial_display()
 
 
-class SubscriptionAdmin(admin.ModelAdmin):
+class DeferringAdmin(admin.ModelAdmin):
+    """ModelAdmin calling views inside `signals.deferring', so that
+    caches are invalidated again after their transactions end."""
+
+    @signals.deferring
+    def add_view(self, *args, **kwargs):
+        return super(DeferringAdmin, self).add_view(*args, **kwargs)
+
+    @signals.deferring
+    def change_view(self, *args, **kwargs):
+        return super(DeferringAdmin, self).change_view(*args, **kwargs)
+
+    @signals.deferring
+    def delete_view(self, *args, **kwargs):
+        return super(DeferringAdmin, self).delete_view(*args, **kwargs)
+
+    @signals.deferring
+    def changelist_view(self, *args, **kwargs):
+        return super(DeferringAdmin, self).changelist_view(*args, **kwargs)
+
+
+class SubscriptionAdmin(DeferringAdmin):
     list_display = ('name', _pricing, _trial)
 admin.site.register(Subscription, SubscriptionAdmin)
 
 
 def _subscription(trans):
-    if trans.subscription != None:
+    if trans.subscription_id is not None:
         return u'<a href="/admin/subscription/subscription/%d/">%s</a>' % (
-            trans.subscription.pk, esc(trans.subscription))
+            trans.subscription_id, esc(trans.subscription))
 _subscription.allow_tags = True
 
 
 def _user(trans):
-    if trans.user != None:
+    if trans.user_id is not None:
         return u'<a href="/admin/auth/user/%d/">%s</a>' % (
-            trans.user.pk, esc(trans.user))
+            trans.user_id, esc(trans.user))
 _user.allow_tags = True
 
 
 def _ipn(trans):
-    if trans.ipn != None:
+    if trans.ipn_id is not None:
         return u'<a href="/admin/ipn/paypalipn/%d/">#%s</a>' % (
-            trans.ipn.pk, trans.ipn.pk)
+            trans.ipn_id, trans.ipn_id)
 _ipn.allow_tags = True
 
 
@@ -46,7 +70,7 @@ class UserSubscriptionAdminForm(forms.ModelForm):
     extend_subscription = forms.fields.BooleanField(required=False)
 
 
-class UserSubscriptionAdmin(admin.ModelAdmin):
+class UserSubscriptionAdmin(DeferringAdmin):
     list_display = ('__unicode__', _user, _subscription, 'active', 'expires', 'valid')
     list_display_links = ('__unicode__',)
     list_filter = ('active', 'subscription', )
@@ -58,6 +82,10 @@ class UserSubscriptionAdmin(admin.ModelAdmin):
                      'classes': ('collapse',)}),
         )
 
+    def queryset(self, request):
+        return with_group_membership(super(UserSubscriptionAdmin, self).queryset(
+            request).select_related('user', 'subscription'))
+
     def save_model(self, request, obj, form, change):
         if form.cleaned_data['extend_subscription']:
             obj.extend()
@@ -69,13 +97,17 @@ class UserSubscriptionAdmin(admin.ModelAdmin):
     actions = ('fix', 'extend',)
 
     def fix(self, request, queryset):
-        for us in queryset.all():
-            us.fix()
+        with transaction.commit_on_success():
+            counts = fix_usersubscriptions(queryset)
+        self.message_user(request, '%(subscribed)d group memberships added, '
+                          '%(unsubscribed)d removed, %(deleted)d subscriptions '
+                          'deleted.' % counts)
     fix.short_description = 'Fix group membership'
 
     def extend(self, request, queryset):
-        for us in queryset.all():
-            us.extend()
+        with transaction.commit_on_success():
+            updated = extend_usersubscriptions(queryset)
+        self.message_user(request, '%d subscriptions extended.' % updated)
     extend.short_description = 'Extend subscription'
 
 admin.site.register(UserSubscription, UserSubscriptionAdmin)
@@ -86,4 +118,14 @@ class TransactionAdmin(admin.ModelAdmin):
     list_display = ('timestamp', 'id', 'event', _subscription, _user, _ipn, 'amount', 'comment')
     list_display_links = ('timestamp', 'id')
     list_filter = ('subscription', 'user')
+
+    def queryset(self, request):
+        return super(TransactionAdmin, self).queryset(request).select_related(
+            'user', 'subscription')
 admin.site.register(Transaction, TransactionAdmin)
+
+
+class IPNJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'signal', 'user_key', 'created', 'run_after', 'attempts', 'failed')
+    list_filter = ('failed', 'signal')
+admin.site.register(IPNJob, IPNJobAdmin)
@@ -0,0 +1,279 @@
+"""Revenue, MRR, churn and cohort reports over the Transaction ledger.
+
+Transactions are aggregated in SQL (GROUP BY day, subscription and
+event) into RevenueSummary rows by `refresh()', which recomputes only
+days since the last summarized day, so it can be run often (e.g. from
+cron).  Revenue and churn reports read RevenueSummary only, so they
+take time proportional to number of reported days, not to number of
+Transactions; days are folded into weeks and months in Python.
+Payments are also added to RevenueSummary as they are written (see
+`subscription.rollup'); both lock Subscription rows (`refresh()' all
+of them), so that a refresh and added payments do not interleave.
+
+Days are UTC days if USE_TZ is set.
+"""
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from models import PlanStats, RevenueSummary, Subscription, Transaction, \
+    plan_registry, _recurrence_unit_days
+from rollup import REVENUE_EVENTS
+
+START_EVENTS = ('activated', )
+# cancelled subscriptions ended at PayPal or after they expired
+CHURN_EVENTS = ('remove subscription (cancelled)', 'remove subscription (expired)')
+# subscriptions ended by a change to another subscription
+SWITCH_EVENTS = ('deactivated', 'remove subscription (deactivated)')
+PAYMENT_EVENTS = ('subscription payment', )
+
+PERIODS = ('day', 'week', 'month')
+
+
+def _to_date(value):
+    # date truncation returns text on SQLite and datetimes elsewhere
+    if isinstance(value, basestring):
+        value = parse_datetime(value) or parse_date(value)
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value
+
+
+def _midnight(day):
+    start = datetime.datetime.combine(day, datetime.time())
+    if settings.USE_TZ:
+        start = timezone.make_aware(start, timezone.utc)
+    return start
+
+
+def _period_start(day, period):
+    if period == 'week':
+        return day - datetime.timedelta(day.weekday())
+    if period == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _trunc_sql(connection, lookup, column):
+    """Return SQL truncating datetime `column' to start of its day or
+    month (`lookup')."""
+    if connection.vendor == 'sqlite':
+        # built-in functions; Django's date truncation is a Python
+        # function called for each row
+        if lookup == 'day':
+            return 'date(%s)' % column
+        return "strftime('%%%%Y-%%%%m-01', %s)" % column
+    return connection.ops.date_trunc_sql(lookup, column)
+
+
+def _overlap():
+    return getattr(settings, 'SUBSCRIPTION_ANALYTICS_OVERLAP', 2)
+
+
+def ledger_summary(since=None, events=None, using=None):
+    """Return values() queryset of Transactions from date `since' on
+    (optionally only with `events'), grouped by `day', `subscription'
+    and `event', with their `number' and `total' amount."""
+    using = using or router.db_for_read(Transaction)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    transactions = Transaction.objects.using(using).order_by()
+    if since is not None:
+        transactions = transactions.filter(timestamp__gte=_midnight(since))
+    if events is not None:
+        transactions = transactions.filter(event__in=events)
+    day_sql = _trunc_sql(connection, 'day', '%s.%s' % (
+        qn(Transaction._meta.db_table), qn('timestamp')))
+    # separate annotate() calls keep order of selected columns
+    return transactions.extra(select={'day': day_sql}).values(
+        'day', 'subscription', 'event').annotate(number=Count('id')).annotate(
+        total=Sum('amount'))
+
+
+def refresh(since=None):
+    """Recompute RevenueSummary rows of days from date `since' on.
+
+    By default, days from SUBSCRIPTION_ANALYTICS_OVERLAP (default 2)
+    days before the last summarized day are recomputed, which also
+    picks up Transactions committed late; if there are no summary rows,
+    all Transactions are summarized.  Payments added by
+    `subscription.rollup' meanwhile wait until the new rows are
+    committed.  Returns number of written rows."""
+    if since is None:
+        last = RevenueSummary.objects.aggregate(last=Max('day'))['last']
+        if last is not None:
+            since = last - datetime.timedelta(_overlap())
+    summaries = RevenueSummary.objects.all()
+    if since is not None:
+        summaries = summaries.filter(day__gte=since)
+
+    db = router.db_for_write(RevenueSummary)
+    connection = connections[db]
+    qn = connection.ops.quote_name
+    sql, params = ledger_summary(since, using=db).query.sql_with_params()
+    # rows are copied by the database, without loading them
+    insert = ('INSERT INTO %s (%s, %s, %s, %s, %s) '
+              'SELECT day, %s, %s, number, COALESCE(total, 0) FROM (%s) s' % (
+                  qn(RevenueSummary._meta.db_table), qn('day'), qn('subscription_id'),
+                  qn('event'), qn('count'), qn('amount'), qn('subscription_id'),
+                  qn('event'), sql))
+
+    with transaction.commit_on_success(using=db):
+        # payments being added by rollup.apply() are committed (and
+        # counted below) first, later ones are added to the new rows
+        list(Subscription.objects.using(db).select_for_update().order_by(
+            'pk').values_list('pk'))
+        summaries.using(db).delete()
+        cursor = connection.cursor()
+        cursor.execute(insert, params)
+    return cursor.rowcount
+
+
+def _summary(events, since=None, until=None, subscription=None):
+    summaries = RevenueSummary.objects.filter(event__in=events)
+    if since is not None:
+        summaries = summaries.filter(day__gte=since)
+    if until is not None:
+        summaries = summaries.filter(day__lt=until)
+    if subscription is not None:
+        summaries = summaries.filter(subscription=subscription)
+    return summaries.order_by()
+
+
+def _fold(rows, period):
+    """Sum (day, value) rows into sorted list of (period start, sum)."""
+    if period not in PERIODS:
+        raise ValueError('Unknown period: %r' % (period, ))
+    totals = {}
+    for day, value in rows:
+        start = _period_start(_to_date(day), period)
+        totals[start] = totals.get(start, 0) + (value or 0)
+    return sorted(totals.items())
+
+
+def revenue(period='day', since=None, until=None, subscription=None):
+    """Return list of (period start date, amount) pairs of payments
+    received in each day, week (starting on Monday) or month `period'
+    between dates `since' (inclusive) and `until' (exclusive),
+    optionally only for `subscription'.  Periods without payments are
+    omitted."""
+    return _fold(_summary(REVENUE_EVENTS, since, until, subscription).values_list(
+        'day').annotate(Sum('amount')), period)
+
+
+def event_counts(events, period='day', since=None, until=None, subscription=None):
+    """Return list of (period start date, number) pairs of Transactions
+    with any of `events', like `revenue()'."""
+    return _fold(_summary(events, since, until, subscription).values_list(
+        'day').annotate(Sum('count')), period)
+
+
+def _active(plans):
+    """Return dictionary mapping ids of `plans' to numbers of their
+    active UserSubscriptions, read from PlanStats; plans without a
+    PlanStats row (see `subscription.rollup.reconcile()') count as 0."""
+    active = dict(PlanStats.objects.filter(
+        subscription__in=[plan.id for plan in plans]).values_list('subscription', 'active'))
+    return dict((plan.id, active.get(plan.id, 0)) for plan in plans)
+
+
+def mrr():
+    """Return list of (plan, active UserSubscriptions, monthly recurring
+    revenue) triples for each recurring plan, in Subscription's order.
+    Plans are PlanRecord objects of `subscription.models.plan_registry';
+    numbers of active UserSubscriptions are read from PlanStats and
+    revenue is estimated with `Subscription.price_per_day()' and average
+    month length."""
+    plans = [plan for plan in plan_registry.plans() if plan.recurrence_unit]
+    active = _active(plans)
+    month = _recurrence_unit_days['M']
+    return [(plan, active[plan.id],
+             Decimal(str(active[plan.id] * plan.price_per_day * month)
+                     ).quantize(Decimal('0.01')))
+            for plan in plans]
+
+
+def churn(period='month', since=None):
+    """Return list of dictionaries describing each day, week or month
+    `period' from date `since' to today: period `start', numbers of
+    `started' and `churned' (cancelled and ended) subscriptions, estimated number
+    of `active' subscriptions at period start and churn `rate' (churned
+    divided by active, None if there were no active subscriptions).
+
+    Active subscriptions are counted backwards from the current number
+    of active recurring UserSubscriptions (read from PlanStats), using
+    start, churn and change events recorded since."""
+    started = dict(event_counts(START_EVENTS, period, since))
+    churned = dict(event_counts(CHURN_EVENTS, period, since))
+    switched = dict(event_counts(SWITCH_EVENTS, period, since))
+    active = sum(_active([plan for plan in plan_registry.plans()
+                          if plan.recurrence_unit]).values())
+
+    result = []
+    for start in sorted(set(started) | set(churned) | set(switched), reverse=True):
+        active += churned.get(start, 0) + switched.get(start, 0) - started.get(start, 0)
+        result.append(dict(
+            start=start, started=started.get(start, 0), churned=churned.get(start, 0),
+            active=active,
+            rate=float(churned.get(start, 0)) / active if active > 0 else None))
+    result.reverse()
+    return result
+
+
+def cohorts(since=None):
+    """Return list of (cohort month, size, retained) triples, one for
+    each month in which users first started a subscription (from date
+    `since' on).  `retained' is a list of numbers of cohort's users
+    who paid for a subscription in the cohort month and each following
+    month.  Computed with two GROUP BY queries over Transactions."""
+    db = router.db_for_read(Transaction)
+    connection = connections[db]
+    qn = connection.ops.quote_name
+    table = qn(Transaction._meta.db_table)
+    start_placeholders = ', '.join(['%s'] * len(START_EVENTS))
+    first = ('SELECT %(user)s, MIN(%(timestamp)s) AS first_time FROM %(table)s '
+             'WHERE %(event)s IN (%(starts)s) AND %(user)s IS NOT NULL '
+             'GROUP BY %(user)s' % dict(
+                 user=qn('user_id'), timestamp=qn('timestamp'), table=table,
+                 event=qn('event'), starts=start_placeholders))
+    params = list(START_EVENTS)
+    cohort_sql = _trunc_sql(connection, 'month', 'f.first_time')
+    where = ''
+    if since is not None:
+        where = 'WHERE f.first_time >= %s'
+        params.append(connection.ops.value_to_db_datetime(_midnight(since)))
+
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, COUNT(*) FROM (%s) f %s GROUP BY %s' % (
+        cohort_sql, first, where, cohort_sql), params)
+    sizes = dict((_to_date(cohort), size) for cohort, size in cursor.fetchall())
+
+    month_sql = _trunc_sql(connection, 'month', 'p.%s' % qn('timestamp'))
+    cursor.execute(
+        'SELECT %(cohort)s, %(month)s, COUNT(DISTINCT p.%(user)s) '
+        'FROM (%(first)s) f INNER JOIN %(table)s p ON p.%(user)s = f.%(user)s '
+        'WHERE p.%(event)s IN (%(payments)s) %(since)s '
+        'GROUP BY %(cohort)s, %(month)s' % dict(
+            cohort=cohort_sql, month=month_sql, user=qn('user_id'), first=first,
+            table=table, event=qn('event'),
+            payments=', '.join(['%s'] * len(PAYMENT_EVENTS)),
+            since=where.replace('WHERE', 'AND')),
+        list(START_EVENTS) + list(PAYMENT_EVENTS) + params[len(START_EVENTS):])
+    retained = {}
+    for cohort, month, users in cursor.fetchall():
+        cohort, month = _to_date(cohort), _to_date(month)
+        offset = (month.year - cohort.year) * 12 + month.month - cohort.month
+        if offset >= 0:
+            retained.setdefault(cohort, {})[offset] = users
+
+    result = []
+    for cohort in sorted(sizes):
+        counts = retained.get(cohort, {})
+        length = max(counts) + 1 if counts else 0
+        result.append((cohort, sizes[cohort], [counts.get(i, 0) for i in range(length)]))
+    return result
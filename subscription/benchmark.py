@@ -0,0 +1,250 @@
+"""Benchmarks of subscription lifecycle hot paths.
+
+`run()' fills the database with synthetic plans, users,
+UserSubscriptions, Transactions and django-paypal PayPalIPN records,
+and measures IPN handling (for each notification type),
+`unsubscribe_expired()', `User.get_subscription()',
+`subscription_detail' view, admin changelists and `extend_date_by()'.
+For each benchmark it reports number of operations, best time of
+`repeat' runs, operations per second and database queries per
+operation; `compare()' compares two such reports.
+
+Benchmarks write to the database, so they should run in a scratch or
+test database; `subscription_benchmark' management command creates
+one the way the test runner does (in memory for SQLite).
+"""
+import datetime
+import itertools
+import platform
+import random
+import time
+
+import django
+from django.contrib import admin
+from django.contrib.auth.models import Group, User
+from django.db import connection
+from django.test.client import RequestFactory
+from paypal.standard.ipn.models import PayPalIPN
+
+from models import IPN_HANDLERS, Subscription, Transaction, UserSubscription, \
+    _lapsed_usersubscriptions, subscription_cache, unsubscribe_expired
+import utils
+import views
+
+# notifications of a subscription's life, handled in this order:
+# (txn_type, plan, django-paypal signal)
+IPN_STEPS = (
+    ('subscr_signup', 'monthly', 'subscription_signup'),
+    ('subscr_payment', 'monthly', 'payment_was_successful'),
+    ('subscr_modify', 'yearly', 'subscription_modify'),
+    ('subscr_cancel', 'yearly', 'subscription_cancel'),
+    ('subscr_eot', 'yearly', 'subscription_eot'),
+    ('web_accept', 'once', 'payment_was_successful'),
+    )
+
+# number of requests of view and admin benchmarks
+REQUESTS = 20
+
+
+class Population(object):
+    """Synthetic plans and `users' users with UserSubscriptions and
+    Transactions."""
+
+    def __init__(self, users, seed=1):
+        self.rnd = random.Random(seed)
+        self._tags = itertools.count(1)
+        self.monthly, self.yearly, self.once = [
+            Subscription.objects.create(
+                name='benchmark %s' % name, price=price, recurrence_period=period,
+                recurrence_unit=unit, trial_period=trial, trial_unit=trial and 'D',
+                group=Group.objects.create(name='benchmark %s' % name))
+            for name, price, period, unit, trial in (
+                ('monthly', 10, 1, 'M', 7), ('yearly', 100, 1, 'Y', None),
+                ('once', 50, None, None, None))]
+        self.plans = (self.monthly, self.yearly, self.once)
+        self.superuser = User.objects.create(username='benchmark', is_staff=True,
+                                             is_superuser=True)
+
+        self.users = self.new_users(users)
+        today = datetime.date.today()
+        usersubscriptions = []
+        for user_id in self.users.values_list('pk', flat=True):
+            plan = self.rnd.choice(self.plans)
+            usersubscriptions.append(UserSubscription(
+                user_id=user_id, subscription=plan, active=self.rnd.random() < 0.9,
+                cancelled=self.rnd.random() < 0.3,
+                expires=today + datetime.timedelta(self.rnd.randrange(1, 365))))
+        UserSubscription.objects.bulk_create(usersubscriptions)
+        self._add_members(us for us in usersubscriptions if us.active)
+        Transaction.objects.bulk_create([
+            Transaction(user_id=us.user_id, subscription=us.subscription, amount=price,
+                        event=event)
+            for us in usersubscriptions
+            for event, price in (('new usersubscription', us.subscription.price),
+                                 ('activated', us.subscription.price),
+                                 ('subscription payment', us.subscription.price))])
+
+    def new_users(self, number):
+        """Create `number' users; return their query set."""
+        prefix = 'benchmark%d-' % next(self._tags)
+        User.objects.bulk_create([User(username='%s%d' % (prefix, i))
+                                  for i in xrange(number)])
+        return User.objects.filter(username__startswith=prefix).order_by('pk')
+
+    def ipns(self, txn_type, plan, user_ids):
+        """Create PayPalIPN of `txn_type' for `plan' and each of
+        `user_ids'; return list of them."""
+        tag = 'benchmark%d' % next(self._tags)
+        ipns = []
+        for user_id in user_ids:
+            ipn = PayPalIPN(txn_type=txn_type, custom=str(user_id),
+                            item_number=str(plan.id), mc_gross=plan.price,
+                            payment_status='Completed', ipaddress='127.0.0.1',
+                            invoice=tag, subscr_id='B%d' % user_id)
+            if txn_type in ('subscr_payment', 'web_accept'):
+                ipn.txn_id = '%s-%d' % (tag[9:], user_id)
+            ipns.append(ipn)
+        PayPalIPN.objects.bulk_create(ipns)
+        return list(PayPalIPN.objects.filter(invoice=tag).order_by('pk'))
+
+    def _add_members(self, usersubscriptions):
+        membership = User.groups.through
+        membership.objects.bulk_create([
+            membership(user_id=us.user_id, group_id=us.subscription.group_id)
+            for us in usersubscriptions])
+
+
+def _ipn(population, users):
+    user_ids = list(population.new_users(users).values_list('pk', flat=True))
+    for txn_type, plan, signal_name in IPN_STEPS:
+        ipns = population.ipns(txn_type, getattr(population, plan), user_ids)
+        handler = IPN_HANDLERS[signal_name]
+        yield 'ipn %s' % txn_type, len(ipns), lambda: [handler(ipn) for ipn in ipns]
+
+
+def _unsubscribe_expired(population, users):
+    # leftovers of previous runs would be examined again
+    _lapsed_usersubscriptions().delete()
+    lapsed = datetime.date.today() - UserSubscription.grace_timedelta \
+        - datetime.timedelta(30)
+    usersubscriptions = [
+        UserSubscription(user_id=user_id, subscription=population.monthly,
+                         active=True, cancelled=i % 2, expires=lapsed)
+        for i, user_id in enumerate(population.new_users(users).values_list('pk', flat=True))]
+    UserSubscription.objects.bulk_create(usersubscriptions)
+    population._add_members(usersubscriptions)
+    yield 'unsubscribe_expired', users, unsubscribe_expired
+
+
+def _get_subscription(population, users):
+    def get_subscriptions(users):
+        for user in users:
+            user.get_subscription()
+    fresh = list(population.users)
+    subscription_cache.invalidate_all()
+    subscription_cache.invalidate_users([user.pk for user in fresh])
+    yield 'get_subscription', len(fresh), lambda: get_subscriptions(fresh)
+    fresh = list(population.users)
+    yield 'get_subscription (cached)', len(fresh), lambda: get_subscriptions(fresh)
+
+
+def _subscription_detail(population, users):
+    requests = []
+    for user in population.users[:REQUESTS]:
+        request = RequestFactory().get('/')
+        request.user = user
+        requests.append((request, population.rnd.choice(population.plans).id))
+    yield 'subscription_detail', len(requests), lambda: [
+        views.subscription_detail(request, plan_id) for request, plan_id in requests]
+
+
+def _admin_changelists(population, users):
+    request = RequestFactory().get('/')
+    request.user = population.superuser
+    for model in (UserSubscription, Transaction):
+        model_admin = admin.site._registry[model]
+        yield 'admin %s changelist' % model._meta.module_name, REQUESTS, lambda: [
+            model_admin.changelist_view(request).render() for i in xrange(REQUESTS)]
+
+
+def _extend_date_by(population, users):
+    rnd = population.rnd
+    today = datetime.date.today()
+    arguments = [(today + datetime.timedelta(rnd.randrange(-365, 365)),
+                  rnd.randrange(1, 13), rnd.choice('DWMY'))
+                 for i in xrange(users * 10)]
+    yield 'extend_date_by', len(arguments), lambda: [
+        utils.extend_date_by(*args) for args in arguments]
+    dates, amounts, units = zip(*arguments)
+    yield 'extend_dates_by', len(arguments), lambda: utils.extend_dates_by(
+        dates, amounts, units)
+
+
+BENCHMARKS = (
+    ('ipn', _ipn),
+    ('unsubscribe_expired', _unsubscribe_expired),
+    ('get_subscription', _get_subscription),
+    ('subscription_detail', _subscription_detail),
+    ('admin', _admin_changelists),
+    ('extend_date_by', _extend_date_by),
+    )
+
+
+def _measure(function):
+    """Return time and number of database queries of calling
+    `function'."""
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        started = time.time()
+        function()
+        seconds = time.time() - started
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+    queries = len(connection.queries) - start
+    del connection.queries[start:]
+    return seconds, queries
+
+
+def run(users=1000, repeat=3, only=None):
+    """Run benchmarks (groups named in `only', default: all of
+    BENCHMARKS) `repeat' times with `users' synthetic users each and
+    return report dictionary.  Benchmark raising an exception reports
+    its `error' instead of its times."""
+    population = Population(users)
+    results = {}
+    for i in xrange(repeat):
+        for group, benchmark in BENCHMARKS:
+            if only and group not in only:
+                continue
+            try:
+                for name, operations, function in benchmark(population, users):
+                    seconds, queries = _measure(function)
+                    best = results.get(name)
+                    if best is None or seconds < best['seconds']:
+                        results[name] = dict(
+                            operations=operations, seconds=round(seconds, 6),
+                            per_second=round(operations / seconds, 1) if seconds else None,
+                            queries=round(float(queries) / operations, 2))
+            except Exception, e:
+                results.setdefault(group, dict(error='%s: %s' % (type(e).__name__, e)))
+    return dict(database=connection.vendor, django=django.get_version(),
+                python=platform.python_version(),
+                created=datetime.datetime.now().replace(microsecond=0).isoformat(),
+                users=users, repeat=repeat, results=results)
+
+
+def compare(old, new):
+    """Return list of (name, old result, new result, ratio) for
+    benchmarks in both `old' and `new' reports.  Ratio compares time
+    per operation; above 1 means new run is slower.  It is None if
+    either benchmark failed."""
+    comparison = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before, after = old['results'][name], new['results'][name]
+        ratio = None
+        if before.get('per_second') and after.get('per_second'):
+            ratio = before['per_second'] / after['per_second']
+        comparison.append((name, before, after, ratio))
+    return comparison
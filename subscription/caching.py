@@ -0,0 +1,205 @@
+"""Cache of users' subscriptions, used by User.get_subscription().
+
+Cache is kept in two layers: a small in-process LRU cache with
+entries expiring after SUBSCRIPTION_LOCAL_CACHE_TTL seconds, and
+Django cache framework backend named by SUBSCRIPTION_CACHE_BACKEND
+that is shared between processes.  User entries map user id to
+subscription id, or to NO_SUBSCRIPTION if user has no subscription.
+In-process layer also keeps PayPal button arguments of subscriptions.
+All entries are keyed by plans version, which is bumped whenever any
+Subscription changes.
+
+Invalidation happens when a change is made, inside its database
+transaction, and again when the transaction ends (through `again',
+e.g. `subscription.signals.after_transaction'): until the change is
+committed, other processes missing the cache load and cache rows as
+they were before it.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+NO_SUBSCRIPTION = 0             # negative cache entry, never a primary key
+
+_VERSION_KEY = 'subscription:version'
+_VERSION_TIMEOUT = 365 * 24 * 3600  # Django 1.5 treats None as default timeout
+
+
+class LocalCache(object):
+    """Thread-safe LRU cache of at most `size' entries, each living
+    for at most `ttl' seconds."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, deadline = self._data.pop(key)
+            except KeyError:
+                return default
+            if deadline < time.time():
+                return default
+            self._data[key] = (value, deadline)  # most recently used
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + self.ttl)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SubscriptionCache(object):
+    """Two-layer cache of user to subscription mapping and of
+    Subscription objects."""
+
+    def __init__(self, backend=None, timeout=None, local_size=None, local_ttl=None,
+                 again=None):
+        if backend is None:
+            backend = getattr(settings, 'SUBSCRIPTION_CACHE_BACKEND', 'default')
+        self.shared = backend and get_cache(backend)
+        if timeout is None:
+            timeout = getattr(settings, 'SUBSCRIPTION_CACHE_TIMEOUT', 3600)
+        self.timeout = timeout
+        if local_size is None:
+            local_size = getattr(settings, 'SUBSCRIPTION_LOCAL_CACHE_SIZE', 10000)
+        if local_ttl is None:
+            local_ttl = getattr(settings, 'SUBSCRIPTION_LOCAL_CACHE_TTL', 30)
+        self.local = LocalCache(local_size, local_ttl)
+        # called with a function and its arguments to call it again
+        # after the current database transaction
+        self.again = again
+
+    def _get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def _set(self, key, value):
+        self.local.set(key, value)
+        if self.shared:
+            self.shared.set(key, value, self.timeout)
+
+    def _delete(self, key):
+        self.local.delete(key)
+        if self.shared:
+            self.shared.delete(key)
+
+    def version(self):
+        version = self._get(_VERSION_KEY)
+        if version is None:
+            # start from current time, so that stale entries of an
+            # evicted version number are never reused
+            version = int(time.time())
+            if self.shared:
+                self.shared.add(_VERSION_KEY, version, _VERSION_TIMEOUT)
+                version = self.shared.get(_VERSION_KEY, version)
+            self.local.set(_VERSION_KEY, version)
+        return version
+
+    def version_time(self):
+        """Return time (seconds since the epoch) at which current plans
+        version was first used; all processes sharing the cache agree on
+        it."""
+        key = 'subscription:version-time:%s' % self.version()
+        value = self._get(key)
+        if value is None:
+            value = int(time.time())
+            if self.shared:
+                self.shared.add(key, value, _VERSION_TIMEOUT)
+                value = self.shared.get(key, value)
+            self.local.set(key, value)
+        return value
+
+    def _user_key(self, user_id):
+        return 'subscription:user:%s:%s' % (self.version(), user_id)
+
+    def _plan_key(self, subscription_id):
+        return 'subscription:plan:%s:%s' % (self.version(), subscription_id)
+
+    def get_subscription_id(self, user_id, load):
+        """Return cached subscription id of user `user_id' or
+        NO_SUBSCRIPTION; on cache miss, value is computed by calling
+        `load(user_id)'."""
+        key = self._user_key(user_id)
+        subscription_id = self._get(key)
+        if subscription_id is None:
+            subscription_id = load(user_id) or NO_SUBSCRIPTION
+            self._set(key, subscription_id)
+        return subscription_id
+
+    def get_subscription(self, subscription_id, load):
+        """Return cached Subscription object with id `subscription_id';
+        on cache miss, object is loaded by calling `load(subscription_id)'."""
+        key = self._plan_key(subscription_id)
+        subscription = self._get(key)
+        if subscription is None:
+            subscription = load(subscription_id)
+            self._set(key, subscription)
+        return subscription
+
+    def get_paypal_button(self, subscription_id, settings_key, upgrade, load):
+        """Return cached user-independent PayPal form arguments of
+        subscription `subscription_id' computed with site and settings
+        identified by string `settings_key'; on cache miss, they are
+        computed by calling `load()'.  They are kept only in the
+        in-process layer, as they are cheap to compute but depend on
+        process' settings and URLconf."""
+        key = 'subscription:paypal:%s:%s:%s:%d' % (
+            self.version(), settings_key, subscription_id, upgrade)
+        button = self.local.get(key)
+        if button is None:
+            button = load()
+            self.local.set(key, button)
+        return button
+
+    def _invalidate_users(self, user_ids):
+        keys = [self._user_key(user_id) for user_id in user_ids]
+        for key in keys:
+            self.local.delete(key)
+        if self.shared:
+            self.shared.delete_many(keys)
+
+    def _invalidate_all(self):
+        if self.shared:
+            try:
+                self.shared.incr(_VERSION_KEY)
+            except ValueError:
+                self.shared.set(_VERSION_KEY, int(time.time()), _VERSION_TIMEOUT)
+        self.local.clear()
+
+    def invalidate_user(self, user_id):
+        self.invalidate_users([user_id])
+
+    def invalidate_users(self, user_ids):
+        user_ids = list(user_ids)
+        self._invalidate_users(user_ids)
+        if self.again:
+            self.again(self._invalidate_users, user_ids)
+
+    def invalidate_all(self):
+        """Invalidate all entries by bumping plans version."""
+        self._invalidate_all()
+        if self.again:
+            self.again(self._invalidate_all)
@@ -0,0 +1,97 @@
+"""Snapshot of all Subscription plans, used by subscription_list view.
+
+Each process keeps one Catalog built from all Subscription rows.  It is
+rebuilt when plans version of the subscription cache (bumped whenever
+any Subscription is saved or deleted, and shared between processes)
+changes.  Pricing and trial display strings of each plan are rendered
+once per language: for languages in SUBSCRIPTION_CATALOG_LANGUAGES
+(default: LANGUAGE_CODE only) when catalog is built, for other ones on
+first use.
+"""
+import datetime
+import threading
+
+from django.conf import settings
+from django.utils import translation
+
+from models import Subscription, subscription_cache
+
+_DISPLAYS = ('get_pricing_display', 'get_trial_display')
+
+
+class Plan(object):
+    """Read-only Subscription with pre-rendered display strings.
+
+    Other attributes are looked up on the Subscription object."""
+
+    def __init__(self, subscription, languages=()):
+        self.subscription = subscription
+        self.absolute_url = subscription.get_absolute_url()
+        self._displays = {}
+        for language in languages:
+            with translation.override(language):
+                self._render()
+
+    def __getattr__(self, name):
+        return getattr(self.subscription, name)
+
+    def __unicode__(self):
+        return unicode(self.subscription)
+
+    def _render(self):
+        displays = dict((name, getattr(self.subscription, name)())
+                        for name in _DISPLAYS)
+        self._displays[translation.get_language()] = displays
+        return displays
+
+    def _display(self, name):
+        displays = self._displays.get(translation.get_language())
+        if displays is None:
+            displays = self._render()
+        return displays[name]
+
+    def get_pricing_display(self):
+        return self._display('get_pricing_display')
+
+    def get_trial_display(self):
+        return self._display('get_trial_display')
+
+    def get_absolute_url(self):
+        return self.absolute_url
+
+
+class Catalog(object):
+    """Snapshot of plans version `version', as a tuple of Plan objects
+    in Subscription's default order."""
+
+    def __init__(self, version, modified, plans):
+        self.version = version
+        self.modified = modified    # naive UTC datetime
+        self.plans = plans
+
+
+_catalog = None
+_lock = threading.Lock()
+
+
+def _languages():
+    return getattr(settings, 'SUBSCRIPTION_CATALOG_LANGUAGES',
+                   (settings.LANGUAGE_CODE, ))
+
+
+def get_catalog():
+    """Return Catalog of current plans version, building it if needed."""
+    global _catalog
+    version = subscription_cache.version()
+    catalog = _catalog
+    if catalog is None or catalog.version != version:
+        with _lock:
+            catalog = _catalog
+            if catalog is None or catalog.version != version:
+                modified = datetime.datetime.utcfromtimestamp(
+                    subscription_cache.version_time())
+                languages = _languages()
+                plans = tuple(Plan(subscription, languages)
+                              for subscription in Subscription.objects.all())
+                catalog = _catalog = Catalog(version, modified, plans)
+    return catalog
@@ -0,0 +1,135 @@
+"""Expiry of lapsed subscriptions shared by several workers and nodes.
+
+`plan()' splits users with lapsed UserSubscriptions into ExpiryShard
+rows of SUBSCRIPTION_EXPIRY_SHARD_SIZE (default 10000) user ids each,
+aligned to multiples of the size, so that nodes planning the same day
+create the same shards.  Shards are leased to workers like IPNJobs:
+a shard is claimed by a conditional UPDATE of its `worker' token and
+`locked_until', so it is processed by one worker at a time on any node.
+
+A shard is processed in chunks, as `unsubscribe_expired()' does.
+Each chunk is committed together with shard's progress (`last_pk' and
+counts) and a renewed lease; if the lease was taken over by another
+worker meanwhile, the chunk is rolled back.  A shard of a crashed
+worker can be claimed again after its lease expires, and processing
+continues after its last committed chunk.
+"""
+import datetime
+import time
+import uuid
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import F, Max, Min
+
+import instrumentation
+import signals
+from models import ExpiryShard, _lapsed_usersubscriptions, _revoke_usersubscriptions
+from rollup import _create
+from worker import _unlocked, worker_name
+
+COUNTERS = ('unsubscribed', 'deleted', 'transactions')
+
+
+class LeaseLost(Exception):
+    """Shard was claimed by another worker."""
+
+
+def shard_size():
+    return getattr(settings, 'SUBSCRIPTION_EXPIRY_SHARD_SIZE', 10000)
+
+
+def plan(day=None):
+    """Create missing ExpiryShards of `day' (default: today) covering
+    users with lapsed UserSubscriptions; returns number of shards of
+    the day."""
+    day = day or datetime.date.today()
+    size = shard_size()
+    bounds = _lapsed_usersubscriptions(day).aggregate(first=Min('user'), last=Max('user'))
+    if bounds['first'] is not None:
+        using = router.db_for_write(ExpiryShard)
+        existing = set(ExpiryShard.objects.filter(day=day).values_list('start', flat=True))
+        with transaction.commit_on_success(using=using):
+            for start in xrange(bounds['first'] // size * size, bounds['last'] + 1, size):
+                if start not in existing:
+                    # ignored if created by another node meanwhile
+                    _create(ExpiryShard, using, lambda: None,
+                            day=day, start=start, end=start + size)
+    return ExpiryShard.objects.filter(day=day).count()
+
+
+def claim(worker, day=None, limit=1, lease=300):
+    """Lease at most `limit' unfinished shards of `day' (default: today)
+    to `worker' for `lease' seconds; returns list of (shard id, token)
+    pairs."""
+    day = day or datetime.date.today()
+    now = datetime.datetime.now()
+    ready = ExpiryShard.objects.filter(day=day, done=False).filter(_unlocked(now))
+    claimed = []
+    for shard_id in ready.order_by('start').values_list('pk', flat=True)[:limit * 2]:
+        token = '%s:%s' % (worker, uuid.uuid4().hex)
+        # fails if another worker claimed the shard since it was read
+        if ready.filter(pk=shard_id).update(
+                worker=token, locked_until=now + datetime.timedelta(seconds=lease)):
+            claimed.append((shard_id, token))
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+@instrumentation.instrumented('expiry.shard')
+def process(shard_id, token, lease=300, chunk_size=1000):
+    """Process lapsed UserSubscriptions of shard `shard_id' leased with
+    `token', continuing after its last committed chunk.  Returns the
+    ExpiryShard; raises LeaseLost if it was claimed by another worker."""
+    shard = ExpiryShard.objects.get(pk=shard_id)
+    lapsed = _lapsed_usersubscriptions(shard.day).filter(
+        user__gte=shard.start, user__lt=shard.end).order_by('pk').values_list(
+        'pk', 'user_id', 'subscription_id', 'subscription__group_id', 'cancelled')
+    last_pk = shard.last_pk
+    while True:
+        started = time.time()
+        rows = list(lapsed.filter(pk__gt=last_pk)[:chunk_size])
+        with signals.deferring(), transaction.commit_on_success():
+            counts = _revoke_usersubscriptions(rows) if rows else {}
+            updates = dict((name, F(name) + counts.get(name, 0)) for name in COUNTERS)
+            if rows:
+                last_pk = rows[-1][0]
+            if not ExpiryShard.objects.filter(pk=shard_id, worker=token).update(
+                    last_pk=last_pk, usersubscriptions=F('usersubscriptions') + len(rows),
+                    seconds=F('seconds') + (time.time() - started), done=not rows,
+                    locked_until=datetime.datetime.now() + datetime.timedelta(seconds=lease),
+                    **updates):
+                raise LeaseLost(shard_id)
+        if not rows:
+            return ExpiryShard.objects.get(pk=shard_id)
+
+
+def _process(args):
+    shard_id, token, kwargs = args
+    try:
+        return process(shard_id, token, **kwargs)
+    except LeaseLost:
+        return None
+
+
+def run(pool, worker=None, day=None, batch_size=1, lease=300, chunk_size=1000, log=None):
+    """Plan shards of `day' (default: today) and process unfinished
+    ones in `pool' (see `worker.make_pool()'), `batch_size' at a time,
+    until none is left to claim.  `log' is called with each processed
+    ExpiryShard.  Returns list of shards processed by this call."""
+    worker = worker or worker_name()
+    day = day or datetime.date.today()
+    kwargs = dict(lease=lease, chunk_size=chunk_size)
+    plan(day)
+    processed = []
+    while True:
+        claimed = claim(worker, day, batch_size, lease)
+        if not claimed:
+            return processed
+        for shard in pool.imap_unordered(
+                _process, [(shard_id, token, kwargs) for shard_id, token in claimed]):
+            if shard is not None:
+                processed.append(shard)
+                if log:
+                    log(shard)
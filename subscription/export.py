@@ -0,0 +1,211 @@
+"""Streaming export of the Transaction ledger.
+
+Used by `subscription_export_transactions' management command.
+Transactions are read in pages of at most `chunk_size' rows, ordered by
+(timestamp, id) and each page selected by keyset (rows after the last
+row of the previous page), so memory use does not depend on ledger size
+and export can be resumed after the last written row.
+"""
+import cStringIO
+import csv
+import gzip
+import os
+from json.encoder import encode_basestring_ascii
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from models import Transaction
+
+FIELDS = ('timestamp', 'id', 'event', 'user_id', 'subscription_id', 'ipn_id',
+          'amount', 'comment', 'idempotency_key')
+
+
+def _values(queryset, connection):
+    if connection.vendor != 'sqlite':
+        return queryset.values_list(*FIELDS)
+    # SQLite keeps timestamps as text; reading them through an
+    # expression skips their conversion to datetime, which would take
+    # most of export's time.
+    qn = connection.ops.quote_name
+    return queryset.extra(select={'timestamp_text': '+%s.%s' % (
+        qn(Transaction._meta.db_table), qn('timestamp'))}
+        ).values_list('timestamp_text', *FIELDS[1:])
+
+
+def _key_time(timestamp):
+    if isinstance(timestamp, basestring):
+        # text read from SQLite, which stores UTC if USE_TZ is set
+        timestamp = parse_datetime(timestamp)
+        if settings.USE_TZ and timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, timezone.utc)
+    return timestamp
+
+
+def pages(queryset=None, after=None, chunk_size=10000):
+    """Yield lists of Transaction value tuples (fields FIELDS) in
+    (timestamp, id) order, starting after (timestamp, id) key `after'.
+    Timestamps are datetime objects, or text in the same format on
+    SQLite."""
+    if queryset is None:
+        queryset = Transaction.objects.all()
+    connection = connections[queryset.db]
+    queryset = _values(queryset.order_by('timestamp', 'id'), connection)
+    while True:
+        page = queryset
+        if after is not None:
+            timestamp, pk = _key_time(after[0]), after[1]
+            # range condition first, so that timestamp index is used
+            page = page.filter(Q(timestamp__gt=timestamp) | Q(id__gt=pk),
+                               timestamp__gte=timestamp)
+        # plain cursor, as Django's per-row processing of values_list()
+        # results would take more time than the query
+        sql, params = page[:chunk_size].query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0], rows[-1][1]
+        if len(rows) < chunk_size:
+            return
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+_JSON_LINE = '{%s}\n' % ','.join('"%s":%%s' % name for name in FIELDS)
+
+
+def _json_line(row, escape=encode_basestring_ascii):
+    # unrolled, as general JSON encoding of a dictionary for each row
+    # would take most of export's time
+    timestamp, pk, event, user_id, subscription_id, ipn_id, amount, comment, key = row
+    return _JSON_LINE % (
+        escape(timestamp if isinstance(timestamp, basestring) else str(timestamp)),
+        pk, escape(event),
+        'null' if user_id is None else user_id,
+        'null' if subscription_id is None else subscription_id,
+        'null' if ipn_id is None else ipn_id,
+        'null' if amount is None else escape(str(amount)),  # kept exact
+        escape(comment),
+        'null' if key is None else escape(key))
+
+
+class CSVWriter(object):
+    """Writes rows as CSV with a header line (unless `header' is false)."""
+
+    def __init__(self, stream, header=True):
+        self.stream = stream
+        self.writer = csv.writer(stream)
+        if header:
+            self.writer.writerow(FIELDS)
+
+    def write(self, rows):
+        # csv module handles None, numbers, datetimes and ASCII text
+        # itself; rows are converted only if some text is not ASCII
+        buf = cStringIO.StringIO()
+        try:
+            csv.writer(buf).writerows(rows)
+        except UnicodeEncodeError:
+            self.writer.writerows([[_encode(value) for value in row] for row in rows])
+        else:
+            self.stream.write(buf.getvalue())
+
+
+class JSONWriter(object):
+    """Writes rows as newline-delimited JSON objects (ASCII only, with
+    other characters escaped)."""
+
+    def __init__(self, stream, header=True):
+        self.stream = stream
+
+    def write(self, rows):
+        self.stream.write(''.join(map(_json_line, rows)))
+
+
+WRITERS = {'csv': CSVWriter, 'json': JSONWriter}
+
+
+class GzipMembers(object):
+    """File-like object compressing data written to file object `raw'
+    as a series of gzip members.  `end_member()' completes the current
+    member, so that `raw' holds a valid gzip file up to that point;
+    readers decompress the members as one file."""
+
+    def __init__(self, raw, compresslevel=6):
+        self.raw = raw
+        self.compresslevel = compresslevel
+        self.member = None
+
+    def write(self, data):
+        if self.member is None:
+            self.member = gzip.GzipFile(fileobj=self.raw, mode='wb',
+                                        compresslevel=self.compresslevel)
+        self.member.write(data)
+
+    def end_member(self):
+        if self.member is not None:
+            self.member.close()         # leaves `raw' open
+            self.member = None
+
+    close = end_member
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return f.read().splitlines()
+    except IOError:
+        return None
+
+
+def read_checkpoint(path):
+    """Return (timestamp, id) key stored in checkpoint file `path', or
+    None if there is no such file."""
+    lines = _read_checkpoint(path)
+    if lines is None:
+        return None
+    pk, timestamp = lines[:2]
+    return timestamp, int(pk)
+
+
+def checkpoint_offset(path):
+    """Return size of output file when checkpoint file `path' was
+    written, or None if it was not stored."""
+    lines = _read_checkpoint(path)
+    if lines and len(lines) > 2:
+        return int(lines[2])
+
+
+def write_checkpoint(path, key, offset=None):
+    """Atomically store (timestamp, id) key `key' and size of output
+    file `offset' (if known) in file `path'."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('%d\n%s\n' % (key[1], key[0]))
+        if offset is not None:
+            f.write('%d\n' % offset)
+    os.rename(tmp, path)
+
+
+def export(writer, queryset=None, after=None, chunk_size=10000, checkpoint=None,
+           flush=None):
+    """Write Transactions (all or from `queryset') after key `after' to
+    `writer'.  If `checkpoint' path is given, key of last written row is
+    stored there after each page, once `flush()' has been called, along
+    with output size it returns.  Returns number of written rows."""
+    count = 0
+    for rows in pages(queryset, after, chunk_size):
+        writer.write(rows)
+        count += len(rows)
+        if checkpoint:
+            write_checkpoint(checkpoint, rows[-1][:2], flush and flush())
+    return count
@@ -0,0 +1,129 @@
+"""Upcoming expirations and expected renewal revenue.
+
+`upcoming()' streams active UserSubscriptions expiring in the next
+days, read in chunks by keyset on (expires, id), which follows the
+(active, expires) index, so memory use does not depend on number of
+subscriptions.  `renewals()' projects renewal payments of recurring,
+not cancelled subscriptions day by day; subscriptions are counted by
+expiry date and plan in SQL and each (date, plan) group is extended
+with `extend_date_by()' once.
+"""
+import collections
+import datetime
+from decimal import Decimal
+
+from django.db import connections
+from django.db.models import Count, Q
+from django.utils.dateparse import parse_date
+
+from models import UserSubscription, plan_registry
+import utils
+
+# Active UserSubscription expiring on `expires'.  User loses access on
+# `lapses' (after grace period) unless subscription is renewed;
+# `next_expires' is expiry date after renewal, None for cancelled and
+# one-time subscriptions.
+Expiration = collections.namedtuple('Expiration', (
+    'usersubscription_id', 'user_id', 'subscription_id', 'expires', 'lapses',
+    'cancelled', 'next_expires'))
+
+Renewals = collections.namedtuple('Renewals', ('day', 'count', 'amount'))
+
+
+def _expiring(start, end):
+    return UserSubscription.active_objects.filter(
+        expires__gte=start, expires__lt=end).order_by('expires', 'pk')
+
+
+FIELDS = ('expires', 'pk', 'user_id', 'subscription_id', 'cancelled')
+
+
+def _values(queryset, connection):
+    if connection.vendor != 'sqlite':
+        return queryset.values_list(*FIELDS)
+    # dates read as text, as in export; each distinct date is parsed
+    # once instead of once per row
+    qn = connection.ops.quote_name
+    return queryset.extra(select={'expires_text': '+%s.%s' % (
+        qn(UserSubscription._meta.db_table), qn('expires'))}
+        ).values_list('expires_text', *FIELDS[1:])
+
+
+def upcoming(days=30, today=None, chunk_size=10000):
+    """Yield Expiration of each active UserSubscription expiring in
+    `days' days from `today' (default: current date), in order of
+    expiry date."""
+    today = today or datetime.date.today()
+    end = today + datetime.timedelta(days)
+    queryset = _expiring(today, end)
+    connection = connections[queryset.db]
+    queryset = _values(queryset, connection)
+    grace = UserSubscription.grace_timedelta
+    plans = dict((plan.id, plan) for plan in plan_registry.plans())
+    dates = {}
+    after = None
+    while True:
+        chunk = queryset
+        if after is not None:
+            chunk = chunk.filter(Q(expires__gt=after[0]) | Q(pk__gt=after[1]),
+                                 expires__gte=after[0])
+        # plain cursor, as in export.pages()
+        sql, params = chunk[:chunk_size].query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        if not rows:
+            return
+
+        expirations, renewing = [], []
+        for expires, pk, user_id, subscription_id, cancelled in rows:
+            if not isinstance(expires, datetime.date):
+                expires = dates.get(expires) or dates.setdefault(expires, parse_date(expires))
+            plan = plans.get(subscription_id)
+            if not cancelled and plan is not None and plan.recurrence_unit \
+                    and plan.recurrence_period:
+                renewing.append((len(expirations), expires, plan.recurrence_period,
+                                 plan.recurrence_unit))
+            expirations.append([pk, user_id, subscription_id, expires, expires + grace,
+                                bool(cancelled), None])
+        if renewing:
+            indexes, starts, amounts, units = zip(*renewing)
+            for i, date in zip(indexes, utils.extend_dates_by(starts, amounts, units)):
+                expirations[i][6] = date
+
+        for expiration in expirations:
+            yield Expiration(*expiration)
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][0], rows[-1][1]
+
+
+def renewals(days=90, today=None):
+    """Yield Renewals (`day', number of renewals and expected `amount')
+    for each of `days' days from `today' (default: current date).
+
+    Renewal of a subscription is expected on its expiry date and, if
+    it falls within the forecast, again on each following expiry date.
+    Subscriptions in grace period (expired, but not lapsed yet) are
+    expected to renew today."""
+    today = today or datetime.date.today()
+    end = today + datetime.timedelta(days)
+    groups = UserSubscription.active_objects.filter(
+        cancelled=False, expires__gte=today - UserSubscription.grace_timedelta,
+        expires__lt=end).order_by().values_list('expires', 'subscription').annotate(Count('id'))
+
+    counts = [0] * days
+    amounts = [Decimal(0)] * days
+    for expires, subscription_id, number in groups:
+        plan = plan_registry.get(subscription_id)
+        if plan is None or not (plan.recurrence_unit and plan.recurrence_period):
+            continue
+        date = expires
+        while date < end:
+            i = max((date - today).days, 0)
+            counts[i] += number
+            amounts[i] += number * plan.price
+            date = utils.extend_date_by(date, plan.recurrence_period, plan.recurrence_unit)
+
+    for i in xrange(days):
+        yield Renewals(today + datetime.timedelta(i), counts[i], amounts[i])
@@ -0,0 +1,207 @@
+"""Wall time, query count and signal listener time of subscription
+operations.
+
+Functions decorated with `instrumented(operation)' (IPN handlers and
+their steps, UserSubscription methods, `unsubscribe_expired()', ledger
+writes and views) report a Sample to each sink listed in
+SUBSCRIPTION_INSTRUMENTATION setting, or added with `add_sink()'.
+Operations nest; inner operations (e.g. `ipn.lookup' inside
+`ipn.subscription_signup') are reported separately and are also
+included in numbers of the outer ones.  Queries are counted with
+Django's debug cursor, enabled only while an operation is measured;
+time spent sending `subscription.signals' is counted as listener time.
+
+With no sinks, an instrumented function is called directly after a
+single check, and nothing is measured.
+
+A sink is any object with `record(sample)' method; LoggingSink,
+StatsdSink and MemorySink are provided.
+"""
+import bisect
+import collections
+import functools
+import logging
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+Sample = collections.namedtuple('Sample', (
+    'operation', 'seconds', 'queries', 'listener_seconds'))
+
+# sinks reporting is enabled for; empty tuple disables it
+sinks = ()
+
+_local = threading.local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        stack = _local.stack = []
+        return stack
+
+
+class LoggingSink(object):
+    """Log each Sample to `logger' with `level'."""
+
+    def __init__(self, logger='subscription.instrumentation', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def record(self, sample):
+        self.logger.log(self.level, '%s: %.2f ms, %d queries, %.2f ms in signal listeners',
+                        sample.operation, sample.seconds * 1000, sample.queries,
+                        sample.listener_seconds * 1000)
+
+
+class StatsdSink(object):
+    """Send each Sample to statsd daemon at (`host', `port') as
+    `<prefix>.<operation>.time', `.queries' and `.listeners' timers,
+    in a single UDP packet.  Errors are ignored."""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='subscription'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, sample):
+        name = '%s.%s' % (self.prefix, sample.operation)
+        packet = '%s.time:%.3f|ms\n%s.queries:%d|ms\n%s.listeners:%.3f|ms' % (
+            name, sample.seconds * 1000, name, sample.queries,
+            name, sample.listener_seconds * 1000)
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error:
+            pass
+
+
+class MemorySink(object):
+    """Keep last `max_samples' Samples of each operation and histogram
+    of their times, with bucket upper bounds `buckets' (in seconds)."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=BUCKETS, max_samples=1000):
+        self.buckets = tuple(buckets)
+        self.max_samples = max_samples
+        self.clear()
+
+    def clear(self):
+        self.samples = {}
+        self.counts = {}
+
+    def record(self, sample):
+        operation = sample.operation
+        if operation not in self.samples:
+            self.samples[operation] = collections.deque(maxlen=self.max_samples)
+            self.counts[operation] = [0] * (len(self.buckets) + 1)
+        self.samples[operation].append(sample)
+        self.counts[operation][bisect.bisect_left(self.buckets, sample.seconds)] += 1
+
+    def histogram(self, operation):
+        """Return list of (upper bound, number of samples) pairs of
+        `operation'; last bound is None (no limit)."""
+        counts = self.counts.get(operation, [0] * (len(self.buckets) + 1))
+        return zip(self.buckets + (None, ), counts)
+
+    def operations(self):
+        return sorted(self.samples)
+
+
+def _load_sinks():
+    global sinks
+    loaded = []
+    for sink in getattr(settings, 'SUBSCRIPTION_INSTRUMENTATION', ()):
+        if isinstance(sink, basestring):
+            dot = sink.rindex('.')
+            module = __import__(sink[:dot], {}, {}, [''])
+            sink = getattr(module, sink[dot + 1:])()
+        loaded.append(sink)
+    sinks = tuple(loaded)
+_load_sinks()
+
+
+def add_sink(sink):
+    """Report operations also to `sink'."""
+    global sinks
+    sinks = sinks + (sink, )
+
+
+def remove_sink(sink):
+    global sinks
+    sinks = tuple(s for s in sinks if s is not sink)
+
+
+def _query_count(databases):
+    return sum(len(connection.queries) for connection in databases)
+
+
+class measure(object):
+    """Context manager reporting Sample of its block as `operation'."""
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        stack = _stack()
+        if not stack:
+            # outermost operation enables counting of queries
+            self.databases = connections.all()
+            self.debug_cursors = [connection.use_debug_cursor
+                                  for connection in self.databases]
+            self.logged = [len(connection.queries) for connection in self.databases]
+            for connection in self.databases:
+                connection.use_debug_cursor = True
+        else:
+            self.databases = stack[0].databases
+        stack.append(self)
+        self.listener_seconds = 0.0
+        self.queries = _query_count(self.databases)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self.started
+        queries = max(_query_count(self.databases) - self.queries, 0)
+        stack = _stack()
+        stack.remove(self)
+        if not stack:
+            for connection, debug_cursor, logged in zip(
+                    self.databases, self.debug_cursors, self.logged):
+                connection.use_debug_cursor = debug_cursor
+                if not (debug_cursor or settings.DEBUG):
+                    # not logged without instrumentation
+                    del connection.queries[logged:]
+        sample = Sample(self.operation, seconds, queries, self.listener_seconds)
+        for sink in sinks:
+            try:
+                sink.record(sample)
+            except Exception:
+                logger.exception('Instrumentation sink %r failed', sink)
+
+
+def add_listener_time(seconds):
+    """Count `seconds' spent in signal listeners to all operations being
+    measured in this thread."""
+    for operation in _stack():
+        operation.listener_seconds += seconds
+
+
+def instrumented(operation):
+    """Decorator reporting calls of decorated function as `operation'
+    while there are sinks."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not sinks:
+                return func(*args, **kwargs)
+            with measure(operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,144 @@
+"""Batched writing of Transaction ledger rows.
+
+Transactions recorded with `record()' inside a TransactionWriter are
+collected and inserted with a single `bulk_create()' when the writer is
+left (or flushed), instead of one INSERT each.  Writers nest; rows go
+to the innermost active writer of the current thread, and functions
+decorated with `batched' join the active writer of their caller.
+Outside of any writer, `record()' saves the Transaction at once.
+
+Django does not run code on transaction commit, so a writer used as a
+unit of work is entered inside the database transaction (e.g. below
+`commit_on_success') and flushes before it commits; ledger rows are
+committed or rolled back together with the changes they record.
+Rows of a writer left by an exception are discarded.
+
+Idempotency keys are unique: of Transactions recorded in a writer
+with the same key (e.g. all rows written while handling one IPN), only
+the first one keeps it.
+
+Counter changes reported to `subscription.rollup' inside a writer are
+applied when it flushes, together with revenue of written payments.
+
+Note that `bulk_create()' does not send `pre_save' and `post_save'
+signals for the inserted Transactions.
+"""
+import functools
+import threading
+import time
+
+import instrumentation
+
+_local = threading.local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        stack = _local.stack = []
+        return stack
+
+
+def current():
+    """Return innermost active TransactionWriter of this thread, or None."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+class TransactionWriter(object):
+    """Collects Transactions and inserts them with `bulk_create()'.
+
+    By default rows are inserted only by `flush()' and when the writer
+    used as a context manager is left.  In buffered mode, meant for
+    batch jobs, rows are also flushed as soon as `max_rows' rows are
+    collected or the oldest collected row is `max_delay' seconds old
+    (checked whenever a row is added)."""
+
+    def __init__(self, max_rows=None, max_delay=None, using=None):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.using = using
+        self.pending = []
+        self.plan_deltas = {}           # see subscription.rollup
+        self.written = 0
+        self.keys = set()               # idempotency keys recorded
+        self._started = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, transaction):
+        """Add unsaved Transaction object `transaction'."""
+        key = transaction.idempotency_key
+        if key is not None:
+            if key in self.keys:
+                transaction.idempotency_key = None
+            else:
+                self.keys.add(key)
+        if not self.pending:
+            self._started = time.time()
+        self.pending.append(transaction)
+        if (self.max_rows is not None and len(self.pending) >= self.max_rows) or \
+           (self.max_delay is not None and time.time() - self._started >= self.max_delay):
+            self.flush()
+
+    def record(self, **fields):
+        """Add Transaction with field values `fields'."""
+        from models import Transaction
+        self.add(Transaction(**fields))
+
+    @instrumentation.instrumented('ledger.flush')
+    def flush(self):
+        """Insert collected Transactions; returns number of inserted rows."""
+        pending, self.pending = self.pending, []
+        plan_deltas, self.plan_deltas = self.plan_deltas, {}
+        if pending:
+            from models import Transaction
+            Transaction.objects.db_manager(self.using).bulk_create(pending)
+            self.written += len(pending)
+        if pending or plan_deltas:
+            import rollup
+            rollup.apply(plan_deltas, pending, self.using)
+        return len(pending)
+
+    def discard(self):
+        """Drop collected Transactions and counter changes without
+        writing them."""
+        self.pending = []
+        self.plan_deltas = {}
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stack = _stack()
+        stack.remove(self)
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+
+def record(**fields):
+    """Record Transaction with field values `fields' in current writer,
+    or save it at once if there is none."""
+    writer = current()
+    if writer is None:
+        with TransactionWriter() as writer:
+            writer.record(**fields)
+    else:
+        writer.record(**fields)
+
+
+def batched(func):
+    """Decorator running `func' inside a new TransactionWriter, unless
+    a writer is already active (then `func' records to it)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current() is not None:
+            return func(*args, **kwargs)
+        with TransactionWriter():
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,68 @@
+import json
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from subscription import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmark IPN handling, expiry, subscription lookups, views ' \
+           'and admin changelists in a test database; write results as JSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000,
+                    help='Number of synthetic users for each benchmark '
+                         '(default 1000).'),
+        make_option('--repeat', type='int', default=3,
+                    help='Number of runs; best time is reported (default 3).'),
+        make_option('--only', action='append', default=[],
+                    choices=[name for name, function in benchmark.BENCHMARKS],
+                    help='Run only this group of benchmarks; may be repeated.'),
+        make_option('--output', default='-',
+                    help='Output file; default is standard output.'),
+        make_option('--compare',
+                    help='Report of an earlier run to compare results with.'),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+                    help='Do not ask before destroying an existing test database.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        verbosity = int(options['verbosity'])
+        old = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                old = json.load(f)
+
+        if 'south' in settings.INSTALLED_APPS:
+            from south.management.commands import patch_for_test_db_setup
+            patch_for_test_db_setup()
+        # never run against the configured database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity, autoclobber=not options['interactive'])
+        try:
+            report = benchmark.run(options['users'], options['repeat'], options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+
+        output = options['output']
+        stream = sys.stdout if output == '-' else open(output, 'w')
+        try:
+            json.dump(report, stream, indent=2, sort_keys=True)
+            stream.write('\n')
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        if old is not None:
+            for name, before, after, ratio in benchmark.compare(old, report):
+                if ratio is None:
+                    change = 'failed'
+                else:
+                    change = '%+.0f%% time' % ((ratio - 1) * 100)
+                self.stderr.write('%s: %s, %s -> %s queries\n' % (
+                    name, change, before.get('queries'), after.get('queries')))
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import expiry, worker
+
+
+class Command(BaseCommand):
+    help = 'Remove users of lapsed subscriptions from subscription groups, ' \
+           'sharing work by user id ranges with other running workers.'
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=1,
+                    help='Number of worker threads (default 1).'),
+        make_option('--processes', type='int', default=0,
+                    help='Number of worker processes; overrides --threads.'),
+        make_option('--lease', type='int', default=300,
+                    help='Seconds after which a shard of a dead worker can be '
+                         'claimed again.'),
+        make_option('--chunk-size', type='int', default=1000,
+                    help='Number of subscriptions processed in one transaction.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        verbosity = int(options['verbosity'])
+
+        def log(shard):
+            rate = shard.usersubscriptions / shard.seconds if shard.seconds else 0
+            self.stdout.write(
+                'users %d-%d: %d subscriptions in %.2f s (%.0f/s), %d unsubscribed, '
+                '%d deleted\n' % (shard.start, shard.end, shard.usersubscriptions,
+                                  shard.seconds, rate, shard.unsubscribed, shard.deleted))
+
+        pool = worker.make_pool(options['threads'], options['processes'])
+        try:
+            shards = expiry.run(pool, batch_size=options['processes'] or options['threads'],
+                                lease=options['lease'], chunk_size=options['chunk_size'],
+                                log=log if verbosity > 1 else None)
+        finally:
+            pool.terminate()
+        if verbosity:
+            self.stdout.write('%d shards, %d subscriptions, %d unsubscribed\n' % (
+                len(shards), sum(shard.usersubscriptions for shard in shards),
+                sum(shard.unsubscribed for shard in shards)))
@@ -0,0 +1,109 @@
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+
+from subscription import export
+from subscription.models import Transaction
+
+
+def _parse_time(value):
+    parsed = parse_datetime(value) or parse_date(value)
+    if parsed is None:
+        raise CommandError('Invalid date or time: %r' % value)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = 'Export Transaction ledger as CSV or newline-delimited JSON, ' \
+           'in (timestamp, id) order.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=sorted(export.WRITERS), default='csv',
+                    help='Output format: csv (default) or json.'),
+        make_option('--output', default='-',
+                    help='Output file; default is standard output.'),
+        make_option('--gzip', action='store_true', default=False,
+                    help='Compress output with gzip; implied by .gz output '
+                         'file name.'),
+        make_option('--since', help='Export transactions from this date or time.'),
+        make_option('--until', help='Export transactions before this date or time.'),
+        make_option('--event', action='append', default=[],
+                    help='Export only transactions with this event; may be '
+                         'repeated.'),
+        make_option('--subscription', action='append', type='int', default=[],
+                    help='Export only transactions of subscription with this '
+                         'id; may be repeated.'),
+        make_option('--checkpoint',
+                    help='File storing position of last exported row.  If it '
+                         'exists, export continues after that row and output '
+                         'file is appended to (after anything written after '
+                         'that row is truncated).'),
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Number of rows read with a single query.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        queryset = Transaction.objects.all()
+        if options['since']:
+            queryset = queryset.filter(timestamp__gte=_parse_time(options['since']))
+        if options['until']:
+            queryset = queryset.filter(timestamp__lt=_parse_time(options['until']))
+        if options['event']:
+            queryset = queryset.filter(event__in=options['event'])
+        if options['subscription']:
+            queryset = queryset.filter(subscription__in=options['subscription'])
+
+        checkpoint = options['checkpoint']
+        after = checkpoint and export.read_checkpoint(checkpoint)
+        if after and options['output'] == '-':
+            raise CommandError('Export to standard output cannot be resumed.')
+        if after and not os.path.exists(options['output']):
+            raise CommandError('Output file %s of checkpoint %s does not exist; restore it, '
+                               'or delete the checkpoint to export all rows again.'
+                               % (options['output'], checkpoint))
+
+        output = options['output']
+        if output == '-':
+            stream = sys.stdout
+        elif after:
+            stream = open(output, 'r+b')
+            # drop rows (or part of gzip member) written after the
+            # checkpoint by an interrupted export
+            stream.seek(0, 2)
+            offset = export.checkpoint_offset(checkpoint)
+            if offset is not None:
+                stream.seek(offset)
+                stream.truncate()
+        else:
+            stream = open(output, 'wb')
+        raw = stream
+        if options['gzip'] or output.endswith('.gz'):
+            # each checkpointed page is a complete gzip member, and a
+            # resumed export adds further members, which readers
+            # decompress as a continuation of the file
+            stream = export.GzipMembers(raw)
+
+        def flush():
+            if stream is raw:
+                stream.flush()
+            else:
+                stream.end_member()
+            raw.flush()
+            if raw is not sys.stdout:
+                return raw.tell()
+
+        try:
+            writer = export.WRITERS[options['format']](stream, header=not after)
+            count = export.export(writer, queryset, after, options['chunk_size'],
+                                  checkpoint, flush)
+        finally:
+            if stream is not raw:
+                stream.close()
+            if raw is not sys.stdout:
+                raw.close()
+        if int(options['verbosity']) > 1:
+            self.stderr.write('%d transactions exported\n' % count)
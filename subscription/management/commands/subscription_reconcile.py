@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import membership
+
+
+class Command(BaseCommand):
+    help = 'Compare subscription group memberships of all users with their ' \
+           'UserSubscriptions and correct differences.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only report differences.'),
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Number of user ids checked at once (default 10000).'),
+        make_option('--remove-unaccounted', action='store_true', default=False,
+                    help='Also remove memberships no subscription gives (e.g. '
+                         'added by hand); by default they are only reported.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        dry_run = options['dry_run']
+        verbosity = int(options['verbosity'])
+
+        def report(difference):
+            if difference.missing:
+                state = 'missing'
+            elif difference.lapsed:
+                state = 'extra (lapsed subscription %s)' % ', '.join(
+                    str(row[2]) for row in difference.lapsed)
+            else:
+                state = 'extra (no subscription)'
+            self.stdout.write('user %s group %s: %s\n' % (
+                difference.user_id, difference.group_id, state))
+
+        remove_unaccounted = options['remove_unaccounted']
+        summary = membership.reconcile(dry_run, options['chunk_size'],
+                                       report=report if verbosity > 1 else None,
+                                       remove_unaccounted=remove_unaccounted)
+        if verbosity > 0:
+            left = 0 if dry_run or remove_unaccounted else summary['unaccounted']
+            self.stdout.write('%d missing and %d extra membership(s) %s\n' % (
+                summary['missing'], summary['extra'] - left,
+                'found' if dry_run else 'corrected'))
+            if left:
+                self.stdout.write('%d membership(s) given by no subscription left alone '
+                                  '(see --remove-unaccounted)\n' % left)
@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import replay, worker
+
+
+class Command(BaseCommand):
+    help = 'Rebuild UserSubscriptions and group memberships of users by ' \
+           'replaying their stored PayPal IPNs.'
+    option_list = BaseCommand.option_list + (
+        make_option('--diff', action='store_true', default=False,
+                    help='Only report differences, change nothing.'),
+        make_option('--threads', type='int', default=1,
+                    help='Number of worker threads (default 1).'),
+        make_option('--processes', type='int', default=0,
+                    help='Number of worker processes; overrides --threads.'),
+        make_option('--batch-size', type='int', default=replay.BATCH_SIZE,
+                    help='Number of users replayed and written at once '
+                         '(default %d).' % replay.BATCH_SIZE),
+        make_option('--chunk-size', type='int', default=10000,
+                    help='Number of IPNs fetched at a time (default 10000).'),
+        make_option('--partition-size', type='int', default=replay.PARTITION_SIZE,
+                    help='Number of IPNs held in memory and replayed by one pool '
+                         '(default %d).' % replay.PARTITION_SIZE),
+        make_option('--delete-unmatched', action='store_true', default=False,
+                    help='Also delete subscriptions of plans none of user\'s '
+                         'IPNs refer to, and group memberships no subscription '
+                         'gives.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        verbosity = int(options['verbosity'])
+
+        def report(difference):
+            self.stdout.write('user %d, subscription %d: %s -> %s\n' % (
+                difference.user_id, difference.subscription_id,
+                difference.stored and tuple(difference.stored),
+                difference.rebuilt and tuple(difference.rebuilt)))
+
+        summary = replay.run(
+            lambda: worker.make_pool(options['threads'], options['processes']),
+            diff_only=options['diff'], chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'], report=report if verbosity > 1 else None,
+            partition_size=options['partition_size'],
+            delete_unmatched=options['delete_unmatched'])
+        if verbosity:
+            self.stdout.write('%(ipns)d IPNs of %(users)d users replayed, '
+                              '%(differences)d subscription(s) differ\n' % summary)
+            if not options['diff']:
+                self.stdout.write(
+                    '%(created)d created, %(updated)d updated, %(deleted)d deleted, '
+                    '%(subscribed)d membership(s) added, %(unsubscribed)d removed\n'
+                    % summary)
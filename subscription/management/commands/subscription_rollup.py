@@ -0,0 +1,42 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import analytics, rollup
+
+
+class Command(BaseCommand):
+    help = 'Verify per-plan subscriber counts and recent daily revenue ' \
+           'against UserSubscriptions and Transaction ledger.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repair', action='store_true', default=False,
+                    help='Correct differing counts and revenue.'),
+        make_option('--days', type='int', default=2,
+                    help='Number of past days of revenue to verify, besides '
+                         'today (default 2).'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        repair = options['repair']
+        verbosity = int(options['verbosity'])
+
+        drift = rollup.reconcile(repair=repair)
+        for subscription_id, stored, counted in drift:
+            self.stdout.write('subscription %s: stored %s, counted %s\n' % (
+                subscription_id, stored, counted))
+
+        since = rollup.today() - datetime.timedelta(options['days'])
+        revenue_drift = rollup.revenue_drift(since)
+        for (day, subscription_id, event), stored, counted in revenue_drift:
+            self.stdout.write('%s subscription %s %s: stored %s, counted %s\n' % (
+                day, subscription_id, event, stored, counted))
+        if revenue_drift and repair:
+            analytics.refresh(since)
+
+        if verbosity > 1 or drift or revenue_drift:
+            self.stdout.write('%d plan(s) and %d revenue row(s) %s\n' % (
+                len(drift), len(revenue_drift),
+                'repaired' if repair else 'differ'))
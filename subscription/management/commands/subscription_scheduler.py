@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import scheduler
+
+
+class Command(BaseCommand):
+    help = 'Remove users from subscription groups as soon as their ' \
+           'subscriptions lapse; runs until interrupted.'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=1000,
+                    help='Number of upcoming deadlines kept in memory (default 1000).'),
+        make_option('--refresh', type='int', default=300,
+                    help='Seconds after which deadlines are loaded again even '
+                         'if no subscription changed (default 300).'),
+        make_option('--poll', type='float', default=1,
+                    help='Seconds between checks for changed subscriptions '
+                         '(default 1).'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        verbosity = int(options['verbosity'])
+
+        def log(summary):
+            self.stdout.write('%(usersubscriptions)d subscriptions due, '
+                              '%(unsubscribed)d unsubscribed, %(deleted)d deleted\n'
+                              % summary)
+
+        try:
+            scheduler.run(limit=options['limit'], refresh=options['refresh'],
+                          poll=options['poll'], log=log if verbosity else None)
+        except KeyboardInterrupt:
+            pass
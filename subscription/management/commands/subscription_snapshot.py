@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Store a snapshot of subscription state of all users, built from ' \
+           'the previous snapshot and transactions recorded since.'
+    option_list = BaseCommand.option_list + (
+        make_option('--lag', type='int', default=snapshots.LAG,
+                    help='Leave out transactions recorded in last LAG seconds '
+                         '(default %d).' % snapshots.LAG),
+        make_option('--keep', type='int', default=0,
+                    help='Delete all but KEEP latest snapshots (default: keep all).'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        verbosity = int(options['verbosity'])
+        last = snapshots._snapshot()
+        snapshot = snapshots.take(options['lag'])
+        if verbosity:
+            if snapshot is None or snapshot == last:
+                self.stdout.write('No new transactions.\n')
+            else:
+                self.stdout.write('Snapshot at transaction %d: %d transactions applied, '
+                                  '%d subscriptions of %d users\n' % (
+                                      snapshot.last_transaction, snapshot.transactions,
+                                      snapshot.rows.count(),
+                                      snapshot.rows.values('user_id').distinct().count()))
+        if options['keep']:
+            deleted = snapshots.prune(options['keep'])
+            if verbosity and deleted:
+                self.stdout.write('%d old snapshots deleted\n' % deleted)
@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription import worker
+
+
+class Command(BaseCommand):
+    help = 'Handle PayPal IPNs queued with SUBSCRIPTION_IPN_QUEUE setting.'
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=1,
+                    help='Number of worker threads (default 1).'),
+        make_option('--processes', type='int', default=0,
+                    help='Number of worker processes; overrides --threads.'),
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of users whose jobs are claimed at once.'),
+        make_option('--lease', type='int', default=300,
+                    help='Seconds after which claimed jobs of a dead worker '
+                         'can be claimed again.'),
+        make_option('--max-attempts', type='int', default=5,
+                    help='Number of attempts before a job is marked as failed.'),
+        make_option('--backoff', type='int', default=60,
+                    help='Seconds before first retry, doubled on each next one.'),
+        make_option('--sleep', type='float', default=5,
+                    help='Seconds to wait when queue is empty.'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit when there are no jobs ready.'),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('Command takes no arguments.')
+        verbosity = int(options['verbosity'])
+        pool = worker.make_pool(options['threads'], options['processes'])
+        try:
+            handled, failed = worker.run(
+                pool,
+                batch_size=options['batch_size'],
+                lease=options['lease'],
+                max_attempts=options['max_attempts'],
+                backoff=options['backoff'],
+                sleep=options['sleep'],
+                once=options['once'],
+                log=verbosity > 1 and (lambda msg: self.stdout.write(msg + '\n')))
+        finally:
+            pool.terminate()
+        if verbosity:
+            self.stdout.write('%d jobs handled, %d failed\n' % (handled, failed))
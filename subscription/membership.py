@@ -0,0 +1,152 @@
+"""Reconciliation of subscription group memberships of all users.
+
+Expected (user, group) pairs are computed from valid UserSubscriptions
+(active and not past grace period) and actual ones are read from
+`User.groups' through table, limited to groups of Subscriptions; both
+are sorted by (user, group) and compared with a merge join.  Users are
+processed in ranges of `chunk_size' ids, with two queries per range
+(plus a few for ranges that need corrections).
+
+Missing memberships are added.  Superfluous memberships given by a
+lapsed UserSubscription are removed the way `fix()' would (recording
+`subscription expired' and deleting cancelled UserSubscriptions).
+Ones no UserSubscription accounts for (e.g. given by hand in the
+admin) are only reported, unless their removal is requested; then
+they are removed with a `remove group membership' Transaction.
+"""
+import collections
+import datetime
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+
+import ledger
+import signals
+from models import Subscription, UserSubscription, _revoke_usersubscriptions, \
+    plan_registry, subscription_cache
+
+# `missing' is true for a membership that should exist, false for one
+# that should not; `lapsed' are rows of lapsed UserSubscriptions giving
+# a superfluous membership, as taken by `_revoke_usersubscriptions()'
+Difference = collections.namedtuple('Difference', (
+    'user_id', 'group_id', 'missing', 'lapsed'))
+
+# rows per query taking lists of ids, within SQLite's limit of variables
+BATCH_SIZE = 500
+
+
+def merge_join(expected, actual):
+    """Yield (item, missing) pairs of items only in sorted iterable
+    `expected' (missing is true) or only in sorted iterable `actual'."""
+    expected, actual = iter(expected), iter(actual)
+    e, a = next(expected, None), next(actual, None)
+    while e is not None or a is not None:
+        if a is None or (e is not None and e < a):
+            yield e, True
+            e = next(expected, None)
+        elif e is None or a < e:
+            yield a, False
+            a = next(actual, None)
+        else:
+            e, a = next(expected, None), next(actual, None)
+
+
+def _differences(users, group_ids, today):
+    """Return sorted list of Differences of users matching `users'
+    lookups."""
+    lapsed_before = today - UserSubscription.grace_timedelta
+    expected, lapsed = set(), {}
+    for pk, user_id, subscription_id, group_id, cancelled, active, expires in \
+            UserSubscription.objects.filter(**users).order_by('pk').values_list(
+                'pk', 'user_id', 'subscription_id', 'subscription__group_id',
+                'cancelled', 'active', 'expires'):
+        if active and (expires is None or expires >= lapsed_before):
+            expected.add((user_id, group_id))
+        else:
+            lapsed.setdefault((user_id, group_id), []).append(
+                (pk, user_id, subscription_id, group_id, cancelled))
+    actual = User.groups.through.objects.filter(group__in=group_ids, **users).order_by(
+        'user', 'group').values_list('user_id', 'group_id')
+    return [Difference(user_id, group_id, missing,
+                       [] if missing else lapsed.get((user_id, group_id), []))
+            for (user_id, group_id), missing in merge_join(sorted(expected), actual)]
+
+
+@ledger.batched
+def _apply(differences, remove_unaccounted=False):
+    membership = User.groups.through
+    counts = dict(subscribed=0, unsubscribed=0, deleted=0, transactions=0)
+    missing = [(d.user_id, d.group_id) for d in differences if d.missing]
+    if missing:
+        membership.objects.bulk_create([
+            membership(user_id=user_id, group_id=group_id)
+            for user_id, group_id in missing])
+        counts['subscribed'] = len(missing)
+
+    lapsed = sorted(row for d in differences if not d.missing for row in d.lapsed)
+    for i in xrange(0, len(lapsed), BATCH_SIZE):
+        for key, value in _revoke_usersubscriptions(lapsed[i:i + BATCH_SIZE]).items():
+            counts[key] += value
+
+    orphans = [(d.user_id, d.group_id) for d in differences
+               if remove_unaccounted and not (d.missing or d.lapsed)]
+    users_by_group = {}
+    for user_id, group_id in orphans:
+        users_by_group.setdefault(group_id, []).append(user_id)
+        plan = plan_registry.for_groups([group_id])
+        ledger.record(user_id=user_id, subscription_id=plan and plan.id, ipn=None,
+                      event='remove group membership', comment='group %d' % group_id)
+    for group_id, user_ids in users_by_group.items():
+        for i in xrange(0, len(user_ids), BATCH_SIZE):
+            membership.objects.filter(group=group_id,
+                                      user__in=user_ids[i:i + BATCH_SIZE]).delete()
+    counts['unsubscribed'] += len(orphans)
+    counts['transactions'] += len(orphans)
+
+    # bulk changes do not send m2m_changed
+    subscription_cache.invalidate_users(set(
+        user_id for user_id, group_id in missing + orphans))
+    return counts
+
+
+def reconcile(dry_run=False, chunk_size=10000, today=None, report=None,
+              remove_unaccounted=False):
+    """Compare group memberships of all users with their
+    UserSubscriptions and, unless `dry_run' is true, correct them.
+    Memberships no UserSubscription accounts for are removed only if
+    `remove_unaccounted' is true.
+
+    Each range of `chunk_size' user ids that needs corrections is
+    checked again and corrected in a single database transaction, with
+    its users' rows locked as IPN handlers do.  `report' is called
+    with each found Difference.  Returns a dictionary with numbers of
+    `missing' and `extra' memberships found (`unaccounted' of the
+    latter) and, unless `dry_run', `subscribed' and `unsubscribed'
+    memberships, `deleted' UserSubscriptions and `transactions'
+    written."""
+    today = today or datetime.date.today()
+    group_ids = set(Subscription.objects.values_list('group_id', flat=True))
+    last = User.objects.aggregate(last=Max('pk'))['last'] or 0
+    summary = dict(missing=0, extra=0, unaccounted=0)
+    if not dry_run:
+        summary.update(subscribed=0, unsubscribed=0, deleted=0, transactions=0)
+
+    for start in xrange(0, last + 1, chunk_size):
+        users = dict(user__gte=start, user__lt=start + chunk_size)
+        differences = _differences(users, group_ids, today)
+        if not dry_run and any(remove_unaccounted or d.missing or d.lapsed
+                               for d in differences):
+            with signals.deferring(), transaction.commit_on_success():
+                list(User.objects.select_for_update().filter(
+                    pk__gte=start, pk__lt=start + chunk_size).values_list('pk'))
+                differences = _differences(users, group_ids, today)
+                for key, value in _apply(differences, remove_unaccounted).items():
+                    summary[key] += value
+        for difference in differences:
+            summary['missing' if difference.missing else 'extra'] += 1
+            if not (difference.missing or difference.lapsed):
+                summary['unaccounted'] += 1
+            if report is not None:
+                report(difference)
+    return summary
@@ -1,31 +1,47 @@
 import datetime
+import functools
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
 from django.contrib import auth
 from django.utils.translation import ugettext as _, ungettext, ugettext_lazy
 
 from paypal.standard import ipn
 
+# make auth.models and ipn.models available when this module is imported
+# before Django loads models, e.g. by management commands
+import django.contrib.auth.models
+import paypal.standard.ipn.models
+
+import caching
+import instrumentation
+import ledger
+import registry
+import rollup
+import scheduler
 import signals
 import utils
 
 
 class Transaction(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+    timestamp = models.DateTimeField(auto_now_add=True, editable=False,
+                                     db_index=True)
     subscription = models.ForeignKey('subscription.Subscription',
                                      null=True, blank=True, editable=False)
     user = models.ForeignKey(auth.models.User,
                              null=True, blank=True, editable=False)
     ipn = models.ForeignKey(ipn.models.PayPalIPN,
                             null=True, blank=True, editable=False)
-    event = models.CharField(max_length=100, editable=False)
+    event = models.CharField(max_length=100, editable=False, db_index=True)
     amount = models.DecimalField(max_digits=64, decimal_places=2,
                                  null=True, blank=True, editable=False)
     comment = models.TextField(blank=True, default='')
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True,
+                                       editable=False, unique=True)
 
     class Meta:
         ordering = ('-timestamp',)
+        index_together = (('subscription', 'timestamp'), )
 
 
 _recurrence_unit_days = {
@@ -125,18 +141,82 @@ class Subscription(models.Model):
         super(Subscription, self).save(*args, **kwargs)
 
 
+subscription_cache = caching.SubscriptionCache(again=signals.after_transaction)
+
+
+def _load_plans():
+    return [registry.PlanRecord(
+                id=s.id, name=s.name, group_id=s.group_id, price=s.price,
+                recurrence_period=s.recurrence_period,
+                recurrence_unit=s.recurrence_unit,
+                trial_period=s.trial_period, trial_unit=s.trial_unit,
+                price_per_day=s.price_per_day())
+            for s in Subscription.objects.defer('description')]
+plan_registry = registry.PlanRegistry(subscription_cache, _load_plans)
+
+
+def _load_user_subscription_id(user_id):
+    plan = plan_registry.for_groups(
+        auth.models.User.groups.through.objects.filter(
+            user=user_id).values_list('group_id', flat=True))
+    if plan is not None:
+        return plan.id
+
+
+def _load_subscription(subscription_id):
+    try:
+        return Subscription.objects.get(id=subscription_id)
+    except Subscription.DoesNotExist:
+        return None
+
+
 # add User.get_subscription() method
 def __user_get_subscription(user):
     if not hasattr(user, '_subscription_cache'):
-        sl = Subscription.objects.filter(group__in=user.groups.all())[:1]
-        if sl:
-            user._subscription_cache = sl[0]
+        groups = getattr(user, '_prefetched_objects_cache', {}).get('groups')
+        if groups is not None:
+            # prefetch_related('groups') was used, no need to ask cache
+            plan = plan_registry.for_groups(group.pk for group in groups)
+            subscription_id = plan and plan.id or caching.NO_SUBSCRIPTION
+        else:
+            subscription_id = subscription_cache.get_subscription_id(
+                user.pk, _load_user_subscription_id)
+        if subscription_id != caching.NO_SUBSCRIPTION:
+            user._subscription_cache = subscription_cache.get_subscription(
+                subscription_id, _load_subscription)
         else:
             user._subscription_cache = None
     return user._subscription_cache
 auth.models.User.add_to_class('get_subscription', __user_get_subscription)
 
 
+def _invalidate_user_subscription(user):
+    if hasattr(user, '_subscription_cache'):
+        del user._subscription_cache
+    subscription_cache.invalidate_user(user.pk)
+
+
+def handle_user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidate cached subscription on User.groups change, which
+    covers UserSubscription.subscribe(), unsubscribe() and fix()."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _invalidate_user_subscription(instance)
+    elif pk_set:
+        subscription_cache.invalidate_users(pk_set)
+    else:
+        subscription_cache.invalidate_all()  # group cleared
+models.signals.m2m_changed.connect(handle_user_groups_changed,
+                                   sender=auth.models.User.groups.through)
+
+
+def handle_subscription_changed(sender, **kwargs):
+    subscription_cache.invalidate_all()
+models.signals.post_save.connect(handle_subscription_changed, sender=Subscription)
+models.signals.post_delete.connect(handle_subscription_changed, sender=Subscription)
+
+
 class ActiveUSManager(models.Manager):
     """Custom Manager for UserSubscription that returns only live US objects."""
     def get_query_set(self):
@@ -146,7 +226,8 @@ class ActiveUSManager(models.Manager):
 class UserSubscription(models.Model):
     user = models.ForeignKey(auth.models.User)
     subscription = models.ForeignKey(Subscription)
-    expires = models.DateField(null=True, default=datetime.date.today)
+    expires = models.DateField(null=True, default=datetime.date.today,
+                               db_index=True)
     active = models.BooleanField(default=True)
     cancelled = models.BooleanField(default=True)
 
@@ -158,12 +239,24 @@ class UserSubscription(models.Model):
 
     class Meta:
         unique_together = (('user', 'subscription'), )
+        index_together = (('active', 'expires'), ('user', 'active'))
 
     def user_is_group_member(self):
         "Returns True is user is member of subscription's group"
-        return self.subscription.group in self.user.groups.all()
+        if hasattr(self, '_user_is_group_member'):
+            # annotated by with_group_membership()
+            return bool(self._user_is_group_member)
+        return auth.models.User.groups.through.objects.filter(
+            user=self.user_id, group=self._group_id()).exists()
     user_is_group_member.boolean = True
 
+    def _group_id(self):
+        plan = plan_registry.get(self.subscription_id)
+        if plan is None:
+            # not loaded yet, e.g. created by other process just now
+            return self.subscription.group_id
+        return plan.group_id
+
     def expired(self):
         """Returns true if there is more than SUBSCRIPTION_GRACE_PERIOD
         days after expiration date."""
@@ -182,32 +275,38 @@ class UserSubscription(models.Model):
             return self.user_is_group_member()
     valid.boolean = True
 
+    @instrumentation.instrumented('usersubscription.unsubscribe')
     def unsubscribe(self):
         """Unsubscribe user."""
-        self.user.groups.remove(self.subscription.group)
+        self.user.groups.remove(self._group_id())
         self.user.save()
+        self.__dict__.pop('_user_is_group_member', None)
 
+    @instrumentation.instrumented('usersubscription.subscribe')
     def subscribe(self):
         """Subscribe user."""
-        self.user.groups.add(self.subscription.group)
+        self.user.groups.add(self._group_id())
         self.user.save()
+        self.__dict__.pop('_user_is_group_member', None)
 
+    @instrumentation.instrumented('usersubscription.fix')
+    @ledger.batched
     def fix(self):
         """Fix group membership if not valid()."""
         if not self.valid():
             if self.expired() or not self.active:
                 self.unsubscribe()
-                Transaction(user=self.user, subscription=self.subscription, ipn=None,
-                            event='subscription expired'
-                            ).save()
+                ledger.record(user=self.user, subscription=self.subscription, ipn=None,
+                              event='subscription expired')
                 if self.cancelled:
+                    rollup.discard(self)
                     self.delete()
-                    Transaction(user=self.user, subscription=self.subscription, ipn=None,
-                                event='remove subscription (expired)'
-                                ).save()
+                    ledger.record(user=self.user, subscription=self.subscription, ipn=None,
+                                  event='remove subscription (expired)')
             else:
                 self.subscribe()
 
+    @instrumentation.instrumented('usersubscription.extend')
     def extend(self, timedelta=None):
         """Extend subscription by `timedelta' or by subscription's
         recurrence period."""
@@ -235,7 +334,7 @@ class UserSubscription(models.Model):
         listeners should return None if change is possible, or a
         reason to display.
         """
-        if self.subscription == subscription:
+        if self.subscription_id == subscription.id:
             if self.active and self.cancelled:
                 return None  # allow resubscribing
             return [_(u'This is your current subscription.')]
@@ -256,204 +355,655 @@ class UserSubscription(models.Model):
         return rv
 
 
-def unsubscribe_expired():
+def with_group_membership(queryset):
+    """Annotate UserSubscription query set, so that objects'
+    `user_is_group_member()' (and `valid()') need no extra queries."""
+    membership = auth.models.User.groups.through._meta.db_table
+    return queryset.extra(select={'_user_is_group_member': """EXISTS (
+        SELECT 1 FROM %(membership)s WHERE
+            %(membership)s.user_id = %(us)s.user_id AND
+            %(membership)s.group_id = (SELECT group_id FROM %(subscription)s
+                                       WHERE %(subscription)s.id = %(us)s.subscription_id))""" % dict(
+        membership=membership,
+        us=UserSubscription._meta.db_table,
+        subscription=Subscription._meta.db_table)})
+
+
+def _lapsed_usersubscriptions(today=None):
+    """Return UserSubscription query set of objects that should not
+    give group membership anymore: expired ones, and inactive ones
+    with `expires' field in the past."""
+    if today is None:
+        today = datetime.date.today()
+    return UserSubscription.objects.filter(
+        models.Q(expires__lt=today - UserSubscription.grace_timedelta)
+        | models.Q(active=False, expires__lt=today))
+
+
+@instrumentation.instrumented('unsubscribe_expired.chunk')
+@ledger.batched
+def _revoke_usersubscriptions(rows):
+    """Remove lapsed UserSubscriptions' users from subscription groups.
+
+    `rows' is a sequence of (pk, user_id, subscription_id, group_id,
+    cancelled) tuples, ordered by pk.  This is a set-based equivalent
+    of calling `fix()' on each of corresponding UserSubscription
+    objects: group memberships are removed with a single delete on
+    `User.groups' through table, audit Transactions are recorded in
+    a TransactionWriter (inserted with a single `bulk_create()', unless
+    they join a buffered writer of the caller) and cancelled UserSubscriptions are
+    deleted with a single delete.  Returns a dictionary with counts of
+    `unsubscribed' memberships, `deleted' UserSubscriptions and
+    `transactions' written."""
+    membership = auth.models.User.groups.through
+    members = set(membership.objects.filter(
+        user__in=set(row[1] for row in rows),
+        group__in=set(row[3] for row in rows),
+        ).values_list('user_id', 'group_id'))
+
+    revoked, deleted, transactions = set(), [], 0
+    for pk, user_id, subscription_id, group_id, cancelled in rows:
+        if (user_id, group_id) not in members or (user_id, group_id) in revoked:
+            continue  # valid(), fix() would leave it alone
+        revoked.add((user_id, group_id))
+        ledger.record(user_id=user_id, subscription_id=subscription_id, ipn=None,
+                      event='subscription expired')
+        transactions += 1
+        if cancelled:
+            deleted.append(pk)
+            ledger.record(user_id=user_id, subscription_id=subscription_id, ipn=None,
+                          event='remove subscription (expired)')
+            transactions += 1
+
+    if revoked:
+        users_by_group = {}
+        for user_id, group_id in revoked:
+            users_by_group.setdefault(group_id, []).append(user_id)
+        q = models.Q(pk__in=[])
+        for group_id, user_ids in users_by_group.items():
+            q |= models.Q(group=group_id, user__in=user_ids)
+        membership.objects.filter(q).delete()
+        # bulk delete does not send m2m_changed
+        subscription_cache.invalidate_users(
+            set(user_id for user_id, group_id in revoked))
+    if deleted:
+        queryset = UserSubscription.objects.filter(pk__in=deleted)
+        rollup.discard_all(queryset)
+        queryset.delete()
+
+    return dict(unsubscribed=len(revoked), deleted=len(deleted),
+                transactions=transactions)
+
+
+@instrumentation.instrumented('unsubscribe_expired')
+def unsubscribe_expired(chunk_size=1000):
     """Unsubscribes all users whose subscription has expired.
-    Loops through all UserSubscription objects with `expires' field
-    earlier than datetime.date.today() and forces correct group
-    membership."""
-    for us in UserSubscription.objects.get(expires__lt=datetime.date.today()):
-        us.fix()
 
+    Works through lapsed UserSubscription objects (expired, or
+    inactive with `expires' earlier than datetime.date.today()) in
+    chunks of `chunk_size' rows, ordered by primary key, and forces
+    correct group membership for each chunk in a single database
+    transaction.  Returns a dictionary with number of processed
+    `chunks', examined `usersubscriptions', `unsubscribed' group
+    memberships, `deleted' UserSubscription objects and audit
+    `transactions' written."""
+    lapsed = _lapsed_usersubscriptions().order_by('pk').values_list(
+        'pk', 'user_id', 'subscription_id', 'subscription__group_id', 'cancelled')
+    summary = dict(chunks=0, usersubscriptions=0,
+                   unsubscribed=0, deleted=0, transactions=0)
+    last_pk = 0
+    while True:
+        rows = list(lapsed.filter(pk__gt=last_pk)[:chunk_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+        with signals.deferring(), transaction.commit_on_success():
+            counts = _revoke_usersubscriptions(rows)
+        summary['chunks'] += 1
+        summary['usersubscriptions'] += len(rows)
+        for key, value in counts.items():
+            summary[key] += value
+    return summary
+
+
+@instrumentation.instrumented('fix_usersubscriptions')
+def fix_usersubscriptions(queryset, chunk_size=1000):
+    """Fix group membership of all UserSubscriptions in `queryset'.
+
+    Set-based equivalent of calling `fix()' on each object, working in
+    chunks of `chunk_size' rows.  Missing memberships are inserted
+    with a single `bulk_create()' per chunk, superfluous ones are
+    removed like in `unsubscribe_expired()'.  Does not manage
+    transactions.  Returns a dictionary with counts of `subscribed'
+    and `unsubscribed' group memberships, `deleted' UserSubscription
+    objects and audit `transactions' written."""
+    membership = auth.models.User.groups.through
+    lapsed_before = datetime.date.today() - UserSubscription.grace_timedelta
+    rows_qs = queryset.order_by('pk').values_list(
+        'pk', 'user_id', 'subscription_id', 'subscription__group_id', 'cancelled',
+        'active', 'expires')
+    summary = dict(subscribed=0, unsubscribed=0, deleted=0, transactions=0)
+    last_pk = 0
+    while True:
+        rows = list(rows_qs.filter(pk__gt=last_pk)[:chunk_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+
+        granted, revoked = set(), []
+        for pk, user_id, subscription_id, group_id, cancelled, active, expires in rows:
+            if active and (expires is None or expires >= lapsed_before):
+                granted.add((user_id, group_id))
+            else:
+                revoked.append((pk, user_id, subscription_id, group_id, cancelled))
+
+        missing = granted - set(membership.objects.filter(
+            user__in=set(user_id for user_id, group_id in granted),
+            group__in=set(group_id for user_id, group_id in granted),
+            ).values_list('user_id', 'group_id'))
+        if missing:
+            membership.objects.bulk_create([
+                membership(user_id=user_id, group_id=group_id)
+                for user_id, group_id in missing])
+            # bulk_create does not send m2m_changed
+            subscription_cache.invalidate_users(
+                set(user_id for user_id, group_id in missing))
+        summary['subscribed'] += len(missing)
+
+        # user keeps a group given by any valid subscription
+        revoked = [row for row in revoked if (row[1], row[3]) not in granted]
+        if revoked:
+            for key, value in _revoke_usersubscriptions(revoked).items():
+                summary[key] += value
+    return summary
+
+
+# rows changed by one UPDATE ... CASE query, within SQLite's limit of
+# variables (3 per row)
+_EXTEND_BATCH_SIZE = 300
+
+
+@instrumentation.instrumented('extend_usersubscriptions')
+def extend_usersubscriptions(queryset):
+    """Extend all UserSubscriptions in `queryset' by their
+    subscriptions' recurrence periods, like `extend()' followed by
+    `save()' would.
+
+    New dates are computed with `utils.extend_dates_by()' for each
+    distinct (recurrence period, recurrence unit) pair and written
+    with a single UPDATE ... SET expires = CASE id ... END query per
+    pair (and per _EXTEND_BATCH_SIZE rows), so the number of queries
+    does not depend on the number of distinct expiry dates.  Does not
+    manage transactions.  Returns number of updated rows."""
+    one_time = (models.Q(subscription__recurrence_unit__isnull=True)
+                | models.Q(subscription__recurrence_unit=''))
+    updated = queryset.filter(one_time).exclude(expires=None).update(expires=None)
+    groups = {}
+    for pk, period, unit, expires in queryset.exclude(one_time).exclude(
+            expires=None).order_by().values_list(
+            'pk', 'subscription__recurrence_period', 'subscription__recurrence_unit',
+            'expires'):
+        pks, dates = groups.setdefault((period, unit), ([], []))
+        pks.append(pk)
+        dates.append(expires)
+
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for (period, unit), (pks, dates) in sorted(groups.items()):
+        extended = utils.extend_dates_by(dates, period, unit)
+        for i in xrange(0, len(pks), _EXTEND_BATCH_SIZE):
+            batch = pks[i:i + _EXTEND_BATCH_SIZE]
+            params = []
+            for pk, expires in zip(batch, extended[i:i + _EXTEND_BATCH_SIZE]):
+                params.extend((pk, connection.ops.value_to_db_date(expires)))
+            cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                qn(UserSubscription._meta.db_table), qn('expires'), qn('id'),
+                ' '.join(['WHEN %s THEN %s'] * len(batch)), qn('id'),
+                ', '.join(['%s'] * len(batch))), params + batch)
+            updated += cursor.rowcount
+    return updated
 
-#### Handle PayPal signals
-def _ipn_usersubscription(payment):
-    class PseudoUS(object):
-        pk = None
 
-        def __nonzero__(self):
-            return False
+#### Handle PayPal signals
+class _PseudoUS(object):
+    """Stands in for UserSubscription when IPN does not match any
+    user and subscription."""
+    pk = None
+
+    def __nonzero__(self):
+        return False
+
+    def __init__(self, user, subscription):
+        self.user = user
+        self.subscription = subscription
+
+
+def _ipn_idempotency_key(payment):
+    """Return key identifying event notified by `payment' IPN.
+
+    Key is the same for every PayPal retry of a notification, so it
+    can be used to detect already processed notifications.  Returns
+    None if event cannot be identified."""
+    if payment.txn_id:
+        ident = payment.txn_id
+    elif payment.subscr_id:
+        ident = payment.subscr_id
+        if payment.subscr_effective:
+            ident += ':%s' % payment.subscr_effective.isoformat()
+    else:
+        return None
+    return '%s:%s' % (payment.txn_type, ident)
 
-        def __init__(self, user, subscription):
-            self.user = user
-            self.subscription = subscription
 
+def _idempotent(handler):
+    """Decorator treating IPN as already processed if recording its
+    idempotency key fails because a concurrent handler of the same
+    notification committed it after the check in
+    `_ipn_usersubscription()'."""
+    @functools.wraps(handler)
+    def wrapper(sender, **kwargs):
+        try:
+            return handler(sender, **kwargs)
+        except IntegrityError:
+            key = _ipn_idempotency_key(sender)
+            if key is None or not Transaction.objects.filter(idempotency_key=key).exists():
+                raise
+    return wrapper
+
+
+@instrumentation.instrumented('ipn.lookup')
+def _ipn_usersubscription(payment, key=None):
+    """Find or create UserSubscription for `payment' IPN.
+
+    Must be called inside a transaction.  User's row and all of user's
+    UserSubscription rows are locked with SELECT ... FOR UPDATE, so
+    notifications for one user are processed one at a time.  Returns
+    (usersubscription, other_usersubscriptions) pair; usersubscription
+    is a false value if IPN does not match a user and a subscription,
+    and is None if IPN with idempotency key `key' was already
+    processed."""
     try:
         s = Subscription.objects.get(id=payment.item_number)
-    except Subscription.DoesNotExist:
+    except (Subscription.DoesNotExist, ValueError):
         s = None
 
     try:
-        u = auth.models.User.objects.get(id=payment.custom)
-    except auth.models.User.DoesNotExist:
+        u = auth.models.User.objects.select_for_update().get(id=payment.custom)
+    except (auth.models.User.DoesNotExist, ValueError):
         u = None
 
-    if u and s:
-        try:
-            us = UserSubscription.objects.get(subscription=s, user=u)
-        except UserSubscription.DoesNotExist:
-            us = UserSubscription(user=u, subscription=s, active=False)
-            Transaction(user=u, subscription=s, ipn=payment,
-                        event='new usersubscription', amount=payment.mc_gross
-                        ).save()
-    else:
-        us = PseudoUS(user=u, subscription=s)
+    if key is not None and Transaction.objects.filter(idempotency_key=key).exists():
+        return None, []
 
-    return us
+    if not (u and s):
+        return _PseudoUS(user=u, subscription=s), []
 
+    us, others = None, []
+    for row in UserSubscription.objects.select_for_update().filter(user=u):
+        row.user = u
+        if row.subscription_id == s.id:
+            row.subscription = s
+            us = row
+        else:
+            others.append(row)
 
+    if us is None:
+        us = UserSubscription(user=u, subscription=s, active=False)
+        ledger.record(user=u, subscription=s, ipn=payment,
+                      event='new usersubscription', amount=payment.mc_gross,
+                      idempotency_key=key)
+
+    return us, others
+
+
+@instrumentation.instrumented('ipn.remove_others')
+def _ipn_remove_others(payment, us, others, key, delete_all=False):
+    """Delete cancelled (or, if `delete_all' is true, all) UserSubscriptions
+    from `others' and deactivate the remaining ones, removing user from
+    their groups."""
+    u, s = us.user, us.subscription
+    removed = [old_us for old_us in others if delete_all or old_us.cancelled]
+    deactivated = [old_us for old_us in others if old_us not in removed]
+    for old_us in others:
+        rollup.discard(old_us)
+
+    if removed:
+        UserSubscription.objects.filter(pk__in=[old_us.pk for old_us in removed]).delete()
+        for old_us in removed:
+            ledger.record(user=u, subscription=s, ipn=payment,
+                          event='remove subscription (deactivated)', amount=payment.mc_gross,
+                          idempotency_key=key)
+
+    if deactivated:
+        UserSubscription.objects.filter(pk__in=[old_us.pk for old_us in deactivated]
+                                        ).update(active=False)
+        u.groups.remove(*Subscription.objects.filter(
+            pk__in=set(old_us.subscription_id for old_us in deactivated)
+            ).values_list('group', flat=True))
+        for old_us in deactivated:
+            ledger.record(user=u, subscription=s, ipn=payment,
+                          event='deactivated', amount=payment.mc_gross,
+                          idempotency_key=key)
+
+
+@_idempotent
+@signals.deferring
+@instrumentation.instrumented('ipn.payment_was_successful')
+@transaction.commit_on_success
+@ledger.batched
 def handle_payment_was_successful(sender, **kwargs):
-    us = _ipn_usersubscription(sender)
+    key = _ipn_idempotency_key(sender)
+    us, others = _ipn_usersubscription(sender, key)
+    if us is None:
+        return                  # already processed
     u, s = us.user, us.subscription
     if us:
         if not s.recurrence_unit:
             if sender.mc_gross == s.price:
+                before = rollup.flags(us.active, us.cancelled)
                 us.subscribe()
                 us.expires = None
                 us.active = True
                 us.save()
-                Transaction(user=u, subscription=s, ipn=sender,
-                            event='one-time payment', amount=sender.mc_gross
-                            ).save()
+                rollup.change(s.id, before, rollup.flags(True, us.cancelled))
+                ledger.record(user=u, subscription=s, ipn=sender,
+                              event='one-time payment', amount=sender.mc_gross,
+                              idempotency_key=key)
                 signals.signed_up.send(s, ipn=sender, subscription=s, user=u,
                                        usersubscription=us)
             else:
-                Transaction(user=u, subscription=s, ipn=sender,
-                            event='incorrect payment', amount=sender.mc_gross
-                            ).save()
+                ledger.record(user=u, subscription=s, ipn=sender,
+                              event='incorrect payment', amount=sender.mc_gross,
+                              idempotency_key=key)
                 signals.event.send(s, ipn=sender, subscription=s, user=u,
                                    usersubscription=us, event='incorrect payment')
         else:
             if sender.mc_gross == s.price:
+                if us.active and rollup.in_trial(us):
+                    # first payment ends trial
+                    rollup.change(s.id, rollup.flags(True, us.cancelled, True),
+                                  rollup.flags(True, us.cancelled))
                 us.extend()
                 us.save()
-                Transaction(user=u, subscription=s, ipn=sender,
-                            event='subscription payment', amount=sender.mc_gross
-                            ).save()
+                ledger.record(user=u, subscription=s, ipn=sender,
+                              event='subscription payment', amount=sender.mc_gross,
+                              idempotency_key=key)
                 signals.paid.send(s, ipn=sender, subscription=s, user=u,
                                   usersubscription=us)
             else:
-                Transaction(user=u, subscription=s, ipn=sender,
-                            event='incorrect payment', amount=sender.mc_gross
-                            ).save()
+                ledger.record(user=u, subscription=s, ipn=sender,
+                              event='incorrect payment', amount=sender.mc_gross,
+                              idempotency_key=key)
                 signals.event.send(s, ipn=sender, subscription=s, user=u,
                                    usersubscription=us, event='incorrect payment')
     else:
-        Transaction(user=u, subscription=s, ipn=sender,
-                    event='unexpected payment', amount=sender.mc_gross
-                    ).save()
+        ledger.record(user=u, subscription=s, ipn=sender,
+                      event='unexpected payment', amount=sender.mc_gross,
+                      idempotency_key=key)
         signals.event.send(s, ipn=sender, subscription=s, user=u, event='unexpected_payment')
-ipn.signals.payment_was_successful.connect(handle_payment_was_successful)
 
 
+@_idempotent
+@signals.deferring
+@instrumentation.instrumented('ipn.payment_was_flagged')
+@transaction.commit_on_success
+@ledger.batched
 def handle_payment_was_flagged(sender, **kwargs):
-    us = _ipn_usersubscription(sender)
+    us, others = _ipn_usersubscription(sender)
     u, s = us.user, us.subscription
-    Transaction(user=u, subscription=s, ipn=sender,
-                event='payment flagged', amount=sender.mc_gross
-                ).save()
+    ledger.record(user=u, subscription=s, ipn=sender,
+                  event='payment flagged', amount=sender.mc_gross)
     signals.event.send(s, ipn=sender, subscription=s, user=u, event='flagged')
-ipn.signals.payment_was_flagged.connect(handle_payment_was_flagged)
 
 
+@_idempotent
+@signals.deferring
+@instrumentation.instrumented('ipn.subscription_signup')
+@transaction.commit_on_success
+@ledger.batched
 def handle_subscription_signup(sender, **kwargs):
-    us = _ipn_usersubscription(sender)
+    key = _ipn_idempotency_key(sender)
+    us, others = _ipn_usersubscription(sender, key)
+    if us is None:
+        return                  # already processed
     u, s = us.user, us.subscription
     if us:
         # deactivate or delete all user's other subscriptions
-        for old_us in u.usersubscription_set.all():
-            if old_us == us:
-                continue     # don't touch current subscription
-            if old_us.cancelled:
-                old_us.delete()
-                Transaction(user=u, subscription=s, ipn=sender,
-                            event='remove subscription (deactivated)', amount=sender.mc_gross
-                            ).save()
-            else:
-                old_us.active = False
-                old_us.unsubscribe()
-                old_us.save()
-                Transaction(user=u, subscription=s, ipn=sender,
-                            event='deactivated', amount=sender.mc_gross
-                            ).save()
+        _ipn_remove_others(sender, us, others, key)
 
         # activate new subscription
+        trial = rollup.in_trial(us)
+        before = rollup.flags(us.active, us.cancelled, trial)
         us.subscribe()
         us.active = True
         us.cancelled = False
         us.save()
-        Transaction(user=u, subscription=s, ipn=sender,
-                    event='activated', amount=sender.mc_gross
-                    ).save()
+        rollup.change(s.id, before, rollup.flags(True, False, trial))
+        ledger.record(user=u, subscription=s, ipn=sender,
+                      event='activated', amount=sender.mc_gross,
+                      idempotency_key=key)
 
         signals.subscribed.send(s, ipn=sender, subscription=s, user=u,
                                 usersubscription=us)
     else:
-        Transaction(user=u, subscription=s, ipn=sender,
-                    event='unexpected subscription', amount=sender.mc_gross
-                    ).save()
+        ledger.record(user=u, subscription=s, ipn=sender,
+                      event='unexpected subscription', amount=sender.mc_gross,
+                      idempotency_key=key)
         signals.event.send(s, ipn=sender, subscription=s, user=u,
                            event='unexpected_subscription')
-ipn.signals.subscription_signup.connect(handle_subscription_signup)
 
 
+@_idempotent
+@signals.deferring
+@instrumentation.instrumented('ipn.subscription_cancel')
+@transaction.commit_on_success
+@ledger.batched
 def handle_subscription_cancel(sender, **kwargs):
-    us = _ipn_usersubscription(sender)
+    key = _ipn_idempotency_key(sender)
+    us, others = _ipn_usersubscription(sender, key)
+    if us is None:
+        return                  # already processed
     u, s = us.user, us.subscription
     if us.pk is not None:
         if not us.active:
             us.unsubscribe()
             us.delete()
-            Transaction(user=u, subscription=s, ipn=sender,
-                        event='remove subscription (cancelled)', amount=sender.mc_gross
-                        ).save()
+            ledger.record(user=u, subscription=s, ipn=sender,
+                          event='remove subscription (cancelled)', amount=sender.mc_gross,
+                          idempotency_key=key)
         else:
+            before = rollup.flags(True, us.cancelled)
             us.cancelled = True
             us.save()
-            Transaction(user=u, subscription=s, ipn=sender,
-                        event='cancel subscription', amount=sender.mc_gross
-                        ).save()
+            rollup.change(s.id, before, rollup.flags(True, True))
+            ledger.record(user=u, subscription=s, ipn=sender,
+                          event='cancel subscription', amount=sender.mc_gross,
+                          idempotency_key=key)
         signals.unsubscribed.send(s, ipn=sender, subscription=s, user=u,
                                   usersubscription=us,
 #                                  refund=refund, reason='cancel')
                                   reason='cancel')
     else:
-        Transaction(user=u, subscription=s, ipn=sender,
-                    event='unexpected cancel', amount=sender.mc_gross
-                    ).save()
+        ledger.record(user=u, subscription=s, ipn=sender,
+                      event='unexpected cancel', amount=sender.mc_gross,
+                      idempotency_key=key)
         signals.event.send(s, ipn=sender, subscription=s, user=u, event='unexpected_cancel')
-ipn.signals.subscription_cancel.connect(handle_subscription_cancel)
-ipn.signals.subscription_eot.connect(handle_subscription_cancel)
 
 
+@_idempotent
+@signals.deferring
+@instrumentation.instrumented('ipn.subscription_modify')
+@transaction.commit_on_success
+@ledger.batched
 def handle_subscription_modify(sender, **kwargs):
-    us = _ipn_usersubscription(sender)
+    key = _ipn_idempotency_key(sender)
+    us, others = _ipn_usersubscription(sender, key)
+    if us is None:
+        return                  # already processed
     u, s = us.user, us.subscription
-    print 'modify', u, s
     if us:
         # delete all user's other subscriptions
-        for old_us in u.usersubscription_set.all():
-            if old_us == us:
-                continue     # don't touch current subscription
-            old_us.delete()
-            Transaction(user=u, subscription=s, ipn=sender,
-                        event='remove subscription (deactivated)', amount=sender.mc_gross
-                        ).save()
+        _ipn_remove_others(sender, us, others, key, delete_all=True)
 
         # activate new subscription
+        trial = rollup.in_trial(us)
+        before = rollup.flags(us.active, us.cancelled, trial)
         us.subscribe()
         us.active = True
         us.cancelled = False
         us.save()
-        Transaction(user=u, subscription=s, ipn=sender,
-                    event='activated', amount=sender.mc_gross
-                    ).save()
+        rollup.change(s.id, before, rollup.flags(True, False, trial))
+        ledger.record(user=u, subscription=s, ipn=sender,
+                      event='activated', amount=sender.mc_gross,
+                      idempotency_key=key)
 
         signals.subscribed.send(s, ipn=sender, subscription=s, user=u,
                                 usersubscription=us)
     else:
-        Transaction(user=u, subscription=u, ipn=sender,
-                    event='unexpected subscription modify', amount=sender.mc_gross
-                    ).save()
+        ledger.record(user=u, subscription=s, ipn=sender,
+                      event='unexpected subscription modify', amount=sender.mc_gross,
+                      idempotency_key=key)
         signals.event.send(s, ipn=sender, subscription=s, user=u,
                            event='unexpected_subscription_modify')
-ipn.signals.subscription_modify.connect(handle_subscription_modify)
+
+
+# django-paypal signal name -> handler
+IPN_HANDLERS = {
+    'payment_was_successful': handle_payment_was_successful,
+    'payment_was_flagged': handle_payment_was_flagged,
+    'subscription_signup': handle_subscription_signup,
+    'subscription_cancel': handle_subscription_cancel,
+    'subscription_eot': handle_subscription_cancel,
+    'subscription_modify': handle_subscription_modify,
+    }
+
+
+class IPNJob(models.Model):
+    """PayPal IPN waiting to be handled by `subscription_worker'
+    management command (used if SUBSCRIPTION_IPN_QUEUE is set).
+
+    Jobs of a single user (IPN's `custom' field) are handled in order
+    of their ids."""
+    ipn = models.ForeignKey(ipn.models.PayPalIPN, editable=False)
+    signal = models.CharField(max_length=32, editable=False)
+    user_key = models.CharField(max_length=255, editable=False, db_index=True)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    run_after = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True, default='', db_index=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return u'%s #%s' % (self.signal, self.ipn_id)
+
+
+class RevenueSummary(models.Model):
+    """Number and total amount of Transactions of one day (UTC if
+    USE_TZ is set), subscription and event; maintained by
+    `subscription.analytics.refresh()'."""
+    day = models.DateField(editable=False)
+    subscription = models.ForeignKey(Subscription, null=True, blank=True, editable=False)
+    event = models.CharField(max_length=100, editable=False)
+    count = models.PositiveIntegerField(default=0, editable=False)
+    amount = models.DecimalField(max_digits=64, decimal_places=2, default=0,
+                                 editable=False)
+
+    class Meta:
+        ordering = ('day', )
+        unique_together = (('day', 'subscription', 'event'), )
+
+    def __unicode__(self):
+        return u'%s %s: %s' % (self.day, self.event, self.count)
+
+
+class PlanStats(models.Model):
+    """Numbers of `active' UserSubscriptions of `subscription', of
+    active ones that are `cancelled' and of active ones in `trial';
+    maintained by `subscription.rollup'."""
+    subscription = models.OneToOneField(Subscription, primary_key=True, editable=False,
+                                        related_name='stats')
+    active = models.IntegerField(default=0, editable=False)
+    cancelled = models.IntegerField(default=0, editable=False)
+    trial = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        verbose_name_plural = 'plan stats'
+
+    def __unicode__(self):
+        return u'%s: %d active' % (self.subscription_id, self.active)
+
+
+class ExpiryShard(models.Model):
+    """Range of user ids (`start' inclusive, `end' exclusive) whose
+    lapsed UserSubscriptions are processed on `day' by one worker of
+    `subscription_expire' command at a time (see
+    `subscription.expiry').  Progress is kept in `last_pk' and counts,
+    so work of a crashed worker is continued by another one."""
+    day = models.DateField(editable=False)
+    start = models.PositiveIntegerField(editable=False)
+    end = models.PositiveIntegerField(editable=False)
+    worker = models.CharField(max_length=100, blank=True, default='')
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_pk = models.PositiveIntegerField(default=0)
+    done = models.BooleanField(default=False)
+    usersubscriptions = models.PositiveIntegerField(default=0)
+    unsubscribed = models.PositiveIntegerField(default=0)
+    deleted = models.PositiveIntegerField(default=0)
+    transactions = models.PositiveIntegerField(default=0)
+    seconds = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ('day', 'start')
+        unique_together = (('day', 'start'), )
+
+    def __unicode__(self):
+        return u'%s users %d-%d' % (self.day, self.start, self.end)
+
+
+class StateSnapshot(models.Model):
+    """Subscription state of all users after Transactions up to
+    `last_transaction' (see `subscription.snapshots').  `until' is the
+    latest timestamp of these Transactions."""
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    last_transaction = models.PositiveIntegerField(editable=False, db_index=True)
+    until = models.DateTimeField(editable=False, db_index=True)
+    transactions = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        ordering = ('-last_transaction', )
+
+    def __unicode__(self):
+        return u'snapshot at transaction %d' % self.last_transaction
+
+
+class SnapshotRow(models.Model):
+    """State of a user's UserSubscription in a StateSnapshot, as
+    `subscription.snapshots' flags."""
+    snapshot = models.ForeignKey(StateSnapshot, related_name='rows')
+    user_id = models.PositiveIntegerField()
+    subscription_id = models.PositiveIntegerField()
+    flags = models.PositiveSmallIntegerField()
+
+    class Meta:
+        unique_together = (('snapshot', 'user_id', 'subscription_id'), )
+
+
+def enqueue_ipn(sender, signal, **kwargs):
+    """Store IPN `sender' as IPNJob for `subscription_worker' command."""
+    IPNJob(ipn=sender, signal=_ipn_signal_names[signal],
+           user_key=sender.custom).save()
+
+_ipn_signal_names = dict((getattr(ipn.signals, name), name) for name in IPN_HANDLERS)
+
+if getattr(settings, 'SUBSCRIPTION_IPN_QUEUE', False):
+    for _name in IPN_HANDLERS:
+        getattr(ipn.signals, _name).connect(enqueue_ipn)
+else:
+    for _name, _handler in IPN_HANDLERS.items():
+        getattr(ipn.signals, _name).connect(_handler)
@@ -0,0 +1,85 @@
+"""In-process registry of subscription plans.
+
+Registry keeps a compact record of every Subscription, loaded at once
+on first use and reloaded when plans version of the subscription cache
+(bumped on every Subscription save or delete, and again after its
+transaction) changes, or after SUBSCRIPTION_PLAN_REGISTRY_TTL seconds
+(default 300) at the latest.  It maps subscription ids and group ids
+to plans without database queries.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+
+class PlanRecord(object):
+    """Read-only summary of a Subscription."""
+    __slots__ = ('id', 'name', 'group_id', 'price', 'recurrence_period',
+                 'recurrence_unit', 'trial_period', 'trial_unit',
+                 'price_per_day')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return '<PlanRecord %s: %s>' % (self.id, self.name)
+
+
+class PlanRegistry(object):
+    """Plans of plans version `cache.version()', loaded by calling
+    `load()', which returns PlanRecord objects in Subscription's
+    default order, and kept for at most `ttl' seconds."""
+
+    def __init__(self, cache, load, ttl=None):
+        self.cache = cache
+        self.load = load
+        if ttl is None:
+            ttl = getattr(settings, 'SUBSCRIPTION_PLAN_REGISTRY_TTL', 300)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _current(self):
+        version = self.cache.version()
+        state = self._state
+        if state[0] != version or state[5] <= time.time():
+            with self._lock:
+                state = self._state
+                if state[0] != version or state[5] <= time.time():
+                    plans = tuple(self.load())
+                    by_id, by_group = {}, {}
+                    for plan in reversed(plans):  # first plan of group wins
+                        by_id[plan.id] = plan
+                        by_group[plan.group_id] = plan
+                    position = dict((plan.id, i) for i, plan in enumerate(plans))
+                    state = self._state = (version, plans, by_id, by_group, position,
+                                           time.time() + self.ttl)
+        return state
+
+    def reload(self):
+        """Drop loaded plans; they are loaded again on next lookup."""
+        self._state = (None, (), {}, {}, {}, 0)
+
+    def plans(self):
+        """Return tuple of all plans, in Subscription's default order."""
+        return self._current()[1]
+
+    def get(self, subscription_id):
+        """Return plan with id `subscription_id' or None."""
+        return self._current()[2].get(subscription_id)
+
+    def for_group(self, group_id):
+        """Return plan of group `group_id' or None; if several plans
+        share the group, first one in Subscription's order is returned."""
+        return self._current()[3].get(group_id)
+
+    def for_groups(self, group_ids):
+        """Return first plan (in Subscription's order) of any of groups
+        `group_ids', or None."""
+        version, plans, by_id, by_group, position, expires = self._current()
+        found = [by_group[group_id] for group_id in group_ids if group_id in by_group]
+        if not found:
+            return None
+        return min(found, key=lambda plan: position[plan.id])
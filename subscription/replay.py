@@ -0,0 +1,414 @@
+"""Rebuilding of UserSubscriptions from stored PayPal IPNs.
+
+PayPalIPN rows are read once, ordered by their `custom' field (user
+id) and id, in partitions holding all IPNs of some users (a query for
+each), so memory use is bounded by partition size rather than by the
+number of IPNs.
+Users of each partition are then replayed in batches, in a thread or
+process pool: each user's IPNs are passed, in order, to an
+in-memory model of the IPN handlers, which keeps user's
+UserSubscriptions as (active, cancelled, expires) states and skips
+notifications whose idempotency key was already seen.  Between
+notifications the model expires subscriptions the way a daily
+`unsubscribe_expired()' would, taking the day on which each IPN was
+received (in current time zone) as today.
+
+Rebuilt states are compared with stored UserSubscriptions of plans
+that user's IPNs refer to; other UserSubscriptions (e.g. added in the
+admin) are left alone, unless they are to be deleted as unmatched.
+Unless only differences are requested, each batch is corrected in a single
+database transaction: rows are created, updated and deleted in bulk
+(each change recorded with a `rebuild subscription (...)' Transaction,
+see `rebuild_event()') and
+group memberships of the batch's users are reconciled as by
+`subscription.membership.reconcile()' (removing unaccounted ones only
+along with unmatched UserSubscriptions).  PlanStats are repaired at
+the end.  Users without IPNs are left alone.
+"""
+import collections
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.datastructures import SortedDict
+from django.utils.dateparse import parse_date, parse_datetime
+from paypal.standard.ipn.models import PayPalIPN
+
+import ledger
+import membership
+import rollup
+import signals
+import utils
+from models import Subscription, UserSubscription, _ipn_idempotency_key, plan_registry
+
+IPN = collections.namedtuple('IPN', (
+    'pk', 'custom', 'txn_type', 'txn_id', 'subscr_id', 'subscr_effective',
+    'item_number', 'mc_gross', 'flag', 'payment_status', 'recurring_payment_id', 'day'))
+
+# PayPalIPN fields of IPN tuple, except `created_at' (for `day') and
+# `mc_gross'
+FIELDS = ('pk', 'custom', 'txn_type', 'txn_id', 'subscr_id', 'subscr_effective',
+          'item_number', 'flag', 'payment_status', 'recurring_payment_id')
+
+# UserSubscription state
+State = collections.namedtuple('State', ('active', 'cancelled', 'expires'))
+
+# `stored' or `rebuilt' is None if the UserSubscription does not exist
+Difference = collections.namedtuple('Difference', (
+    'user_id', 'subscription_id', 'stored', 'rebuilt'))
+
+# rows per query taking lists of ids, within SQLite's limit of variables
+BATCH_SIZE = 500
+
+# IPNs read by one query and replayed by one pool
+PARTITION_SIZE = 100000
+
+_SUBSCRIPTION_SIGNALS = {
+    'subscr_cancel': 'subscription_cancel',
+    'subscr_signup': 'subscription_signup',
+    'subscr_eot': 'subscription_eot',
+    'subscr_modify': 'subscription_modify',
+    }
+
+
+def signal_name(ipn):
+    """Return name of django-paypal signal sent for `ipn' (as
+    `PayPalIPN.send_signals()' chooses it) or None if it is not one
+    handled by IPN_HANDLERS."""
+    if ipn.txn_id:
+        if ipn.flag:
+            return 'payment_was_flagged'
+        if ipn.payment_status in ('Refunded', 'Reversed'):
+            return None
+        return 'payment_was_successful'
+    if ipn.recurring_payment_id:
+        return None
+    return _SUBSCRIPTION_SIGNALS.get(ipn.txn_type)
+
+
+def _expire(states, day):
+    # unsubscribe_expired() deletes cancelled subscriptions that still
+    # give group membership: active ones
+    lapsed_before = day - UserSubscription.grace_timedelta
+    for subscription_id, state in states.items():
+        if state.active and state.cancelled and state.expires is not None \
+                and state.expires < lapsed_before:
+            del states[subscription_id]
+
+
+def _plans():
+    return dict((str(plan.id), plan) for plan in plan_registry.plans())
+
+
+def _plan(plans, item_number):
+    plan = plans.get(item_number)
+    if plan is None:
+        try:
+            plan = plans.get(str(int(item_number)))
+        except ValueError:
+            pass
+    return plan
+
+
+def replay(ipns, today=None, plans=None):
+    """Return dictionary mapping subscription ids to States of
+    UserSubscriptions of a user after handling `ipns' (IPN tuples of
+    that user, in order) as of `today' (default: today).  `plans' maps
+    Subscription ids as strings to PlanRecords (default: all plans)."""
+    if plans is None:
+        plans = _plans()
+    states, seen = {}, set()
+    for ipn in ipns:
+        name = signal_name(ipn)
+        if name is None or name == 'payment_was_flagged':
+            continue            # no changes
+        _expire(states, ipn.day)
+        key = _ipn_idempotency_key(ipn)
+        if key is not None:
+            if key in seen:
+                continue        # already processed
+            seen.add(key)
+        plan = _plan(plans, ipn.item_number)
+        if plan is None:
+            continue
+        state = states.get(plan.id)
+        if name == 'payment_was_successful':
+            if ipn.mc_gross != plan.price:
+                continue        # incorrect payment
+            if state is None:
+                state = State(False, True, ipn.day)
+            if not plan.recurrence_unit:
+                states[plan.id] = state._replace(active=True, expires=None)
+            elif state.expires is not None:
+                states[plan.id] = state._replace(expires=utils.extend_date_by(
+                    state.expires, plan.recurrence_period, plan.recurrence_unit))
+        elif name in ('subscription_signup', 'subscription_modify'):
+            if state is None:
+                state = State(False, True, ipn.day)
+            for subscription_id, other in states.items():
+                if subscription_id == plan.id:
+                    continue
+                if name == 'subscription_modify' or other.cancelled:
+                    del states[subscription_id]
+                else:
+                    states[subscription_id] = other._replace(active=False)
+            states[plan.id] = state._replace(active=True, cancelled=False)
+        elif state is not None:
+            # subscription_cancel, subscription_eot
+            if not state.active:
+                del states[plan.id]
+            else:
+                states[plan.id] = state._replace(cancelled=True)
+    _expire(states, today or datetime.date.today())
+    return states
+
+
+def _values(queryset, connection):
+    if connection.vendor != 'sqlite':
+        return queryset.values_list('created_at', 'mc_gross', *FIELDS)
+    # timestamps and amounts read through an expression, as in export,
+    # skip their conversion, which would take most of the time; each
+    # distinct day and amount is then converted once
+    qn = connection.ops.quote_name
+    table = qn(PayPalIPN._meta.db_table)
+    return queryset.extra(select=SortedDict([
+        ('created_at_text', '+%s.%s' % (table, qn('created_at'))),
+        ('mc_gross_text', '+%s.%s' % (table, qn('mc_gross')))])
+        ).values_list('created_at_text', 'mc_gross_text', *FIELDS)
+
+
+def _day(created_at):
+    if isinstance(created_at, basestring):
+        # text read from SQLite, which stores UTC if USE_TZ is set
+        created_at = parse_datetime(created_at)
+        if settings.USE_TZ:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+    if timezone.is_aware(created_at):
+        created_at = timezone.localtime(created_at)
+    return created_at.date()
+
+
+def _fetch(queryset, connection, chunk_size):
+    # plain cursor, as in export.pages()
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    rows = []
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            return rows
+        rows.extend(chunk)
+
+
+def stream(chunk_size=10000, partition_size=PARTITION_SIZE):
+    """Yield dictionaries mapping user ids to lists of their IPN tuples,
+    in order.  Each holds all IPNs of its users, at most
+    `partition_size' of them (more if a single user has more).
+    PayPalIPNs are read ordered by `custom' and id, with a query for
+    each partition, fetching `chunk_size' rows at a time."""
+    queryset = PayPalIPN.objects.order_by('custom', 'pk')
+    connection = connections[queryset.db]
+    queryset = _values(queryset, connection)
+    last, days, amounts = None, {}, {}
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(Q(custom__gt=last[0]) | Q(custom=last[0], pk__gt=last[1]))
+        rows = _fetch(page[:partition_size], connection, chunk_size)
+        if not rows:
+            return
+        if len(rows) == partition_size:
+            # IPNs of the last user may continue after the limit; they
+            # are left to the next partition, or read now if that user
+            # fills the whole partition
+            custom, end = rows[-1][3], len(rows)
+            while end and rows[end - 1][3] == custom:
+                end -= 1
+            if end:
+                del rows[end:]
+            else:
+                rows.extend(_fetch(queryset.filter(custom=custom, pk__gt=rows[-1][2]),
+                                   connection, chunk_size))
+        last = rows[-1][3], rows[-1][2]
+        by_user = {}
+        for row in rows:
+            created_at, amount, custom = row[0], row[1], row[3]
+            try:
+                user_id = int(custom)
+            except ValueError:
+                continue        # not one of our IPNs
+            if str(user_id) != custom:
+                # written by the views as user id; other spellings
+                # would be grouped apart from it
+                continue
+            if isinstance(created_at, basestring) and not settings.USE_TZ:
+                # text in local time; only the date is needed
+                day = days.get(created_at[:10]) or days.setdefault(
+                    created_at[:10], parse_date(created_at[:10]))
+            else:
+                day = _day(created_at)
+            if amount is not None and not isinstance(amount, Decimal):
+                if amount not in amounts:
+                    amounts[amount] = Decimal(str(amount))
+                amount = amounts[amount]
+            ipn = IPN._make(row[2:9] + (amount, ) + row[9:] + (day, ))
+            by_user.setdefault(user_id, []).append(ipn)
+        if by_user:
+            yield by_user
+
+
+def _mentioned(ipns, plans):
+    """Return set of ids of Subscriptions `ipns' handled by IPN_HANDLERS
+    refer to."""
+    mentioned = set()
+    for ipn in ipns:
+        if signal_name(ipn) is not None:
+            plan = _plan(plans, ipn.item_number)
+            if plan is not None:
+                mentioned.add(plan.id)
+    return mentioned
+
+
+def _differences(rebuilt, user_ids, mentioned=None):
+    # stored rows not in `mentioned' (user id, subscription id) pairs
+    # are left out, unless it is None
+    stored = dict(((user_id, subscription_id), (pk, State(active, cancelled, expires)))
+                  for pk, user_id, subscription_id, active, cancelled, expires in
+                  UserSubscription.objects.filter(user__in=user_ids).values_list(
+                      'pk', 'user', 'subscription', 'active', 'cancelled', 'expires'))
+    if mentioned is not None:
+        stored = dict(item for item in stored.items() if item[0] in mentioned)
+    differences, pks = [], {}
+    for key in sorted(set(stored) | set(rebuilt)):
+        pk, old = stored.get(key, (None, None))
+        new = rebuilt.get(key)
+        if old != new:
+            differences.append(Difference(key[0], key[1], old, new))
+            pks[key] = pk
+    return differences, pks
+
+
+def rebuild_event(state):
+    """Return event of Transaction recording that a UserSubscription
+    was rebuilt as State `state' (or deleted if it is None), e.g.
+    'rebuild subscription (active, cancelled)'."""
+    if state is None:
+        return 'rebuild subscription (removed)'
+    return 'rebuild subscription (%s%s)' % (
+        'active' if state.active else 'inactive', ', cancelled' if state.cancelled else '')
+
+
+@ledger.batched
+def _write(differences, pks):
+    created, updates, deleted = [], {}, []
+    for d in differences:
+        pk = pks[d.user_id, d.subscription_id]
+        if d.rebuilt is None:
+            deleted.append(pk)
+        elif pk is None:
+            created.append(UserSubscription(user_id=d.user_id, subscription_id=d.subscription_id,
+                                            **d.rebuilt._asdict()))
+        else:
+            updates.setdefault(d.rebuilt, []).append(pk)
+        ledger.record(user_id=d.user_id, subscription_id=d.subscription_id, ipn=None,
+                      event=rebuild_event(d.rebuilt), comment='%s -> %s' % (
+                          d.stored and tuple(d.stored), d.rebuilt and tuple(d.rebuilt)))
+    if created:
+        UserSubscription.objects.bulk_create(created)
+    for state, ids in updates.items():
+        UserSubscription.objects.filter(pk__in=ids).update(**state._asdict())
+    if deleted:
+        UserSubscription.objects.filter(pk__in=deleted).delete()
+    return dict(created=len(created), updated=sum(map(len, updates.values())),
+                deleted=len(deleted), transactions=len(differences))
+
+
+def rebuild(ipns_by_user, diff_only=False, today=None, delete_unmatched=False):
+    """Replay IPNs of a batch of at most BATCH_SIZE users
+    (`ipns_by_user' maps user ids to lists of IPN tuples) and, unless
+    `diff_only', correct their UserSubscriptions and group memberships.
+    UserSubscriptions of plans their IPNs do not refer to, and group
+    memberships no UserSubscription gives, are left alone, or deleted
+    if `delete_unmatched' is true.  Returns (summary dictionary, list
+    of Differences) pair."""
+    today = today or datetime.date.today()
+    plans = _plans()
+    user_ids = list(User.objects.filter(pk__in=list(ipns_by_user)).values_list('pk', flat=True))
+    rebuilt, mentioned = {}, None if delete_unmatched else set()
+    for user_id in user_ids:
+        for subscription_id, state in replay(ipns_by_user[user_id], today, plans).items():
+            rebuilt[user_id, subscription_id] = state
+        if mentioned is not None:
+            mentioned.update((user_id, subscription_id) for subscription_id in
+                             _mentioned(ipns_by_user[user_id], plans))
+    differences, pks = _differences(rebuilt, user_ids, mentioned)
+    summary = dict(users=len(user_ids), ipns=sum(len(ipns_by_user[u]) for u in user_ids),
+                   differences=len(differences))
+    if diff_only:
+        return summary, differences
+    with signals.deferring(), transaction.commit_on_success():
+        list(User.objects.select_for_update().filter(pk__in=user_ids).values_list('pk'))
+        differences, pks = _differences(rebuilt, user_ids, mentioned)
+        summary.update(_write(differences, pks))
+        group_ids = set(Subscription.objects.values_list('group_id', flat=True))
+        for key, value in membership._apply(membership._differences(
+                dict(user__in=user_ids), group_ids, today), delete_unmatched).items():
+            summary[key] = summary.get(key, 0) + value
+    return summary, differences
+
+
+# IPNs of a partition read by `run()', shared with its pool's threads
+# or forked processes, so that they need not be pickled for each batch
+_streamed = {}
+
+
+def _rebuild(args):
+    user_ids, kwargs = args
+    return rebuild(dict((user_id, _streamed[user_id]) for user_id in user_ids), **kwargs)
+
+
+def run(make_pool, diff_only=False, chunk_size=10000, batch_size=BATCH_SIZE, today=None,
+        report=None, partition_size=PARTITION_SIZE, delete_unmatched=False):
+    """Rebuild UserSubscriptions of all users with IPNs (see module
+    documentation), `partition_size' IPNs at a time, each partition in
+    pool returned by `make_pool()' (e.g. `worker.make_pool()'), called
+    after its IPNs are read.  Users are replayed `batch_size' (at most
+    BATCH_SIZE) at a time; `report' is called with each found
+    Difference.  See `rebuild()' for `delete_unmatched'.  Returns
+    summary dictionary with numbers of replayed `ipns' and `users' and
+    of `differences' found, and, unless `diff_only', of `created',
+    `updated' and `deleted' UserSubscriptions, `subscribed' and
+    `unsubscribed' memberships and `transactions' written."""
+    batch_size = min(batch_size, BATCH_SIZE)
+    kwargs = dict(diff_only=diff_only, today=today, delete_unmatched=delete_unmatched)
+    summary = dict(ipns=0, users=0, differences=0)
+    if not diff_only:
+        summary.update(created=0, updated=0, deleted=0, subscribed=0, unsubscribed=0,
+                       transactions=0)
+    for partition in stream(chunk_size, partition_size):
+        _streamed.update(partition)
+        try:
+            user_ids = sorted(_streamed)
+            batches = [(user_ids[i:i + batch_size], kwargs)
+                       for i in xrange(0, len(user_ids), batch_size)]
+            pool = make_pool()
+            try:
+                for batch_summary, differences in pool.imap_unordered(_rebuild, batches):
+                    for key, value in batch_summary.items():
+                        summary[key] += value
+                    if report is not None:
+                        for difference in differences:
+                            report(difference)
+            finally:
+                if hasattr(pool, 'terminate'):
+                    pool.terminate()
+        finally:
+            _streamed.clear()
+    if not diff_only:
+        rollup.reconcile(repair=True)
+    return summary
@@ -0,0 +1,248 @@
+"""Per-plan subscriber counts and per-day revenue, kept up to date as
+subscriptions change.
+
+PlanStats rows hold numbers of active UserSubscriptions of each plan,
+of active ones that are cancelled and of active ones still in trial
+(of a plan with trial period, not paid for yet).  Code changing
+UserSubscriptions reports each change with `change()' or `discard()';
+changes reported inside a TransactionWriter are summed and applied
+together with writing its Transactions, so in the same database
+transaction as the state changes.  Payments written by the ledger are
+added to RevenueSummary rows of their day at the same time, with rows
+of their Subscriptions locked, so that they do not interleave with
+`subscription.analytics.refresh()' rewriting these rows.
+
+PlanStats are not updated by other changes of UserSubscriptions (e.g.
+in admin) or of Subscriptions' trial periods; `reconcile()' (and
+`subscription_rollup' management command) finds and repairs such
+drift.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+import ledger
+
+REVENUE_EVENTS = ('one-time payment', 'subscription payment')
+PAYMENT_EVENT = 'subscription payment'
+COUNTERS = ('active', 'cancelled', 'trial')
+ZERO = (0, 0, 0)
+
+
+def has_trial(subscription_id):
+    """Return true if recurring Subscription `subscription_id' has a
+    trial period."""
+    from models import plan_registry
+    plan = plan_registry.get(subscription_id)
+    return bool(plan and plan.recurrence_unit and plan.trial_period
+                and plan.trial_unit not in (None, '', '0'))
+
+
+def in_trial(usersubscription):
+    """Return true if `usersubscription' is of a plan with trial period
+    and it has not been paid for yet."""
+    from models import Transaction
+    return has_trial(usersubscription.subscription_id) and \
+        not Transaction.objects.filter(user=usersubscription.user_id,
+                                       subscription=usersubscription.subscription_id,
+                                       event=PAYMENT_EVENT).exists()
+
+
+def flags(active, cancelled=False, trial=False):
+    """Return counters of a single UserSubscription in given state."""
+    return (int(bool(active)), int(bool(active and cancelled)),
+            int(bool(active and trial)))
+
+
+def change(subscription_id, before, after):
+    """Report change of a UserSubscription of `subscription_id' from
+    counters `before' to `after' (as returned by `flags()').  Outside
+    of a TransactionWriter, PlanStats is updated at once, so this must
+    be called after the change."""
+    deltas = tuple(new - old for old, new in zip(before, after))
+    if not any(deltas):
+        return
+    writer = ledger.current()
+    if writer is None:
+        apply({subscription_id: deltas})
+    else:
+        old = writer.plan_deltas.get(subscription_id, ZERO)
+        writer.plan_deltas[subscription_id] = tuple(map(sum, zip(old, deltas)))
+
+
+def discard(usersubscription):
+    """Report that `usersubscription' is going to be deactivated or
+    deleted."""
+    if usersubscription.active:
+        change(usersubscription.subscription_id,
+               flags(True, usersubscription.cancelled, in_trial(usersubscription)),
+               ZERO)
+
+
+def discard_all(queryset):
+    """Report that all UserSubscriptions in `queryset' are going to be
+    deactivated or deleted."""
+    for subscription_id, counters in counts(queryset).items():
+        change(subscription_id, counters, ZERO)
+
+
+def counts(queryset=None):
+    """Return dictionary mapping subscription ids to (active, cancelled,
+    trial) counters of UserSubscriptions in `queryset' (default: all),
+    computed with a single GROUP BY query."""
+    from models import Transaction, UserSubscription
+    if queryset is None:
+        queryset = UserSubscription.objects.all()
+    qn = connections[queryset.db].ops.quote_name
+    us_table = qn(UserSubscription._meta.db_table)
+    unpaid = ('CASE WHEN EXISTS (SELECT 1 FROM %(t)s WHERE %(t)s.%(user)s = %(us)s.%(user)s '
+              'AND %(t)s.%(subscription)s = %(us)s.%(subscription)s AND %(t)s.%(event)s = %%s) '
+              'THEN 0 ELSE 1 END' % dict(
+                  t=qn(Transaction._meta.db_table), us=us_table, user=qn('user_id'),
+                  subscription=qn('subscription_id'), event=qn('event')))
+    rows = queryset.filter(active=True).order_by().extra(
+        select={'unpaid': unpaid}, select_params=(PAYMENT_EVENT, )).values(
+        'subscription', 'cancelled', 'unpaid').annotate(number=Count('id'))
+    result = {}
+    for row in rows:
+        subscription_id = row['subscription']
+        active, cancelled, trial = result.get(subscription_id, ZERO)
+        number = row['number']
+        result[subscription_id] = (
+            active + number, cancelled + (number if row['cancelled'] else 0),
+            trial + (number if row['unpaid'] and has_trial(subscription_id) else 0))
+    return result
+
+
+def _create(model, using, update, **values):
+    # another transaction may create the row first; then it is updated
+    sid = transaction.savepoint(using)
+    try:
+        model.objects.using(using).create(**values)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid, using)
+        update()
+    else:
+        transaction.savepoint_commit(sid, using)
+
+
+def _day(timestamp):
+    if timezone.is_aware(timestamp):
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.date()
+
+
+def apply(plan_deltas, transactions=(), using=None):
+    """Add (active, cancelled, trial) counter changes in `plan_deltas'
+    dictionary to PlanStats, and amounts of payments in `transactions'
+    to RevenueSummary."""
+    from models import PlanStats, RevenueSummary, Subscription, UserSubscription
+    using = using or router.db_for_write(PlanStats)
+    for subscription_id, deltas in sorted(plan_deltas.items()):
+        update = lambda: PlanStats.objects.using(using).filter(
+            subscription=subscription_id).update(**dict(
+                (name, F(name) + delta) for name, delta in zip(COUNTERS, deltas)))
+        if not update():
+            # first change of plan: counted, including this change
+            counters = counts(UserSubscription.objects.using(using).filter(
+                subscription=subscription_id)).get(subscription_id, ZERO)
+            _create(PlanStats, using, update, subscription_id=subscription_id,
+                    **dict(zip(COUNTERS, counters)))
+
+    revenue = {}
+    for t in transactions:
+        if t.event in REVENUE_EVENTS:
+            key = (_day(t.timestamp), t.subscription_id, t.event)
+            number, amount = revenue.get(key, (0, 0))
+            revenue[key] = (number + 1, amount + (t.amount or 0))
+    if revenue:
+        # analytics.refresh() locks all of them
+        list(Subscription.objects.using(using).select_for_update().filter(
+            pk__in=set(key[1] for key in revenue)).order_by('pk').values_list('pk'))
+    for (day, subscription_id, event), (number, amount) in sorted(revenue.items()):
+        update = lambda: RevenueSummary.objects.using(using).filter(
+            day=day, subscription=subscription_id, event=event).update(
+            count=F('count') + number, amount=F('amount') + amount)
+        if not update():
+            _create(RevenueSummary, using, update, day=day, subscription_id=subscription_id,
+                    event=event, count=number, amount=amount)
+
+
+def plan_stats(subscription_id):
+    """Return PlanStats of Subscription `subscription_id', counting its
+    UserSubscriptions if there is none yet."""
+    from models import PlanStats
+    try:
+        return PlanStats.objects.get(subscription=subscription_id)
+    except PlanStats.DoesNotExist:
+        apply({subscription_id: ZERO})
+        return PlanStats.objects.get(subscription=subscription_id)
+
+
+def today():
+    """Return current day of RevenueSummary (UTC if USE_TZ is set)."""
+    if settings.USE_TZ:
+        return timezone.now().date()    # UTC
+    return datetime.date.today()
+
+
+def revenue_today(subscription=None):
+    """Return amount of payments received today."""
+    from models import RevenueSummary
+    summaries = RevenueSummary.objects.filter(day=today(), event__in=REVENUE_EVENTS)
+    if subscription is not None:
+        summaries = summaries.filter(subscription=subscription)
+    return summaries.aggregate(amount=Sum('amount'))['amount'] or 0
+
+
+def reconcile(repair=False):
+    """Compare PlanStats with counted UserSubscriptions and return list
+    of (subscription id, stored counters or None, counted counters) of
+    plans that differ.  If `repair' is true, set PlanStats to counted
+    values.  PlanStats rows are locked while counting, so changes
+    committed meanwhile are not lost."""
+    from models import PlanStats, Subscription
+    using = router.db_for_write(PlanStats)
+    drift = []
+    with transaction.commit_on_success(using=using):
+        stored = dict(
+            (row[0], tuple(row[1:])) for row in
+            PlanStats.objects.using(using).select_for_update().values_list(
+                'subscription', *COUNTERS))
+        counted = counts()
+        for subscription_id in Subscription.objects.using(using).values_list('pk', flat=True):
+            actual = counted.get(subscription_id, ZERO)
+            if stored.get(subscription_id) != actual:
+                drift.append((subscription_id, stored.get(subscription_id), actual))
+        if repair:
+            for subscription_id, old, actual in drift:
+                values = dict(zip(COUNTERS, actual))
+                if old is None:
+                    PlanStats.objects.using(using).create(
+                        subscription_id=subscription_id, **values)
+                else:
+                    PlanStats.objects.using(using).filter(
+                        subscription=subscription_id).update(**values)
+    return drift
+
+
+def revenue_drift(since):
+    """Compare RevenueSummary payment rows from date `since' on with
+    the ledger; return list of ((day, subscription id, event), stored
+    (count, amount) or None, counted (count, amount) or None)."""
+    from analytics import ledger_summary, _to_date
+    from models import RevenueSummary
+    stored = dict(((day, subscription_id, event), (count, amount))
+                  for day, subscription_id, event, count, amount in
+                  RevenueSummary.objects.filter(
+                      day__gte=since, event__in=REVENUE_EVENTS).values_list(
+                      'day', 'subscription', 'event', 'count', 'amount'))
+    counted = dict(((_to_date(row['day']), row['subscription'], row['event']),
+                    (row['number'], row['total'] or 0))
+                   for row in ledger_summary(since, REVENUE_EVENTS))
+    return [(key, stored.get(key), counted.get(key))
+            for key in sorted(set(stored) | set(counted))
+            if stored.get(key) != counted.get(key)]
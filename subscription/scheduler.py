@@ -0,0 +1,181 @@
+"""Expiry of UserSubscriptions at their deadlines, without full scans.
+
+A UserSubscription lapses at midnight of the day after its `expires'
+date plus SUBSCRIPTION_GRACE_PERIOD days (or, if it is inactive, of
+the day after `expires').  `Scheduler' keeps a heap of deadlines of
+the `limit' UserSubscriptions to lapse next, read through the
+(active, expires) index, and at each deadline removes their users
+from subscription groups the way `fix()' would, after checking again
+that they did lapse.  The heap is complete up to its `horizon'; when
+the horizon is reached, the next deadlines are loaded.
+
+IPN handlers extending, cancelling or replacing a subscription call
+`notify()' after their transaction is committed; it bumps a version
+number in the SUBSCRIPTION_CACHE_BACKEND cache, and a running
+scheduler reloads its heap when it sees a new version.  Without a
+shared cache the heap is only reloaded every `refresh' seconds.
+"""
+import datetime
+import heapq
+import time
+
+from django.db import transaction
+
+import caching
+import signals
+
+_VERSION_KEY = 'subscription:scheduler'
+
+# rows per query taking lists of ids, within SQLite's limit of variables
+BATCH_SIZE = 500
+
+
+def _cache():
+    from models import subscription_cache
+    return subscription_cache.shared
+
+
+def version():
+    """Return version number bumped by `notify()', or None."""
+    cache = _cache()
+    return cache.get(_VERSION_KEY) if cache else None
+
+
+def notify(**kwargs):
+    """Tell running schedulers that deadlines may have changed."""
+    cache = _cache()
+    if not cache:
+        return
+    try:
+        cache.incr(_VERSION_KEY)
+    except ValueError:
+        cache.add(_VERSION_KEY, 1, caching._VERSION_TIMEOUT)
+
+
+def _notify(sender, **kwargs):
+    notify()
+
+for _signal in (signals.signed_up, signals.subscribed, signals.unsubscribed, signals.paid):
+    _signal.connect(_notify, deferred=True)
+
+
+def _grace(active):
+    from models import UserSubscription
+    return UserSubscription.grace_timedelta if active else datetime.timedelta(0)
+
+
+def deadline(expires, active):
+    """Return datetime at which UserSubscription with `expires' date
+    and `active' flag lapses."""
+    return datetime.datetime.combine(expires + _grace(active) + datetime.timedelta(1),
+                                     datetime.time())
+
+
+class Scheduler(object):
+    """Heap of deadlines of at most about `limit' UserSubscriptions
+    lapsing after `checked' (default: now)."""
+
+    def __init__(self, limit=1000, checked=None):
+        self.limit = limit
+        self.checked = checked or datetime.datetime.now()
+        self.heap = []
+        self.horizon = None
+        self.loaded = None
+
+    def _upcoming(self):
+        """Yield (active, query set) pairs of UserSubscriptions with
+        deadline after `checked'."""
+        from models import UserSubscription
+        day = self.checked.date()
+        for active in (True, False):
+            yield active, UserSubscription.objects.filter(
+                active=active, expires__gte=day - _grace(active))
+
+    def load(self):
+        """Replace the heap with deadlines after `checked', up to the
+        earliest deadline of `limit'-th active or inactive
+        UserSubscription to lapse."""
+        horizon = None
+        for active, upcoming in self._upcoming():
+            nth = list(upcoming.order_by('expires').values_list(
+                'expires', flat=True)[self.limit - 1:self.limit])
+            if nth and (horizon is None or deadline(nth[0], active) < horizon):
+                horizon = deadline(nth[0], active)
+        self.heap = []
+        for active, upcoming in self._upcoming():
+            if horizon is not None:
+                upcoming = upcoming.filter(expires__lt=horizon.date() - _grace(active))
+            self.heap.extend((deadline(expires, active), pk)
+                             for pk, expires in upcoming.values_list('pk', 'expires'))
+        heapq.heapify(self.heap)
+        self.horizon = horizon
+        self.loaded = time.time()
+
+    def next_deadline(self):
+        """Return datetime of next deadline or of the horizon, if it
+        comes first; None if no UserSubscription lapses."""
+        deadlines = [d for d in (self.heap and self.heap[0][0], self.horizon) if d]
+        return min(deadlines) if deadlines else None
+
+    def stale(self):
+        """Return true if the heap needs to be loaded again."""
+        return self.loaded is None or (
+            self.horizon is not None and self.checked >= self.horizon)
+
+    def fire(self, now=None):
+        """Remove users of UserSubscriptions whose deadline passed by
+        `now' (default: now) from subscription groups.  Returns a
+        dictionary with numbers of `usersubscriptions' due,
+        `unsubscribed' memberships, `deleted' UserSubscriptions and
+        `transactions' written."""
+        from models import _lapsed_usersubscriptions, _revoke_usersubscriptions
+        now = now or datetime.datetime.now()
+        if self.horizon is not None:
+            now = min(now, self.horizon)
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[1])
+        self.checked = max(self.checked, now)
+        summary = dict(usersubscriptions=len(due), unsubscribed=0, deleted=0,
+                       transactions=0)
+        # rows may have changed since they were loaded
+        lapsed = _lapsed_usersubscriptions(now.date()).order_by('pk').values_list(
+            'pk', 'user_id', 'subscription_id', 'subscription__group_id', 'cancelled')
+        due.sort()
+        for i in xrange(0, len(due), BATCH_SIZE):
+            rows = list(lapsed.filter(pk__in=due[i:i + BATCH_SIZE]))
+            if rows:
+                with signals.deferring(), transaction.commit_on_success():
+                    for key, value in _revoke_usersubscriptions(rows).items():
+                        summary[key] += value
+        return summary
+
+
+def run(limit=1000, refresh=300, poll=1.0, log=None):
+    """Handle already lapsed UserSubscriptions with
+    `unsubscribe_expired()', then handle each one at its deadline until
+    interrupted.  Version set by `notify()' is checked every `poll'
+    seconds; the heap of `limit' deadlines is also reloaded every
+    `refresh' seconds.  `log' is called with each `fire()' summary
+    with due UserSubscriptions."""
+    from models import unsubscribe_expired
+    started = datetime.datetime.now()
+    summary = unsubscribe_expired()
+    if log and summary['usersubscriptions']:
+        log(summary)
+    scheduler = Scheduler(limit, started)
+    loaded_version = None
+    while True:
+        summary = scheduler.fire()
+        if log and summary['usersubscriptions']:
+            log(summary)
+        current = version()
+        if current != loaded_version or scheduler.stale() or \
+                time.time() - scheduler.loaded >= refresh:
+            loaded_version = current
+            scheduler.load()
+        wake = scheduler.next_deadline()
+        timeout = poll
+        if wake is not None:
+            timeout = min(timeout, max(0, (wake - datetime.datetime.now()).total_seconds()))
+        time.sleep(timeout)
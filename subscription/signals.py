@@ -1,17 +1,247 @@
-from django.dispatch import Signal
+"""Signals sent on subscription events.
+
+Each receiver call is timed; `slowest()' returns receivers that took
+most time, and receivers taking longer than
+SUBSCRIPTION_SLOW_RECEIVER seconds (if set) are logged.  When
+`subscription.instrumentation' has sinks, each receiver call is also
+reported as `signal.<signal>.<receiver>' operation.
+
+Receivers marked with `deferred' (or connected with `deferred=True')
+are not called by `send()' inside a function decorated with
+`deferring' (e.g. IPN handlers, outside of their database
+transaction); they are queued and called after the function returns,
+so after its transaction is committed, and dropped if it raises.
+Outside of such function they are called at once.  If
+SUBSCRIPTION_SIGNAL_THREADS is set, deferred receivers are called in a
+pool of that many threads instead.  Return values of deferred
+receivers are not returned by `send()', so `change_check' receivers
+cannot be deferred.  `deferring()' called without a function returns
+a context manager doing the same for its block.
+
+Functions passed to `after_transaction()' inside such function or
+block are called when it is left, whether or not it raises, before
+deferred receivers; the subscription cache uses it to invalidate
+entries again once a change is committed (or rolled back).
+"""
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django import dispatch
+from django.conf import settings
+from django.db import connections
+from django.dispatch.dispatcher import _make_id
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+ReceiverStats = collections.namedtuple('ReceiverStats', (
+    'signal', 'receiver', 'calls', 'seconds', 'max_seconds'))
+
+_local = threading.local()
+_lock = threading.Lock()
+_stats = {}
+_pool = None
+
+
+def _receiver_name(receiver):
+    name = getattr(receiver, '__name__', type(receiver).__name__)
+    return '%s.%s' % (getattr(receiver, '__module__', None), name)
+
+
+def _mark_deferred(receiver):
+    # bound methods share attributes of their function
+    getattr(receiver, 'im_func', receiver).subscription_deferred = True
+
+
+def deferred(receiver):
+    """Mark `receiver' to be called after commit (see module
+    documentation); returns `receiver', so it can be used as decorator."""
+    _mark_deferred(receiver)
+    return receiver
+
+
+class Signal(dispatch.Signal):
+    """Signal timing its receivers and deferring ones marked with
+    `deferred'."""
+
+    def __init__(self, providing_args=None, name=None, deferrable=True):
+        super(Signal, self).__init__(providing_args)
+        self.name = name
+        self.deferrable = deferrable
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None, deferred=False):
+        if deferred:
+            _mark_deferred(receiver)
+        if not self.deferrable and getattr(receiver, 'subscription_deferred', False):
+            raise ValueError('Receivers of %s signal cannot be deferred.' % self.name)
+        super(Signal, self).connect(receiver, sender, weak, dispatch_uid)
+
+    def send(self, sender, **named):
+        responses = []
+        if not self.receivers:
+            return responses
+        started = time.time()
+        try:
+            for receiver in self._live_receivers(_make_id(sender)):
+                if self.deferrable and getattr(receiver, 'subscription_deferred', False):
+                    _defer(self, receiver, sender, named)
+                else:
+                    responses.append((receiver, self._call(receiver, sender, named)))
+        finally:
+            if instrumentation.sinks:
+                instrumentation.add_listener_time(time.time() - started)
+        return responses
+
+    def _call(self, receiver, sender, named):
+        name = _receiver_name(receiver)
+        started = time.time()
+        try:
+            if instrumentation.sinks:
+                with instrumentation.measure('signal.%s.%s' % (self.name, name)):
+                    return receiver(signal=self, sender=sender, **named)
+            return receiver(signal=self, sender=sender, **named)
+        finally:
+            _count(self.name, name, time.time() - started)
+
+
+def _count(signal_name, receiver_name, seconds):
+    key = (signal_name, receiver_name)
+    with _lock:
+        calls, total, longest = _stats.get(key, (0, 0.0, 0.0))
+        _stats[key] = (calls + 1, total + seconds, max(longest, seconds))
+    slow = getattr(settings, 'SUBSCRIPTION_SLOW_RECEIVER', None)
+    if slow is not None and seconds > slow:
+        logger.warning('Slow receiver %s of %s signal: %.1f ms',
+                       receiver_name, signal_name, seconds * 1000)
+
+
+def slowest(limit=10):
+    """Return list of ReceiverStats of at most `limit' receivers that
+    took most time in total, slowest first."""
+    with _lock:
+        stats = [ReceiverStats(signal_name, receiver_name, calls, seconds, longest)
+                 for (signal_name, receiver_name), (calls, seconds, longest)
+                 in _stats.items()]
+    stats.sort(key=lambda s: s.seconds, reverse=True)
+    return stats[:limit]
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+
+
+def _defer(signal, receiver, sender, named):
+    queue = getattr(_local, 'queue', None)
+    if queue is None:
+        _run_deferred([(signal, receiver, sender, named)])
+    else:
+        queue.append((signal, receiver, sender, named))
+
+
+def _call_deferred(call):
+    signal, receiver, sender, named = call
+    try:
+        signal._call(receiver, sender, named)
+    except Exception:
+        logger.exception('Deferred receiver %s of %s signal failed',
+                         _receiver_name(receiver), signal.name)
+
+
+def _call_in_thread(call):
+    try:
+        _call_deferred(call)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+def _run_deferred(calls):
+    global _pool
+    threads = getattr(settings, 'SUBSCRIPTION_SIGNAL_THREADS', 0)
+    if not threads:
+        for call in calls:
+            _call_deferred(call)
+        return
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(threads)
+    for call in calls:
+        _pool.apply_async(_call_in_thread, (call, ))
+
+
+def after_transaction(func, *args):
+    """Queue `func(*args)' to be called when the outermost function or
+    block `deferring' is left; returns false (and does not call `func')
+    outside of one."""
+    calls = getattr(_local, 'after', None)
+    if calls is None:
+        return False
+    calls.append((func, args))
+    return True
+
+
+def _run_after(calls):
+    for func, args in calls:
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Call of %s after transaction failed', _receiver_name(func))
+
+
+@contextlib.contextmanager
+def _deferring():
+    queue = getattr(_local, 'queue', None)
+    outermost = queue is None
+    if outermost:
+        queue = _local.queue = []
+        after = _local.after = []
+    start = len(queue)
+    try:
+        yield
+    except:
+        del queue[start:]
+        raise
+    finally:
+        if outermost:
+            _local.queue = _local.after = None
+            _run_after(after)
+    if outermost:
+        _run_deferred(queue)
+
+
+def deferring(func=None):
+    """Decorator queueing deferred receivers of signals sent by `func'
+    and calling them after it returns (see module documentation);
+    without `func', returns a context manager doing the same."""
+    if func is None:
+        return _deferring()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _deferring():
+            return func(*args, **kwargs)
+    return wrapper
+
 
 ## Our signals
 
 # one time subscriptions
-signed_up = Signal()
+signed_up = Signal(name='signed_up')
 
 # recurring subscriptions
-subscribed = Signal()
-unsubscribed = Signal()
-paid = Signal()
+subscribed = Signal(name='subscribed')
+unsubscribed = Signal(name='unsubscribed')
+paid = Signal(name='paid')
 
 # misc. subscription-related events
-event = Signal()
+event = Signal(name='event')
 
 # upgrade/downgrade possibility check
-change_check = Signal()
+change_check = Signal(name='change_check', deferrable=False)
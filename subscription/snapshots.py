@@ -0,0 +1,229 @@
+"""Point-in-time subscription state materialized from the Transaction ledger.
+
+State of a user's UserSubscription is a combination of flags: ACTIVE,
+CANCELLED and LAPSED (user was removed from its group after it
+expired).  `apply()' changes states by a Transaction the way the code
+recording it changed UserSubscriptions; changes made without
+recording a Transaction (e.g. in the admin) are not seen.
+
+`take()' stores states of all users as a StateSnapshot, computed from
+the previous snapshot and the Transactions recorded after it.
+Transactions newer than `lag' seconds are left for the next snapshot,
+so that ones of database transactions still running (and not yet
+visible) are not skipped.  `user_state()' and `population()' load the
+latest snapshot taken before the requested time and apply only the
+Transactions recorded after it, so their cost depends on time between
+snapshots rather than on the length of the ledger.
+"""
+import datetime
+import itertools
+
+from django.db import router, transaction
+from django.utils import timezone
+
+from models import SnapshotRow, StateSnapshot, Transaction, plan_registry
+
+ACTIVE = 1
+CANCELLED = 2
+LAPSED = 4
+# UserSubscription created by an IPN handler, which may have left it
+# unsaved (e.g. on an incorrect payment)
+NEW = 8
+
+# seconds after which a recorded Transaction is assumed to be committed
+LAG = 300
+
+CHUNK_SIZE = 10000
+
+# events recorded when an IPN handler saves the UserSubscription, or
+# for other UserSubscriptions of its user
+_SAVING = frozenset(('one-time payment', 'subscription payment', 'activated',
+                     'deactivated', 'remove subscription (deactivated)'))
+
+
+def is_active(flags):
+    """Return true if state `flags' (or None) gives membership of
+    subscription's group."""
+    return flags is not None and flags & (ACTIVE | LAPSED) == ACTIVE
+
+
+# flags of UserSubscriptions rebuilt by `subscription.replay' (see
+# its `rebuild_event()'), None if deleted
+_REBUILT = {
+    'rebuild subscription (active)': ACTIVE,
+    'rebuild subscription (active, cancelled)': ACTIVE | CANCELLED,
+    'rebuild subscription (inactive)': 0,
+    'rebuild subscription (inactive, cancelled)': CANCELLED,
+    'rebuild subscription (removed)': None,
+    }
+
+
+def apply(states, user_id, subscription_id, event):
+    """Change `states', a dictionary of user id -> {subscription id:
+    flags}, by a Transaction."""
+    if user_id is None or subscription_id is None:
+        return
+    user = states.get(user_id, {})
+    flags = user.get(subscription_id)
+    if flags is not None and flags & NEW and event not in _SAVING:
+        flags = None
+    if event == 'new usersubscription':
+        flags = NEW | CANCELLED         # model defaults, inactive
+    elif event == 'one-time payment':
+        flags = (flags or 0) & CANCELLED | ACTIVE
+    elif event == 'subscription payment':
+        # lapsed subscription stays out of its group until activated
+        flags = (flags or 0) & ~NEW
+    elif event == 'activated':
+        flags = ACTIVE
+    elif event == 'cancel subscription':
+        flags = ACTIVE | CANCELLED | (flags or 0) & LAPSED
+    elif event == 'subscription expired':
+        flags = (flags or 0) | LAPSED
+    elif event in ('remove subscription (cancelled)', 'remove subscription (expired)'):
+        flags = None
+    elif event in _REBUILT:
+        flags = _REBUILT[event]
+        if flags is not None:
+            flags |= user.get(subscription_id, 0) & LAPSED
+    elif event == 'deactivated':
+        # recorded with the new subscription, for each one deactivated
+        for other, other_flags in user.items():
+            if other != subscription_id and not other_flags & CANCELLED:
+                user[other] = other_flags & ~ACTIVE
+    elif event == 'remove subscription (deactivated)':
+        # recorded with the new subscription, for each one deleted:
+        # cancelled ones, or all of them on subscription modify
+        others = sorted((not other_flags & CANCELLED, other)
+                        for other, other_flags in user.items() if other != subscription_id)
+        if others:
+            del user[others[0][1]]
+    if flags is None:
+        user.pop(subscription_id, None)
+    else:
+        user[subscription_id] = flags
+    if user:
+        states[user_id] = user
+    else:
+        states.pop(user_id, None)
+
+
+def _deltas(transactions, after, until=None, lag=LAG, chunk_size=CHUNK_SIZE):
+    """Yield (pk, timestamp, user_id, subscription_id, event)
+    of `transactions' with pk greater than `after', in pk order,
+    recorded by `until'.  Stops at the first one recorded more than
+    `lag' seconds after `until'."""
+    rows = transactions.order_by('pk').values_list(
+        'pk', 'timestamp', 'user_id', 'subscription_id', 'event')
+    stop = until and until + datetime.timedelta(seconds=lag)
+    while True:
+        chunk = list(rows.filter(pk__gt=after)[:chunk_size])
+        for row in chunk:
+            if until is not None and row[1] > until:
+                if row[1] > stop:
+                    return
+                continue
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        after = chunk[-1][0]
+
+
+def _snapshot(when=None):
+    snapshots = StateSnapshot.objects.order_by('-last_transaction')
+    if when is not None:
+        snapshots = snapshots.filter(until__lte=when)
+    return next(iter(snapshots[:1]), None)
+
+
+def _load(snapshot, **users):
+    states = {}
+    if snapshot is not None:
+        for user_id, subscription_id, flags in snapshot.rows.filter(**users).values_list(
+                'user_id', 'subscription_id', 'flags').iterator():
+            states.setdefault(user_id, {})[subscription_id] = flags
+    return states
+
+
+def take(lag=LAG, now=None):
+    """Store a StateSnapshot including Transactions recorded `lag'
+    seconds before `now' (default: now).  Returns the new snapshot, or
+    the latest one if no Transactions were recorded since."""
+    cutoff = (now or timezone.now()) - datetime.timedelta(seconds=lag)
+    base = _snapshot()
+    last, until, count = (base.last_transaction, base.until, 0) if base else (0, None, 0)
+    first = Transaction.objects.filter(pk__gt=last).order_by('pk').values_list(
+        'timestamp', flat=True)[:1]
+    if not first or first[0] > cutoff:
+        return base
+    states = _load(base)
+    for pk, timestamp, user_id, subscription_id, event in _deltas(
+            Transaction.objects.all(), last, cutoff, 0):
+        apply(states, user_id, subscription_id, event)
+        last, until, count = pk, max(until, timestamp) if until else timestamp, count + 1
+    if not count:
+        return base
+
+    with transaction.commit_on_success(using=router.db_for_write(StateSnapshot)):
+        snapshot = StateSnapshot.objects.create(
+            last_transaction=last, until=until, transactions=count)
+        rows = (SnapshotRow(snapshot=snapshot, user_id=user_id,
+                            subscription_id=subscription_id, flags=flags)
+                for user_id, user in states.iteritems()
+                for subscription_id, flags in user.iteritems())
+        while True:
+            chunk = list(itertools.islice(rows, 1000))
+            if not chunk:
+                break
+            SnapshotRow.objects.bulk_create(chunk)
+    return snapshot
+
+
+def prune(keep):
+    """Delete all but `keep' latest StateSnapshots; returns number of
+    deleted snapshots."""
+    old = list(StateSnapshot.objects.order_by('-last_transaction').values_list(
+        'pk', flat=True)[keep:])
+    with transaction.commit_on_success(using=router.db_for_write(StateSnapshot)):
+        for snapshot_id in old:
+            SnapshotRow.objects.filter(snapshot=snapshot_id).delete()
+        StateSnapshot.objects.filter(pk__in=old).delete()
+    return len(old)
+
+
+def user_state(user_id, when=None):
+    """Return {subscription id: flags} of user `user_id' at `when'
+    (default: now)."""
+    snapshot = _snapshot(when)
+    states = _load(snapshot, user_id=user_id)
+    for pk, timestamp, user_id, subscription_id, event in _deltas(
+            Transaction.objects.filter(user=user_id),
+            snapshot.last_transaction if snapshot else 0, when):
+        apply(states, user_id, subscription_id, event)
+    return states.get(user_id, {})
+
+
+def plan_at(user_id, when=None):
+    """Return id of the Subscription user `user_id' was subscribed to at
+    `when' (default: now), or None.  Of several active subscriptions,
+    the one `User.get_subscription()' would return for groups they give
+    is chosen: first plan of these groups in Subscription's order."""
+    active = [subscription_id for subscription_id, flags in user_state(user_id, when).items()
+              if is_active(flags)]
+    if not active:
+        return None
+    plans = [plan_registry.get(subscription_id) for subscription_id in active]
+    plan = plan_registry.for_groups(plan.group_id for plan in plans if plan is not None)
+    # plans deleted since are not in the registry
+    return plan.id if plan is not None else min(active)
+
+
+def population(when=None):
+    """Return states of all users at `when' (default: now) as a
+    dictionary of user id -> {subscription id: flags}."""
+    snapshot = _snapshot(when)
+    states = _load(snapshot)
+    for pk, timestamp, user_id, subscription_id, event in _deltas(
+            Transaction.objects.all(), snapshot.last_transaction if snapshot else 0, when):
+        apply(states, user_id, subscription_id, event)
+    return states
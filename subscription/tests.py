@@ -1,9 +1,51 @@
-from datetime import date
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 import calendar
+import csv
+import gzip
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
 
+from django.contrib import admin
+from django.contrib.admin.util import lookup_field
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone, unittest
+from paypal.standard.ipn import signals as ipn_signals
+from paypal.standard.ipn.models import PayPalIPN
 
+import subscription.admin
+import subscription.analytics
+import subscription.benchmark
+import subscription.caching
+import subscription.expiry
+import subscription.export
+import subscription.forecast
+import subscription.instrumentation
+import subscription.membership
+import subscription.registry
+import subscription.replay
+import subscription.ledger
+import subscription.models
+import subscription.rollup
+import subscription.scheduler
+import subscription.snapshots
 import subscription.utils
+import subscription.views
+import subscription.worker
+from subscription.models import ExpiryShard, IPNJob, Subscription, Transaction, UserSubscription
 
 A_LEAP_YEAR = 2012
 NOT_A_LEAP_YEAR = 2011
@@ -27,3 +69,1490 @@ class SubscriptionUtil(TestCase):
                         self.assertEqual(added.month, 1)
                     else:
                         self.assertEqual(added.month, start.month + 1)
+
+    def _random_dates(self, count):
+        rnd = random.Random(count)
+        dates = [date(1999, 12, 1) + timedelta(rnd.randrange(3000)) for i in xrange(count)]
+        dates += [date(year, month, calendar.monthrange(year, month)[1])
+                  for year in YEARS for month in MONTHS]  # month ends
+        amounts = [rnd.randrange(0, 50) for date_ in dates]
+        units = [rnd.choice(subscription.utils.UNITS) for date_ in dates]
+        return dates, amounts, units
+
+    def _check_extend_dates_by(self):
+        dates, amounts, units = self._random_dates(5000)
+        self.assertEqual(
+            subscription.utils.extend_dates_by(dates, amounts, units),
+            [subscription.utils.extend_date_by(date_, amount, unit)
+             for date_, amount, unit in zip(dates, amounts, units)])
+        self.assertEqual(
+            subscription.utils.extend_dates_by(dates, 1, 'M'),
+            [subscription.utils.extend_date_by(date_, 1, 'M') for date_ in dates])
+        self.assertEqual(subscription.utils.extend_dates_by([], [], []), [])
+        self.assertRaises(ValueError, subscription.utils.extend_dates_by,
+                          dates, amounts, 'Q')
+
+    def test_extend_dates_by(self):
+        self._check_extend_dates_by()
+        numpy = subscription.utils.numpy
+        if numpy is not None:
+            dates, amounts, units = self._random_dates(100)
+            extended = subscription.utils.extend_dates_by(
+                numpy.array(dates, dtype='datetime64[D]'), numpy.array(amounts),
+                numpy.array(units))
+            self.assertEqual(extended.dtype, numpy.dtype('datetime64[D]'))
+            self.assertEqual(extended.tolist(),
+                             subscription.utils.extend_dates_by(dates, amounts, units))
+
+    def test_extend_dates_by_without_numpy(self):
+        numpy, subscription.utils.numpy = subscription.utils.numpy, None
+        try:
+            self._check_extend_dates_by()
+        finally:
+            subscription.utils.numpy = numpy
+
+
+class UserSubscriptionFixtures(object):
+
+    def setUp(self):
+        self.group = Group.objects.create(name='monthly')
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=self.group)
+        self.lapsed = date.today() - UserSubscription.grace_timedelta - timedelta(1)
+        subscription.models.plan_registry.plans()
+        subscription.rollup.plan_stats(self.subscription.id)
+
+    def _usersubscription(self, username, expires, cancelled=False):
+        user = User.objects.create(username=username)
+        user.groups.add(self.group)
+        return UserSubscription.objects.create(
+            user=user, subscription=self.subscription,
+            expires=expires, active=True, cancelled=cancelled)
+
+
+class UnsubscribeExpiredTest(UserSubscriptionFixtures, TestCase):
+
+    def test_unsubscribe_expired(self):
+        current = self._usersubscription('current', date.today())
+        expired = self._usersubscription('expired', self.lapsed)
+        cancelled = self._usersubscription('cancelled', self.lapsed, cancelled=True)
+
+        summary = subscription.models.unsubscribe_expired(chunk_size=1)
+
+        self.assertEqual(summary, dict(chunks=2, usersubscriptions=2,
+                                       unsubscribed=2, deleted=1, transactions=3))
+        self.assertTrue(current.user_is_group_member())
+        self.assertFalse(expired.user_is_group_member())
+        self.assertFalse(UserSubscription.objects.filter(pk=cancelled.pk).exists())
+        self.assertEqual(Transaction.objects.filter(user=cancelled.user).count(), 2)
+
+        # already fixed rows are left alone
+        summary = subscription.models.unsubscribe_expired()
+        self.assertEqual(summary['unsubscribed'], 0)
+        self.assertEqual(summary['transactions'], 0)
+
+    def test_unsubscribe_expired_queries(self):
+        for i in xrange(10):
+            self._usersubscription('user%d' % i, self.lapsed, cancelled=i % 2)
+        # one chunk: lookup, membership, collect and delete membership,
+        # count and delete usersubscriptions, insert transactions, update
+        # plan stats, empty chunk lookup
+        self.assertNumQueries(9, subscription.models.unsubscribe_expired)
+
+
+class UserGetSubscriptionTest(TestCase):
+
+    def setUp(self):
+        subscription.models.subscription_cache.invalidate_all()
+        self.group = Group.objects.create(name='monthly')
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=self.group)
+        self.user = User.objects.create(username='user')
+
+    def _get_subscription(self):
+        # fresh instance, as in a new request
+        return User.objects.get(pk=self.user.pk).get_subscription()
+
+    def test_cached(self):
+        self.assertEqual(self._get_subscription(), None)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertNumQueries(0, user.get_subscription)
+
+        us = UserSubscription.objects.create(
+            user=self.user, subscription=self.subscription)
+        us.subscribe()
+        self.assertEqual(self._get_subscription(), self.subscription)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertNumQueries(0, user.get_subscription)
+
+        us.unsubscribe()
+        self.assertEqual(self._get_subscription(), None)
+
+    def test_invalidated_after_commit(self):
+        cache = subscription.models.subscription_cache
+
+        def load_before_commit(user_id):
+            return None
+
+        with subscription.signals.deferring():
+            with transaction.commit_on_success():
+                self.user.groups.add(self.group)
+                # reader in another process still sees rows before the commit
+                self.assertEqual(cache.get_subscription_id(self.user.pk, load_before_commit),
+                                 subscription.caching.NO_SUBSCRIPTION)
+            self.assertEqual(cache.get_subscription_id(self.user.pk, load_before_commit),
+                             subscription.caching.NO_SUBSCRIPTION)
+        self.assertEqual(self._get_subscription(), self.subscription)
+
+    def test_subscription_saved(self):
+        self.user.groups.add(self.group)
+        self.assertEqual(self._get_subscription().name, 'Monthly')
+        self.subscription.name = 'Renamed'
+        self.subscription.save()
+        self.assertEqual(self._get_subscription().name, 'Renamed')
+
+
+class PlanRegistryTest(TestCase):
+
+    def setUp(self):
+        subscription.models.subscription_cache.invalidate_all()
+        self.registry = subscription.models.plan_registry
+        self.group = Group.objects.create(name='shared')
+        self.cheap, self.expensive = [
+            Subscription.objects.create(
+                name=name, price=price, recurrence_period=1,
+                recurrence_unit='M', group=self.group)
+            for name, price in (('cheap', 10), ('expensive', 20))]
+        self.other = Subscription.objects.create(
+            name='other', price=5, recurrence_period=1, recurrence_unit='Y',
+            group=Group.objects.create(name='other'))
+        self.user = User.objects.create(username='user')
+
+    def test_lookups(self):
+        self.assertEqual([plan.name for plan in self.registry.plans()],
+                         ['other', 'cheap', 'expensive'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.get(self.cheap.id).price_per_day,
+                             self.cheap.price_per_day())
+            self.assertEqual(self.registry.for_group(self.group.id).id, self.cheap.id)
+            self.assertEqual(self.registry.for_groups([self.group.id, self.other.group_id]).id,
+                             self.other.id)
+            self.assertEqual(self.registry.for_groups([0]), None)
+            self.assertEqual(self.registry.get(0), None)
+
+    def test_reloaded(self):
+        self.registry.plans()
+        self.cheap.price = 30
+        self.cheap.save()
+        self.assertEqual(self.registry.for_group(self.group.id).id, self.expensive.id)
+
+    def test_reloaded_after_commit(self):
+        loaded = []
+
+        def load():
+            loaded.append(len(loaded))
+            return subscription.models._load_plans()
+
+        registry = subscription.registry.PlanRegistry(
+            subscription.models.subscription_cache, load)
+        with subscription.signals.deferring():
+            with transaction.commit_on_success():
+                self.cheap.price = 30
+                self.cheap.save()
+                # loaded while the change is not committed yet
+                registry.plans()
+            registry.plans()
+        self.assertEqual(loaded, [0])
+        registry.plans()
+        self.assertEqual(loaded, [0, 1])
+
+    def test_ttl(self):
+        registry = subscription.registry.PlanRegistry(
+            subscription.models.subscription_cache, subscription.models._load_plans, ttl=0)
+        registry.plans()
+        with self.assertNumQueries(1):
+            registry.plans()
+
+    def test_prefetched_groups(self):
+        self.user.groups.add(self.group)
+        self.registry.plans()
+        subscription.models.subscription_cache.get_subscription(
+            self.cheap.id, subscription.models._load_subscription)
+        user = User.objects.prefetch_related('groups').get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.get_subscription(), self.cheap)
+
+    def test_group_membership(self):
+        us = UserSubscription.objects.create(user=self.user, subscription=self.cheap)
+        us = UserSubscription.objects.get(pk=us.pk)
+        self.registry.plans()
+        with self.assertNumQueries(1):
+            self.assertFalse(us.user_is_group_member())
+
+
+class PayPalFormTest(TestCase):
+    urls = 'subscription.urls'
+
+    def setUp(self):
+        subscription.models.subscription_cache.invalidate_all()
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=Group.objects.create(name='monthly'))
+        self.users = [User.objects.create(username='user%d' % i) for i in range(2)]
+        self.built = 0
+        self._paypal_subscription_args = subscription.views._paypal_subscription_args
+        def counting(*args, **kwargs):
+            self.built += 1
+            return self._paypal_subscription_args(*args, **kwargs)
+        subscription.views._paypal_subscription_args = counting
+
+    def tearDown(self):
+        subscription.views._paypal_subscription_args = self._paypal_subscription_args
+
+    def _initial(self, user, **kwargs):
+        return subscription.views._paypal_form(self.subscription, user, **kwargs).initial
+
+    def test_cached(self):
+        first = self._initial(self.users[0])
+        with self.assertNumQueries(0):
+            second = self._initial(self.users[1], invoice='x')
+        self.assertEqual(self.built, 1)
+        self.assertEqual((first['custom'], second['custom']),
+                         (self.users[0].id, self.users[1].id))
+        self.assertEqual(second['invoice'], 'x')
+        self.assertNotIn('invoice', first)
+        self.assertEqual(first['a3'], 10)
+        self.assertTrue(first['notify_url'].endswith('/paypal/'))
+        self.assertEqual(self._initial(self.users[0], upgrade_subscription=True)['modify'], 2)
+        self.assertEqual(self.built, 2)
+
+    def test_form_per_request(self):
+        forms = [subscription.views._paypal_form(self.subscription, user)
+                 for user in self.users]
+        self.assertIsNot(forms[0].fields, forms[1].fields)
+        forms[0].fields['custom'].widget.attrs['class'] = 'changed'
+        for user, form in zip(self.users, forms):
+            self.assertIn('name="custom" type="hidden" value="%d"' % user.id, form.render())
+        self.assertNotIn('changed', forms[1].render())
+
+    def test_settings_changed(self):
+        self._initial(self.users[0])
+        with self.settings(SUBSCRIPTION_PAYPAL_SETTINGS={'business': 'other@example.com'}):
+            self.assertEqual(self._initial(self.users[0])['business'], 'other@example.com')
+        self.assertEqual(self._initial(self.users[0])['business'], 'biz@example.com')
+        self.assertEqual(self.built, 2)
+
+    def test_subscription_saved(self):
+        self._initial(self.users[0])
+        self.subscription.price = 20
+        self.subscription.save()
+        self.assertEqual(self._initial(self.users[0])['a3'], 20)
+        self.assertEqual(self.built, 2)
+
+
+class SubscriptionListTest(TestCase):
+    urls = 'subscription.urls'
+
+    def setUp(self):
+        subscription.models.subscription_cache.invalidate_all()
+        self.subscriptions = [
+            Subscription.objects.create(
+                name=name, price=price, recurrence_period=1, recurrence_unit=unit,
+                trial_period=1, trial_unit='W', group=Group.objects.create(name=name))
+            for name, price, unit in (('monthly', 10, 'M'), ('yearly', 100, 'Y'))]
+        self.render = subscription.views.render
+        subscription.views.render = self._render
+
+    def tearDown(self):
+        subscription.views.render = self.render
+
+    def _render(self, request, template, context):
+        self.context = context
+        return HttpResponse()
+
+    def _list(self, user=None, **headers):
+        request = RequestFactory().get('/', **headers)
+        request.user = user or AnonymousUser()
+        return subscription.views.subscription_list(request)
+
+    def test_snapshot(self):
+        self._list()
+        with self.assertNumQueries(0):
+            response = self._list()
+        plans = self.context['object_list']
+        self.assertEqual([plan.name for plan in plans], ['monthly', 'yearly'])
+        for plan, subscription_ in zip(plans, self.subscriptions):
+            self.assertEqual(plan.get_pricing_display(), subscription_.get_pricing_display())
+            self.assertEqual(plan.get_trial_display(), subscription_.get_trial_display())
+            self.assertEqual(plan.get_absolute_url(), subscription_.get_absolute_url())
+
+        self.assertEqual(self._list(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.subscriptions[0].price = 20
+        self.subscriptions[0].save()
+        self.assertEqual(self._list(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        self.assertEqual(self.context['object_list'][0].get_pricing_display(),
+                         self.subscriptions[0].get_pricing_display())
+
+    def test_user_subscription_changed(self):
+        user = User.objects.create(username='user')
+        response = self._list(User.objects.get(pk=user.pk))
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self._list(User.objects.get(pk=user.pk),
+                                    HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        user.groups.add(self.subscriptions[0].group)
+        self.assertEqual(self._list(User.objects.get(pk=user.pk),
+                                    HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_paginated(self):
+        with self.settings(SUBSCRIPTION_LIST_PAGINATE_BY=1):
+            self._list()
+            self.assertEqual([plan.name for plan in self.context['object_list']], ['monthly'])
+            self.assertTrue(self.context['is_paginated'])
+            request = RequestFactory().get('/', {'page': 3})
+            request.user = AnonymousUser()
+            self.assertRaises(Http404, subscription.views.subscription_list, request)
+
+
+class SubscriptionDetailTest(TestCase):
+    urls = 'subscription.urls'
+
+    def setUp(self):
+        subscription.models.subscription_cache.invalidate_all()
+        self.monthly, self.yearly = [
+            Subscription.objects.create(
+                name=name, price=10, recurrence_period=1, recurrence_unit=unit,
+                group=Group.objects.create(name=name))
+            for name, unit in (('monthly', 'M'), ('yearly', 'Y'))]
+        self.user = User.objects.create(username='user')
+        Site.objects.get_current()  # cached by Django after first request
+        self.render = subscription.views.render
+        subscription.views.render = lambda request, template, context: context
+
+    def tearDown(self):
+        subscription.views.render = self.render
+
+    def _detail(self, subscription_):
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(2):
+            return subscription.views.subscription_detail(request, subscription_.id)
+
+    def test_new(self):
+        context = self._detail(self.monthly)
+        self.assertEqual(context['usersubscription'], None)
+        self.assertEqual(context['change_denied_reasons'], None)
+        self.assertEqual(context['form'].initial['modify'], 0)
+
+    def test_upgrade(self):
+        UserSubscription.objects.create(user=self.user, subscription=self.monthly,
+                                        cancelled=False)
+        yearly = UserSubscription.objects.create(user=self.user, subscription=self.yearly,
+                                                 active=False)
+        context = self._detail(self.yearly)
+        self.assertEqual(context['usersubscription'], yearly)
+        self.assertEqual(context['change_denied_reasons'], [])
+        self.assertEqual(context['form'].initial['modify'], 2)
+
+    def test_current(self):
+        monthly = UserSubscription.objects.create(user=self.user, subscription=self.monthly,
+                                                  cancelled=False)
+        context = self._detail(self.monthly)
+        self.assertEqual(context['usersubscription'], monthly)
+        self.assertEqual(len(context['change_denied_reasons']), 1)
+        self.assertEqual(context['form'], None)
+
+
+class IPNFixtures(object):
+
+    def setUp(self):
+        self.group = Group.objects.create(name='monthly')
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=self.group)
+        self.user = User.objects.create(username='user')
+        subscription.models.plan_registry.plans()  # loaded once per process
+        subscription.rollup.plan_stats(self.subscription.id)
+
+    def _ipn(self, txn_type, subscription=None, user=None, **kwargs):
+        subscription = subscription or self.subscription
+        kwargs.setdefault('mc_gross', subscription.price)
+        kwargs.setdefault('subscr_id', 'S-%d' % subscription.id)
+        kwargs.setdefault('payment_status', 'Completed')
+        return PayPalIPN.objects.create(
+            txn_type=txn_type, custom=str((user or self.user).id),
+            item_number=str(subscription.id), ipaddress='127.0.0.1', **kwargs)
+
+
+class IPNHandlerTest(IPNFixtures, TestCase):
+
+    def test_signup_and_payment(self):
+        signup = self._ipn('subscr_signup', subscr_id='S-1')
+        # subscription, locked user, idempotency check, locked
+        # usersubscriptions, subscribe() (4), save, new usersubscription
+        # and activated transactions, plan stats
+        self.assertNumQueries(
+            11, subscription.models.handle_subscription_signup, signup)
+        us = UserSubscription.objects.get(user=self.user)
+        self.assertTrue(us.active)
+        self.assertFalse(us.cancelled)
+        self.assertTrue(us.user_is_group_member())
+
+        payment = self._ipn('subscr_payment', subscr_id='S-1', txn_id='T-1')
+        # subscription, locked user, idempotency check, locked
+        # usersubscriptions, save (2), subscription payment transaction,
+        # locked subscription, today's revenue (update, insert)
+        self.assertNumQueries(
+            10, subscription.models.handle_payment_was_successful, payment)
+        self.assertEqual(UserSubscription.objects.get(pk=us.pk).expires,
+                         subscription.utils.extend_date_by(us.expires, 1, 'M'))
+
+    def test_replay(self):
+        signup = self._ipn('subscr_signup', subscr_id='S-1')
+        subscription.models.handle_subscription_signup(signup)
+        transactions = Transaction.objects.count()
+
+        retry = self._ipn('subscr_signup', subscr_id='S-1')
+        # subscription, locked user, idempotency check
+        self.assertNumQueries(
+            3, subscription.models.handle_subscription_signup, retry)
+        self.assertEqual(Transaction.objects.count(), transactions)
+
+    def test_replay_committed_meanwhile(self):
+        models = subscription.models
+        models.handle_subscription_signup(self._ipn('subscr_signup', subscr_id='S-1'))
+        transactions = Transaction.objects.count()
+
+        # concurrent handler of a retry committed after the check
+        lookup = models._ipn_usersubscription
+        models._ipn_usersubscription = lambda payment, key: lookup(payment)
+        try:
+            models.handle_subscription_signup(self._ipn('subscr_signup', subscr_id='S-1'))
+        finally:
+            models._ipn_usersubscription = lookup
+        self.assertEqual(Transaction.objects.count(), transactions)
+        self.assertEqual(Transaction.objects.exclude(idempotency_key=None).count(), 1)
+
+    def test_signup_deactivates_others(self):
+        yearly = Subscription.objects.create(
+            name='Yearly', price=100, recurrence_period=1,
+            recurrence_unit='Y', group=Group.objects.create(name='yearly'))
+        subscription.models.handle_subscription_signup(
+            self._ipn('subscr_signup', subscr_id='S-1'))
+        subscription.models.handle_subscription_signup(
+            self._ipn('subscr_signup', subscription=yearly, subscr_id='S-2'))
+
+        old = UserSubscription.objects.get(user=self.user, subscription=self.subscription)
+        new = UserSubscription.objects.get(user=self.user, subscription=yearly)
+        self.assertFalse(old.active)
+        self.assertFalse(old.user_is_group_member())
+        self.assertTrue(new.active)
+        self.assertTrue(new.user_is_group_member())
+
+
+class _SerialPool(object):
+    def imap_unordered(self, func, iterable):
+        return itertools.imap(func, iterable)
+
+
+class IPNWorkerTest(IPNFixtures, TestCase):
+
+    def _enqueue(self, signal, *args, **kwargs):
+        ipn = self._ipn(*args, **kwargs)
+        subscription.models.enqueue_ipn(ipn, signal=getattr(ipn_signals, signal))
+        return IPNJob.objects.get(ipn=ipn).pk
+
+    def test_worker(self):
+        self._enqueue('subscription_signup', 'subscr_signup', subscr_id='S-1')
+        self._enqueue('payment_was_successful', 'subscr_payment',
+                      subscr_id='S-1', txn_id='T-1')
+        self.assertEqual(subscription.worker.run(_SerialPool(), once=True), (2, 0))
+        self.assertFalse(IPNJob.objects.exists())
+        us = UserSubscription.objects.get(user=self.user)
+        self.assertTrue(us.active)
+        self.assertTrue(us.user_is_group_member())
+        self.assertEqual(us.expires, subscription.utils.extend_date_by(date.today(), 1, 'M'))
+
+    def test_user_order(self):
+        other = User.objects.create(username='other')
+        first = self._enqueue('subscription_signup', 'subscr_signup', subscr_id='S-1')
+        theirs = self._enqueue('subscription_signup', 'subscr_signup', user=other,
+                               subscr_id='S-2')
+        second = self._enqueue('subscription_cancel', 'subscr_cancel', subscr_id='S-1')
+        self.assertEqual(subscription.worker.claim('a'), [[first, second], [theirs]])
+
+        # user's later job waits while the first one is leased
+        third = self._enqueue('payment_was_successful', 'subscr_payment',
+                              subscr_id='S-1', txn_id='T-1')
+        self.assertEqual(subscription.worker.claim('b'), [])
+        subscription.worker.release([first, second, theirs])
+        self.assertEqual(subscription.worker.claim('b'), [[first, second, third], [theirs]])
+
+    def test_lease_expiry(self):
+        job_id = self._enqueue('subscription_signup', 'subscr_signup', subscr_id='S-1')
+        self.assertEqual(subscription.worker.claim('a', lease=300), [[job_id]])
+        self.assertEqual(subscription.worker.claim('b'), [])
+
+        # worker `a' died
+        IPNJob.objects.filter(pk=job_id).update(
+            locked_until=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(subscription.worker.claim('b'), [[job_id]])
+        self.assertTrue(IPNJob.objects.get(pk=job_id).worker.startswith('b:'))
+
+    def test_backoff(self):
+        job_id = self._enqueue('subscription_signup', 'subscr_signup', subscr_id='S-1')
+        later = self._enqueue('subscription_cancel', 'subscr_cancel', subscr_id='S-1')
+        IPNJob.objects.filter(pk=job_id).update(signal='unknown')
+
+        for attempt, delay in ((1, 60), (2, 120)):
+            started = datetime.now()
+            self.assertEqual(subscription.worker.run(_SerialPool(), once=True, backoff=60),
+                             (0, 1))
+            job = IPNJob.objects.get(pk=job_id)
+            self.assertEqual(job.attempts, attempt)
+            self.assertFalse(job.failed)
+            self.assertTrue(started + timedelta(seconds=delay) <= job.run_after <=
+                            datetime.now() + timedelta(seconds=delay))
+            # later job of the same user waits for the failed one
+            self.assertEqual(subscription.worker.claim('test'), [])
+            IPNJob.objects.filter(pk=job_id).update(run_after=datetime.now())
+        self.assertFalse(IPNJob.objects.get(pk=later).attempts)
+
+    def test_max_attempts(self):
+        job_id = self._enqueue('subscription_signup', 'subscr_signup', subscr_id='S-1')
+        IPNJob.objects.filter(pk=job_id).update(signal='unknown')
+        for attempt in (1, 2):
+            IPNJob.objects.filter(pk=job_id).update(run_after=datetime.now())
+            self.assertEqual(subscription.worker.run(_SerialPool(), once=True,
+                                                     max_attempts=2), (0, 1))
+        job = IPNJob.objects.get(pk=job_id)
+        self.assertTrue(job.failed)
+        self.assertTrue('KeyError' in job.last_error)
+        IPNJob.objects.filter(pk=job_id).update(run_after=datetime.now())
+        self.assertEqual(subscription.worker.run(_SerialPool(), once=True), (0, 0))
+
+
+class TransactionWriterTest(TestCase):
+
+    def test_flush_on_exit(self):
+        with self.assertNumQueries(1):
+            with subscription.ledger.TransactionWriter() as writer:
+                subscription.ledger.record(event='one')
+                subscription.ledger.record(event='two')
+                self.assertEqual(len(writer), 2)
+        self.assertEqual(writer.written, 2)
+        self.assertEqual(sorted(Transaction.objects.values_list('event', flat=True)),
+                         ['one', 'two'])
+
+    def test_discard_on_error(self):
+        try:
+            with subscription.ledger.TransactionWriter():
+                subscription.ledger.record(event='one')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(subscription.ledger.current(), None)
+
+    def test_buffered(self):
+        with subscription.ledger.TransactionWriter(max_rows=2) as writer:
+            for i in range(5):
+                subscription.ledger.record(event=str(i))
+            self.assertEqual(Transaction.objects.count(), 4)
+            self.assertEqual(len(writer), 1)
+        self.assertEqual(Transaction.objects.count(), 5)
+
+    def test_batched_joins_writer(self):
+        @subscription.ledger.batched
+        def work():
+            subscription.ledger.record(event='inner')
+            return subscription.ledger.current()
+
+        with subscription.ledger.TransactionWriter() as writer:
+            self.assertTrue(work() is writer)
+            self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(Transaction.objects.count(), 1)
+
+    def test_record_without_writer(self):
+        with self.assertNumQueries(1):
+            subscription.ledger.record(event='one')
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+class AdminChangelistTest(TestCase):
+
+    def setUp(self):
+        self.group = Group.objects.create(name='monthly')
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=self.group)
+        for i in xrange(20):
+            user = User.objects.create(username='user%d' % i)
+            us = UserSubscription.objects.create(user=user, subscription=self.subscription)
+            if i % 2:
+                us.subscribe()
+            Transaction.objects.create(user=user, subscription=self.subscription,
+                                       event='activated')
+
+    def _changelist_rows(self, model):
+        model_admin = admin.site._registry[model]
+        request = RequestFactory().get('/')
+        return [[lookup_field(name, obj, model_admin)[2]
+                 for name in model_admin.list_display]
+                for obj in model_admin.queryset(request)]
+
+    def test_usersubscription_changelist(self):
+        with self.assertNumQueries(1):
+            rows = self._changelist_rows(UserSubscription)
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(sorted(row[-1] for row in rows), [False] * 10 + [True] * 10)
+
+    def test_transaction_changelist(self):
+        with self.assertNumQueries(1):
+            rows = self._changelist_rows(Transaction)
+        self.assertEqual(len(rows), 20)
+
+
+class BulkActionTest(UserSubscriptionFixtures, TestCase):
+
+    def test_fix_usersubscriptions(self):
+        current = self._usersubscription('current', date.today())
+        current.unsubscribe()
+        expired = self._usersubscription('expired', self.lapsed)
+        cancelled = self._usersubscription('cancelled', self.lapsed, cancelled=True)
+
+        # lookup, membership, insert membership, revoke (7), empty lookup
+        with self.assertNumQueries(11):
+            counts = subscription.models.fix_usersubscriptions(UserSubscription.objects.all())
+        self.assertEqual(counts, dict(subscribed=1, unsubscribed=2, deleted=1, transactions=3))
+        self.assertTrue(current.user_is_group_member())
+        self.assertFalse(expired.user_is_group_member())
+        self.assertFalse(UserSubscription.objects.filter(pk=cancelled.pk).exists())
+
+    def test_extend_usersubscriptions(self):
+        today = date.today()
+        first = self._usersubscription('first', today)
+        second = self._usersubscription('second', today)
+        third = self._usersubscription('third', subscription.utils.extend_date_by(today, 1, 'M'))
+
+        self.assertEqual(
+            subscription.models.extend_usersubscriptions(UserSubscription.objects.all()), 3)
+        for us in (first, second, third):
+            self.assertEqual(UserSubscription.objects.get(pk=us.pk).expires,
+                             subscription.utils.extend_date_by(us.expires, 1, 'M'))
+
+    def test_extend_distinct_dates(self):
+        today = date.today()
+        subscriptions = [self._usersubscription('user%d' % i, today + timedelta(i))
+                         for i in range(10)]
+        subscriptions[0].subscription = Subscription.objects.create(
+            name='Weekly', price=3, recurrence_period=2, recurrence_unit='W',
+            group=self.group)
+        subscriptions[0].save()
+        # one-time clear, lookup, update of each plan
+        with self.assertNumQueries(4):
+            self.assertEqual(subscription.models.extend_usersubscriptions(
+                UserSubscription.objects.all()), 10)
+        for us in subscriptions:
+            plan = us.subscription
+            self.assertEqual(UserSubscription.objects.get(pk=us.pk).expires,
+                             subscription.utils.extend_date_by(
+                                 us.expires, plan.recurrence_period, plan.recurrence_unit))
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite-specific')
+class QueryPlanTest(TestCase):
+
+    def _plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def test_indexed(self):
+        today = date.today()
+        for queryset in (
+                UserSubscription.active_objects.filter(expires__lt=today),
+                UserSubscription.objects.filter(expires=today),
+                UserSubscription.objects.filter(user=1, active=True),
+                Transaction.objects.all()[:100],
+                Transaction.objects.filter(subscription=1)[:100],
+                subscription.forecast._expiring(today, today + timedelta(90))[:1000],
+                UserSubscription.objects.filter(
+                    active=True, expires__gte=today).order_by('expires')[999:1000]):
+            plan = self._plan(queryset)
+            self.assertIn('INDEX', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ExportTransactionsTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=Group.objects.create(name='monthly'))
+        self.transactions = [self._transaction(datetime(2013, 1, 1 + i // 2), event)
+                             for i, event in enumerate(['one-time payment', 'subscription payment',
+                                                        u'\u017c\xf3\u0142w', 'subscription payment',
+                                                        'subscription expired'])]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _transaction(self, timestamp, event):
+        t = Transaction.objects.create(subscription=self.subscription, event=event,
+                                       amount=Decimal('10.10'))
+        Transaction.objects.filter(pk=t.pk).update(timestamp=timestamp)
+        return t
+
+    def _export(self, name, **options):
+        path = os.path.join(self.dir, name)
+        call_command('subscription_export_transactions', output=path, **options)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path) as f:
+            return f.read()
+
+    def test_csv(self):
+        rows = list(csv.reader(StringIO(self._export('ledger.csv', chunk_size=2))))
+        self.assertEqual(tuple(rows[0]), subscription.export.FIELDS)
+        self.assertEqual([int(row[1]) for row in rows[1:]], [t.pk for t in self.transactions])
+        self.assertEqual(rows[3][2].decode('utf-8'), u'\u017c\xf3\u0142w')
+        self.assertEqual(Decimal(rows[1][6]), Decimal('10.10'))
+        self.assertEqual(rows[1][0][:10], '2013-01-01')
+
+    def test_json(self):
+        lines = self._export('ledger.json.gz', format='json', event=['subscription payment'],
+                             since='2013-01-01 12:00', until='2013-01-03').splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [self.transactions[3].pk])
+        row = json.loads(lines[0])
+        self.assertEqual((Decimal(row['amount']), row['ipn_id'], row['subscription_id']),
+                         (Decimal('10.10'), None, self.subscription.pk))
+
+    def test_checkpoint(self):
+        checkpoint = os.path.join(self.dir, 'checkpoint')
+        self._export('ledger.csv.gz', checkpoint=checkpoint, chunk_size=2)
+        self.transactions.append(self._transaction(datetime(2013, 2, 1), 'subscription payment'))
+        rows = list(csv.reader(StringIO(
+            self._export('ledger.csv.gz', checkpoint=checkpoint, chunk_size=2))))
+        self.assertEqual([int(row[1]) for row in rows[1:]], [t.pk for t in self.transactions])
+        self.assertEqual(subscription.export.read_checkpoint(checkpoint)[1],
+                         self.transactions[-1].pk)
+
+    def test_checkpoint_without_output(self):
+        checkpoint = os.path.join(self.dir, 'checkpoint')
+        self._export('ledger.csv', checkpoint=checkpoint)
+        os.remove(os.path.join(self.dir, 'ledger.csv'))
+        self.assertRaisesRegexp(CommandError, 'delete the checkpoint', self._export,
+                                'ledger.csv', checkpoint=checkpoint)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'ledger.csv')))
+
+    def test_gzip_resumed(self):
+        checkpoint = os.path.join(self.dir, 'checkpoint')
+        write = subscription.export.CSVWriter.write
+        pages = []
+
+        def crashing(writer, rows):
+            pages.append(rows)
+            if len(pages) == 2:
+                writer.stream.write('partial,row\n')
+                raise IOError('disk full')
+            write(writer, rows)
+        subscription.export.CSVWriter.write = crashing
+        try:
+            self.assertRaises(IOError, self._export, 'ledger.csv.gz',
+                              checkpoint=checkpoint, chunk_size=2)
+        finally:
+            subscription.export.CSVWriter.write = write
+        self.assertEqual(subscription.export.read_checkpoint(checkpoint)[1],
+                         self.transactions[1].pk)
+        # member cut short by a crash
+        with open(os.path.join(self.dir, 'ledger.csv.gz'), 'ab') as f:
+            f.write('\x1f\x8b\x08\x00')
+        rows = list(csv.reader(StringIO(
+            self._export('ledger.csv.gz', checkpoint=checkpoint, chunk_size=2))))
+        self.assertEqual(tuple(rows[0]), subscription.export.FIELDS)
+        self.assertEqual([int(row[1]) for row in rows[1:]], [t.pk for t in self.transactions])
+
+
+class AnalyticsTest(TestCase):
+
+    def setUp(self):
+        self.monthly = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=Group.objects.create(name='monthly'))
+        self.users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        for i, user in enumerate(self.users):
+            self._transaction(datetime(2013, 1, 1 + i), 'activated', user)
+            self._transaction(datetime(2013, 1, 1 + i, 12), 'subscription payment', user, '10')
+        self._transaction(datetime(2013, 2, 1), 'subscription payment', self.users[0], '10')
+        self._transaction(datetime(2013, 2, 2), 'remove subscription (cancelled)', self.users[1])
+        self._transaction(datetime(2013, 2, 3), 'subscription payment', self.users[2], '10.50')
+        UserSubscription.objects.create(user=self.users[0], subscription=self.monthly)
+        UserSubscription.objects.create(user=self.users[2], subscription=self.monthly)
+        subscription.rollup.reconcile(repair=True)
+
+    def _transaction(self, timestamp, event, user, amount=None):
+        t = Transaction.objects.create(subscription=self.monthly, user=user, event=event,
+                                       amount=amount)
+        Transaction.objects.filter(pk=t.pk).update(timestamp=timestamp)
+        return t
+
+    def test_refresh(self):
+        self.assertEqual(subscription.analytics.refresh(), 9)
+        payments = subscription.models.RevenueSummary.objects.get(
+            day=date(2013, 1, 2), event='subscription payment')
+        self.assertEqual((payments.count, payments.amount), (1, Decimal('10')))
+
+        # days from two days before last summarized one are recomputed
+        self._transaction(datetime(2013, 2, 3, 13), 'subscription payment', self.users[0], '10')
+        self._transaction(datetime(2013, 1, 15), 'subscription payment', self.users[0], '10')
+        self.assertEqual(subscription.analytics.refresh(), 3)
+        self.assertEqual(subscription.models.RevenueSummary.objects.get(
+            day=date(2013, 2, 3), event='subscription payment').count, 2)
+        self.assertFalse(subscription.models.RevenueSummary.objects.filter(
+            day=date(2013, 1, 15)).exists())
+        subscription.analytics.refresh(since=date(2013, 1, 1))
+        self.assertTrue(subscription.models.RevenueSummary.objects.filter(
+            day=date(2013, 1, 15)).exists())
+
+    def test_revenue(self):
+        subscription.analytics.refresh()
+        with self.assertNumQueries(1):
+            months = subscription.analytics.revenue('month')
+        self.assertEqual(months, [(date(2013, 1, 1), Decimal('30')),
+                                  (date(2013, 2, 1), Decimal('20.50'))])
+        self.assertEqual(subscription.analytics.revenue('week', since=date(2013, 1, 2),
+                                                        until=date(2013, 2, 3)),
+                         [(date(2012, 12, 31), Decimal('20')),
+                          (date(2013, 1, 28), Decimal('10'))])
+
+    def test_mrr(self):
+        [(plan, active, mrr)] = subscription.analytics.mrr()
+        self.assertEqual((plan.id, active, mrr), (self.monthly.id, 2, Decimal('20.00')))
+        # read from PlanStats, not counted
+        PlanStats = subscription.models.PlanStats
+        PlanStats.objects.filter(subscription=self.monthly).update(active=5)
+        with self.assertNumQueries(1):
+            [(plan, active, mrr)] = subscription.analytics.mrr()
+        self.assertEqual((active, mrr), (5, Decimal('50.00')))
+        # missing row counts as 0 and is not created
+        PlanStats.objects.all().delete()
+        self.assertEqual(subscription.analytics.mrr()[0][1:], (0, Decimal('0.00')))
+        self.assertFalse(PlanStats.objects.exists())
+
+    def test_churn(self):
+        subscription.analytics.refresh()
+        self.assertEqual(subscription.analytics.churn('month'), [
+            dict(start=date(2013, 1, 1), started=3, churned=0, active=0, rate=None),
+            dict(start=date(2013, 2, 1), started=0, churned=1, active=3, rate=1 / 3.)])
+
+    def test_cohorts(self):
+        self.assertEqual(subscription.analytics.cohorts(), [(date(2013, 1, 1), 3, [3, 2])])
+        self.assertEqual(subscription.analytics.cohorts(since=date(2013, 2, 1)), [])
+
+
+class RollupTest(IPNFixtures, TestCase):
+
+    def setUp(self):
+        self.monthly = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1, recurrence_unit='M',
+            trial_period=7, trial_unit='D', group=Group.objects.create(name='monthly'))
+        self.yearly = Subscription.objects.create(
+            name='Yearly', price=100, recurrence_period=1, recurrence_unit='Y',
+            group=Group.objects.create(name='yearly'))
+        self.user = User.objects.create(username='user')
+
+    def _stats(self, plan):
+        stats = subscription.rollup.plan_stats(plan.id)
+        return stats.active, stats.cancelled, stats.trial
+
+    def test_ipn_handlers(self):
+        stats = self._stats
+        subscription.models.handle_subscription_signup(
+            self._ipn('subscr_signup', self.monthly, subscr_id='S-1'))
+        self.assertEqual(stats(self.monthly), (1, 0, 1))
+
+        subscription.models.handle_payment_was_successful(
+            self._ipn('subscr_payment', self.monthly, subscr_id='S-1', txn_id='T-1'))
+        self.assertEqual(stats(self.monthly), (1, 0, 0))
+        self.assertEqual(subscription.rollup.revenue_today(), Decimal('10'))
+
+        subscription.models.handle_subscription_cancel(
+            self._ipn('subscr_cancel', self.monthly, subscr_id='S-1'))
+        self.assertEqual(stats(self.monthly), (1, 1, 0))
+
+        subscription.models.handle_subscription_signup(
+            self._ipn('subscr_signup', self.yearly, subscr_id='S-2'))
+        subscription.models.handle_payment_was_successful(
+            self._ipn('subscr_payment', self.yearly, subscr_id='S-2', txn_id='T-2'))
+        self.assertEqual(stats(self.monthly), (0, 0, 0))
+        self.assertEqual(stats(self.yearly), (1, 0, 0))
+        self.assertEqual(subscription.rollup.revenue_today(), Decimal('110'))
+        self.assertEqual(subscription.rollup.revenue_today(self.yearly), Decimal('100'))
+
+        self.assertEqual(subscription.rollup.reconcile(), [])
+        self.assertEqual(subscription.rollup.revenue_drift(subscription.rollup.today()), [])
+
+    def test_plan_stats_query(self):
+        subscription.rollup.plan_stats(self.monthly.id)
+        with self.assertNumQueries(1):
+            subscription.rollup.plan_stats(self.monthly.id)
+
+    def test_reconcile(self):
+        subscription.rollup.plan_stats(self.yearly.id)
+        UserSubscription.objects.create(user=self.user, subscription=self.yearly,
+                                        active=True, cancelled=True)
+        self.assertEqual(subscription.rollup.reconcile(),
+                         [(self.monthly.id, None, (0, 0, 0)),
+                          (self.yearly.id, (0, 0, 0), (1, 1, 0))])
+        call_command('subscription_rollup', repair=True, verbosity=0, stdout=StringIO())
+        self.assertEqual(self._stats(self.yearly), (1, 1, 0))
+        self.assertEqual(subscription.rollup.reconcile(), [])
+
+    def test_repair_revenue(self):
+        subscription.models.Transaction.objects.create(
+            subscription=self.yearly, event='subscription payment', amount=100)
+        self.assertEqual(subscription.rollup.revenue_today(), 0)
+        output = StringIO()
+        call_command('subscription_rollup', repair=True, stdout=output)
+        self.assertTrue('1 revenue row(s) repaired' in output.getvalue())
+        self.assertEqual(subscription.rollup.revenue_today(), Decimal('100'))
+
+
+class ForecastTest(TestCase):
+
+    def setUp(self):
+        self.today = date(2013, 1, 10)
+        self.monthly = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1, recurrence_unit='M',
+            group=Group.objects.create(name='monthly'))
+        self.once = Subscription.objects.create(
+            name='Once', price=50, group=Group.objects.create(name='once'))
+        self.usersubscriptions = [
+            self._usersubscription(self.monthly, date(2013, 1, 20)),
+            self._usersubscription(self.monthly, date(2013, 1, 12)),
+            self._usersubscription(self.monthly, date(2013, 1, 12), cancelled=True),
+            self._usersubscription(self.once, date(2013, 1, 15)),
+            self._usersubscription(self.monthly, date(2013, 1, 9)),    # in grace period
+            self._usersubscription(self.monthly, date(2013, 3, 1)),
+            ]
+
+    def _usersubscription(self, plan, expires, cancelled=False):
+        user = User.objects.create(username='user%d' % User.objects.count())
+        return UserSubscription.objects.create(user=user, subscription=plan, expires=expires,
+                                               active=True, cancelled=cancelled)
+
+    def test_upcoming(self):
+        us = self.usersubscriptions
+        expirations = list(subscription.forecast.upcoming(30, self.today, chunk_size=2))
+        self.assertEqual([e.usersubscription_id for e in expirations],
+                         [us[1].id, us[2].id, us[3].id, us[0].id])
+        first = expirations[0]
+        self.assertEqual((first.user_id, first.subscription_id, first.expires),
+                         (us[1].user_id, self.monthly.id, date(2013, 1, 12)))
+        self.assertEqual(first.lapses, date(2013, 1, 12) + UserSubscription.grace_timedelta)
+        self.assertEqual(first.next_expires, date(2013, 2, 12))
+        self.assertEqual([(e.cancelled, e.next_expires) for e in expirations[1:]],
+                         [(True, None), (False, None), (False, date(2013, 2, 20))])
+
+    def test_renewals(self):
+        renewals = list(subscription.forecast.renewals(45, self.today))
+        self.assertEqual(len(renewals), 45)
+        self.assertEqual(renewals[0].day, self.today)
+        by_day = dict((r.day, (r.count, r.amount)) for r in renewals if r.count)
+        self.assertEqual(by_day, {
+            date(2013, 1, 10): (1, Decimal('10')),
+            date(2013, 1, 12): (1, Decimal('10')),
+            date(2013, 1, 20): (1, Decimal('10')),
+            date(2013, 2, 9): (1, Decimal('10')),
+            date(2013, 2, 12): (1, Decimal('10')),
+            date(2013, 2, 20): (1, Decimal('10')),
+            })
+
+
+class BenchmarkTest(TestCase):
+
+    def test_run(self):
+        report = subscription.benchmark.run(users=5, repeat=1)
+        json.dumps(report)
+        results = report['results']
+        for txn_type, plan, signal_name in subscription.benchmark.IPN_STEPS:
+            self.assertEqual(results['ipn %s' % txn_type]['operations'], 5)
+        for name in ('unsubscribe_expired', 'get_subscription', 'extend_date_by'):
+            self.assertFalse('error' in results[name])
+        self.assertEqual(results['get_subscription (cached)']['queries'], 0)
+
+        slower = dict(report, results=dict(
+            (name, dict(result, per_second=result['per_second'] / 2))
+            for name, result in results.items() if result.get('per_second')))
+        for name, before, after, ratio in subscription.benchmark.compare(report, slower):
+            self.assertAlmostEqual(ratio, 2)
+
+
+class InstrumentationTest(TestCase):
+
+    def setUp(self):
+        self.subscription = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=Group.objects.create(name='monthly'))
+        self.user = User.objects.create(username='user')
+        subscription.models.plan_registry.plans()
+        subscription.rollup.plan_stats(self.subscription.id)
+        self.sink = subscription.instrumentation.MemorySink()
+        subscription.instrumentation.add_sink(self.sink)
+
+    def tearDown(self):
+        subscription.instrumentation.remove_sink(self.sink)
+
+    def _signup(self):
+        subscription.models.handle_subscription_signup(PayPalIPN.objects.create(
+            txn_type='subscr_signup', custom=str(self.user.id), subscr_id='S-1',
+            item_number=str(self.subscription.id), mc_gross=10, ipaddress='127.0.0.1'))
+
+    def test_ipn(self):
+        def slow_listener(sender, **kwargs):
+            time.sleep(0.01)
+        subscription.signals.subscribed.connect(slow_listener)
+        try:
+            logged = len(connection.queries)
+            self._signup()
+        finally:
+            subscription.signals.subscribed.disconnect(slow_listener)
+        self.assertEqual(len(connection.queries), logged)  # DEBUG is off
+
+        for operation in ('ipn.subscription_signup', 'ipn.lookup',
+                          'usersubscription.subscribe', 'ledger.flush'):
+            self.assertEqual(len(self.sink.samples[operation]), 1)
+        signup = self.sink.samples['ipn.subscription_signup'][0]
+        self.assertEqual(signup.queries, 11)
+        self.assertTrue(signup.listener_seconds >= 0.01)
+        self.assertTrue(signup.seconds >= signup.listener_seconds)
+        self.assertEqual(self.sink.samples['ipn.lookup'][0].queries, 4)
+        self.assertEqual(sum(count for bound, count in
+                             self.sink.histogram('ipn.subscription_signup')), 1)
+
+    def test_disabled(self):
+        subscription.instrumentation.remove_sink(self.sink)
+        self._signup()
+        self.assertEqual(self.sink.operations(), [])
+
+    def test_settings(self):
+        # sinks are loaded from settings at import
+        with self.settings(SUBSCRIPTION_INSTRUMENTATION=[
+                'subscription.instrumentation.MemorySink']):
+            subscription.instrumentation._load_sinks()
+            sink, = subscription.instrumentation.sinks
+            subscription.models.unsubscribe_expired()
+            self.assertEqual(sink.operations(), ['unsubscribe_expired'])
+        subscription.instrumentation._load_sinks()
+        self.assertFalse(sink in subscription.instrumentation.sinks)
+
+
+class SignalTest(IPNFixtures, TestCase):
+
+    def setUp(self):
+        super(SignalTest, self).setUp()
+        subscription.signals.reset_stats()
+        self.calls = []
+
+    def test_deferred(self):
+        @subscription.signals.deferred
+        def deferred_receiver(sender, usersubscription, **kwargs):
+            # called after the handler's transaction, with saved row
+            self.calls.append(('deferred', UserSubscription.objects.filter(
+                pk=usersubscription.pk).exists()))
+
+        def receiver(sender, **kwargs):
+            self.calls.append(('sync', None))
+        subscription.signals.subscribed.connect(deferred_receiver)
+        subscription.signals.subscribed.connect(receiver)
+        try:
+            subscription.models.handle_subscription_signup(self._ipn('subscr_signup'))
+        finally:
+            subscription.signals.subscribed.disconnect(deferred_receiver)
+            subscription.signals.subscribed.disconnect(receiver)
+        self.assertEqual(self.calls, [('sync', None), ('deferred', True)])
+        self.assertEqual(sorted((s.receiver.split('.')[-1], s.calls)
+                                for s in subscription.signals.slowest()
+                                if s.receiver.startswith(__name__)),
+                         [('deferred_receiver', 1), ('receiver', 1)])
+
+    def test_dropped_on_error(self):
+        def deferred_receiver(sender, **kwargs):
+            self.calls.append('deferred')
+
+        def failing_receiver(sender, **kwargs):
+            raise ValueError
+        subscription.signals.subscribed.connect(deferred_receiver, deferred=True)
+        subscription.signals.subscribed.connect(failing_receiver)
+        try:
+            self.assertRaises(ValueError, subscription.models.handle_subscription_signup,
+                              self._ipn('subscr_signup'))
+        finally:
+            subscription.signals.subscribed.disconnect(deferred_receiver)
+            subscription.signals.subscribed.disconnect(failing_receiver)
+        self.assertEqual(self.calls, [])
+
+    def test_change_check_not_deferrable(self):
+        def receiver(sender, **kwargs):
+            pass
+        self.assertRaises(ValueError, subscription.signals.change_check.connect,
+                          receiver, deferred=True)
+
+
+class MembershipReconcileTest(UserSubscriptionFixtures, TestCase):
+
+    def setUp(self):
+        super(MembershipReconcileTest, self).setUp()
+        future = date.today() + timedelta(10)
+        self._usersubscription('active', future)
+        self._usersubscription('lapsed', self.lapsed)
+        self._usersubscription('lapsed_cancelled', self.lapsed, cancelled=True)
+        inactive = self._usersubscription('inactive', future)
+        UserSubscription.objects.filter(pk=inactive.pk).update(active=False)
+        self._usersubscription('nonmember', future).user.groups.clear()
+        User.objects.create(username='orphan').groups.add(self.group)
+
+    def _members(self):
+        return sorted(User.groups.through.objects.filter(
+            group=self.group).values_list('user__username', flat=True))
+
+    def test_merge_join(self):
+        self.assertEqual(list(subscription.membership.merge_join([1, 3, 4, 6], [2, 3, 5, 6, 7])),
+                         [(1, True), (2, False), (4, True), (5, False), (7, False)])
+
+    def test_reconcile(self):
+        members = self._members()
+        output = StringIO()
+        call_command('subscription_reconcile', dry_run=True, verbosity=2, stdout=output)
+        self.assertEqual(self._members(), members)
+        self.assertTrue('1 missing and 4 extra membership(s) found' in output.getvalue())
+        self.assertTrue('extra (no subscription)' in output.getvalue())
+
+        transactions = Transaction.objects.count()
+        output = StringIO()
+        call_command('subscription_reconcile', chunk_size=2, stdout=output)
+        self.assertTrue('1 missing and 3 extra membership(s) corrected' in output.getvalue())
+        self.assertTrue('1 membership(s) given by no subscription left alone'
+                        in output.getvalue())
+        self.assertEqual(Transaction.objects.count(), transactions + 4)
+        # given by hand, kept
+        self.assertEqual(self._members(), ['active', 'nonmember', 'orphan'])
+        self.assertFalse(UserSubscription.objects.filter(
+            user__username='lapsed_cancelled').exists())
+        self.assertEqual(subscription.membership.reconcile(dry_run=True),
+                         dict(missing=0, extra=1, unaccounted=1))
+
+        summary = subscription.membership.reconcile(remove_unaccounted=True)
+        self.assertEqual(summary, dict(missing=0, extra=1, unaccounted=1, subscribed=0,
+                                       unsubscribed=1, deleted=0, transactions=1))
+        self.assertEqual(Transaction.objects.latest('pk').event, 'remove group membership')
+        self.assertEqual(self._members(), ['active', 'nonmember'])
+        self.assertEqual(subscription.membership.reconcile(dry_run=True),
+                         dict(missing=0, extra=0, unaccounted=0))
+
+
+class ExpiryShardTest(UserSubscriptionFixtures, TestCase):
+
+    def setUp(self):
+        super(ExpiryShardTest, self).setUp()
+        self.current = self._usersubscription('current', date.today())
+        self.expired = [self._usersubscription('expired%d' % i, self.lapsed, cancelled=i % 2)
+                        for i in xrange(5)]
+
+    def test_plan(self):
+        with self.settings(SUBSCRIPTION_EXPIRY_SHARD_SIZE=2):
+            shards = subscription.expiry.plan()
+            self.assertEqual(subscription.expiry.plan(), shards)
+        first, last = self.expired[0].user_id, self.expired[-1].user_id
+        starts = list(ExpiryShard.objects.values_list('start', flat=True))
+        self.assertEqual(len(starts), shards)
+        self.assertTrue(all(start % 2 == 0 for start in starts))
+        self.assertTrue(starts[0] <= first < starts[0] + 2)
+        self.assertTrue(starts[-1] <= last < starts[-1] + 2)
+
+    def test_run(self):
+        processed = []
+        with self.settings(SUBSCRIPTION_EXPIRY_SHARD_SIZE=2):
+            shards = subscription.expiry.run(_SerialPool(), worker='test', chunk_size=1,
+                                             log=processed.append)
+        self.assertEqual(shards, processed)
+        self.assertEqual(sum(shard.usersubscriptions for shard in shards), 5)
+        self.assertEqual(sum(shard.unsubscribed for shard in shards), 5)
+        self.assertEqual(sum(shard.deleted for shard in shards), 2)
+        self.assertFalse(ExpiryShard.objects.filter(done=False).exists())
+        self.assertEqual(
+            [us.user_is_group_member() for us in UserSubscription.objects.order_by('pk')],
+            [True, False, False, False])
+        self.assertEqual(subscription.expiry.claim('test'), [])
+
+    def test_lease(self):
+        subscription.expiry.plan()
+        [(shard_id, token)] = subscription.expiry.claim('a', limit=2)
+        self.assertEqual(subscription.expiry.claim('b'), [])
+
+        # worker `a' stopped after the first chunk and its lease expired
+        first = self.expired[0].pk
+        ExpiryShard.objects.filter(pk=shard_id).update(
+            last_pk=first, locked_until=datetime.now() - timedelta(1))
+        [(shard_id, other)] = subscription.expiry.claim('b')
+        shard = subscription.expiry.process(shard_id, other)
+        self.assertTrue(shard.done)
+        self.assertEqual(shard.usersubscriptions, 4)
+        self.assertTrue(UserSubscription.objects.get(pk=first).user_is_group_member())
+        self.assertRaises(subscription.expiry.LeaseLost,
+                          subscription.expiry.process, shard_id, token)
+
+
+class SchedulerTest(UserSubscriptionFixtures, TestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        today = date.today()
+        self.tomorrow = datetime.combine(today + timedelta(1), datetime.min.time())
+        grace = UserSubscription.grace_timedelta
+        self.due = self._usersubscription('due', today - grace)
+        self.cancelled = self._usersubscription('cancelled', today - grace, cancelled=True)
+        self.inactive = self._usersubscription('inactive', today)
+        UserSubscription.objects.filter(pk=self.inactive.pk).update(active=False)
+        self.later = self._usersubscription('later', today + timedelta(10))
+
+    def test_fire(self):
+        scheduler = subscription.scheduler.Scheduler()
+        scheduler.load()
+        self.assertEqual(len(scheduler.heap), 4)
+        self.assertEqual(scheduler.horizon, None)
+        self.assertEqual(scheduler.next_deadline(), self.tomorrow)
+        self.assertEqual(scheduler.fire()['usersubscriptions'], 0)
+
+        # renewed after it was loaded
+        UserSubscription.objects.filter(pk=self.due.pk).update(
+            expires=date.today() + timedelta(30))
+        self.assertEqual(scheduler.fire(self.tomorrow),
+                         dict(usersubscriptions=3, unsubscribed=2, deleted=1, transactions=3))
+        self.assertTrue(self.due.user_is_group_member())
+        self.assertFalse(self.inactive.user_is_group_member())
+        self.assertFalse(UserSubscription.objects.filter(pk=self.cancelled.pk).exists())
+        self.assertEqual(scheduler.next_deadline(), subscription.scheduler.deadline(
+            self.later.expires, True))
+
+    def test_horizon(self):
+        scheduler = subscription.scheduler.Scheduler(limit=2)
+        scheduler.load()
+        self.assertEqual(scheduler.horizon, self.tomorrow)
+        self.assertEqual(sorted(pk for deadline, pk in scheduler.heap),
+                         [self.due.pk, self.cancelled.pk, self.inactive.pk])
+
+        self.assertEqual(scheduler.fire(self.tomorrow + timedelta(30))['usersubscriptions'], 3)
+        self.assertEqual(scheduler.checked, self.tomorrow)
+        self.assertTrue(scheduler.stale())
+        scheduler.load()
+        self.assertEqual([pk for deadline, pk in scheduler.heap], [self.later.pk])
+        self.assertEqual(scheduler.horizon, None)
+
+    def test_notify(self):
+        version = subscription.scheduler.version()
+        subscription.models.handle_subscription_cancel(PayPalIPN.objects.create(
+            txn_type='subscr_cancel', custom=str(self.later.user_id), subscr_id='S-1',
+            item_number=str(self.subscription.id), mc_gross=10, ipaddress='127.0.0.1'))
+        self.assertNotEqual(subscription.scheduler.version(), version)
+
+
+class ReplayTest(IPNFixtures, TestCase):
+
+    def setUp(self):
+        super(ReplayTest, self).setUp()
+        self.monthly = self.subscription
+        self.once = Subscription.objects.create(
+            name='Once', price=50, group=Group.objects.create(name='once'))
+
+    def _states(self):
+        return dict((us.subscription_id, (us.active, us.cancelled, us.expires))
+                    for us in UserSubscription.objects.filter(user=self.user))
+
+    def test_replay(self):
+        models = subscription.models
+        models.handle_subscription_signup(self._ipn('subscr_signup', self.monthly))
+        models.handle_payment_was_successful(self._ipn('subscr_payment', self.monthly,
+                                                       txn_id='T-1'))
+        # PayPal retry of the payment
+        models.handle_payment_was_successful(self._ipn('subscr_payment', self.monthly,
+                                                       txn_id='T-1'))
+        models.handle_payment_was_successful(self._ipn('web_accept', self.once,
+                                                       txn_id='T-2'))
+        models.handle_subscription_cancel(self._ipn('subscr_cancel', self.monthly))
+        states = self._states()
+        self.assertEqual(len(states), 2)
+        self.assertEqual(
+            subscription.replay.run(_SerialPool, diff_only=True),
+            dict(ipns=5, users=1, differences=0))
+
+        UserSubscription.objects.filter(subscription=self.monthly).update(
+            cancelled=False, expires=date.today())
+        UserSubscription.objects.filter(subscription=self.once).delete()
+        self.user.groups.clear()
+        differences = []
+        summary = subscription.replay.run(_SerialPool, report=differences.append)
+        self.assertEqual(summary, dict(ipns=5, users=1, differences=2, created=1, updated=1,
+                                       deleted=0, subscribed=2, unsubscribed=0,
+                                       transactions=2))
+        self.assertEqual(sorted(d.subscription_id for d in differences),
+                         [self.monthly.id, self.once.id])
+        self.assertEqual(self._states(), states)
+        self.assertEqual(set(self.user.groups.all()), set([self.group, self.once.group]))
+        self.assertEqual(subscription.rollup.reconcile(), [])
+        # rebuilt states are followed by snapshots
+        S = subscription.snapshots
+        self.assertEqual(S.user_state(self.user.id), dict(
+            (subscription_id, (S.ACTIVE if active else 0) | (S.CANCELLED if cancelled else 0))
+            for subscription_id, (active, cancelled, expires) in states.items()))
+
+    def test_unmatched(self):
+        subscription.models.handle_subscription_signup(self._ipn('subscr_signup', self.monthly))
+        # granted in the admin, without an IPN
+        UserSubscription.objects.create(user=self.user, subscription=self.once, active=True,
+                                        cancelled=False)
+        states = self._states()
+        self.assertEqual(subscription.replay.run(_SerialPool)['differences'], 0)
+        self.assertEqual(self._states(), states)
+
+        summary = subscription.replay.run(_SerialPool, delete_unmatched=True)
+        self.assertEqual((summary['differences'], summary['deleted']), (1, 1))
+        self.assertEqual(list(self._states()), [self.monthly.id])
+
+    def test_partitions(self):
+        users = [self.user] + [User.objects.create(username='user%d' % i) for i in range(2)]
+        ipns = []
+        for i in range(2):
+            for user in reversed(users):
+                ipns.append(self._ipn('subscr_payment', user=user, subscr_id='S-%d' % user.id,
+                                      txn_id='T-%d-%d' % (user.id, i)))
+        PayPalIPN.objects.create(txn_type='web_accept', custom='0%d' % self.user.id,
+                                 txn_id='T-0', ipaddress='127.0.0.1')
+        partitions = list(subscription.replay.stream(chunk_size=1, partition_size=1))
+        self.assertEqual([partition.keys() for partition in partitions],
+                         [[user.id] for user in sorted(users, key=lambda u: str(u.id))])
+        for partition in partitions:
+            [(user_id, user_ipns)] = partition.items()
+            self.assertEqual([ipn.pk for ipn in user_ipns],
+                             [ipn.pk for ipn in ipns if ipn.custom == str(user_id)])
+        [partition] = subscription.replay.stream()
+        self.assertEqual(sorted(partition), sorted(user.id for user in users))
+        self.assertEqual(subscription.replay.run(_SerialPool, diff_only=True, partition_size=1),
+                         subscription.replay.run(_SerialPool, diff_only=True))
+
+    def test_modify(self):
+        day = date(2012, 1, 1)
+        ipn = subscription.replay.IPN(
+            pk=None, custom=str(self.user.id), txn_type='subscr_signup', txn_id='',
+            subscr_id='S-1', subscr_effective=None, item_number=str(self.monthly.id),
+            mc_gross=Decimal(10), flag=False, payment_status='', recurring_payment_id='',
+            day=day)
+        ipns = [ipn, ipn._replace(txn_type='subscr_payment', txn_id='T-1'),
+                ipn._replace(txn_type='subscr_modify', item_number=str(self.once.id),
+                             subscr_effective=datetime(2012, 1, 1))]
+        State = subscription.replay.State
+        self.assertEqual(subscription.replay.replay(ipns[:2], date(2012, 1, 2)),
+                         {self.monthly.id: State(True, False, date(2012, 2, 1))})
+        self.assertEqual(subscription.replay.replay(ipns, date(2012, 1, 2)),
+                         {self.once.id: State(True, False, date(2012, 1, 1))})
+        # cancelled subscription expired before it is replaced
+        ipns[2:2] = [ipn._replace(txn_type='subscr_cancel')]
+        ipns[-1] = ipns[-1]._replace(day=date(2012, 3, 1))
+        self.assertEqual(subscription.replay.replay(ipns, date(2012, 3, 2)),
+                         {self.once.id: State(True, False, date(2012, 3, 1))})
+
+
+class SnapshotTest(IPNFixtures, TestCase):
+
+    def setUp(self):
+        self.monthly = Subscription.objects.create(
+            name='Monthly', price=10, recurrence_period=1,
+            recurrence_unit='M', group=Group.objects.create(name='monthly'))
+        self.yearly = Subscription.objects.create(
+            name='Yearly', price=100, recurrence_period=1,
+            recurrence_unit='Y', group=Group.objects.create(name='yearly'))
+        self.user = User.objects.create(username='user')
+        self.other = User.objects.create(username='other')
+
+    def _recorded(self, timestamp):
+        Transaction.objects.filter(timestamp__gt=timestamp).update(timestamp=timestamp)
+
+    def _stored(self):
+        S = subscription.snapshots
+        states = {}
+        for us in UserSubscription.objects.all():
+            states.setdefault(us.user_id, {})[us.subscription_id] = (
+                (S.ACTIVE if us.active else 0) | (S.CANCELLED if us.cancelled else 0))
+        return states
+
+    def test_snapshots(self):
+        S = subscription.snapshots
+        models = subscription.models
+        now = timezone.now()
+        before, after = now - timedelta(2), now - timedelta(1)
+        models.handle_subscription_signup(self._ipn('subscr_signup', self.monthly))
+        models.handle_payment_was_successful(self._ipn('subscr_payment', self.monthly,
+                                                       txn_id='T-1'))
+        self._recorded(before)
+        states = self._stored()
+        snapshot = S.take()
+        self.assertEqual(snapshot.transactions, 3)
+        self.assertEqual(S.take(), snapshot)
+        self.assertEqual(S.population(), states)
+
+        # replaced by another plan; incorrect payment leaves nothing behind
+        models.handle_subscription_signup(self._ipn('subscr_signup', self.yearly))
+        models.handle_subscription_cancel(self._ipn('subscr_cancel', self.monthly))
+        models.handle_payment_was_successful(self._ipn(
+            'subscr_payment', self.monthly, self.other, mc_gross=1, txn_id='T-2'))
+        self._recorded(after)
+        self.assertEqual(set(self._stored()), set([self.user.id]))
+        self.assertEqual(S.population(), self._stored())
+        self.assertEqual(S.population(before), states)
+        self.assertEqual(S.plan_at(self.user.id, before), self.monthly.id)
+        self.assertEqual(S.plan_at(self.user.id), self.yearly.id)
+        self.assertEqual(S.plan_at(self.other.id), None)
+
+        # recent transactions are left out
+        self.assertEqual(S.take(lag=86400 * 3), snapshot)
+        latest = S.take()
+        self.assertEqual(latest.rows.count(), 1)
+        self.assertEqual(S.prune(1), 1)
+        self.assertEqual(S.user_state(self.user.id, before),
+                         {self.monthly.id: S.ACTIVE})
+        self.assertEqual(S.user_state(self.user.id, after), {self.yearly.id: S.ACTIVE})
+
+    def test_plan_at_several_active(self):
+        S = subscription.snapshots
+        weekly = Subscription.objects.create(
+            name='Weekly', price=3, recurrence_period=1, recurrence_unit='W',
+            group=Group.objects.create(name='weekly'))
+        for plan in (self.yearly, weekly):
+            Transaction.objects.create(user=self.user, subscription=plan, event='activated')
+            self.user.groups.add(plan.group)
+        self.assertEqual(set(S.user_state(self.user.id)), set([self.yearly.id, weekly.id]))
+        # cheaper plan comes first in Subscription's order, as for the
+        # live answer
+        self.assertEqual(S.plan_at(self.user.id), weekly.id)
+        self.assertEqual(User.objects.get(pk=self.user.pk).get_subscription(), weekly)
+
+    def test_apply(self):
+        S = subscription.snapshots
+        states = {}
+        rebuild_event = subscription.replay.rebuild_event
+        S.apply(states, 1, 2, rebuild_event(subscription.replay.State(True, False, None)))
+        S.apply(states, 1, 3, 'one-time payment')
+        S.apply(states, 1, 3, 'subscription expired')
+        self.assertEqual(states, {1: {2: S.ACTIVE, 3: S.ACTIVE | S.LAPSED}})
+        self.assertFalse(S.is_active(states[1][3]))
+        # renewal payment does not give the group back
+        S.apply(states, 1, 3, 'subscription payment')
+        self.assertEqual(states[1][3], S.ACTIVE | S.LAPSED)
+        S.apply(states, 1, 3, 'activated')
+        self.assertTrue(S.is_active(states[1][3]))
+        S.apply(states, 1, 2, rebuild_event(None))
+        S.apply(states, 1, 3, 'remove subscription (expired)')
+        self.assertEqual(states, {})
@@ -17,7 +17,7 @@ if django.VERSION < (1, 5, 0):
 else:
     from django.views.generic import TemplateView
     urlpatterns = patterns('subscription.views',
-        url(r'^$', TemplateView.as_view(template_name='subscription/subscription_list.html'), name='subscription_list'),
+        url(r'^$', 'subscription_list', name='subscription_list'),
         url(r'^done/', TemplateView.as_view(template_name='subscription/subscription_done.html'), name='subscription_done'),
         url(r'^change-done/', TemplateView.as_view(template_name='subscription/subscription_change_done.html'), name='subscription_change_done'),
         url(r'^cancel/', TemplateView.as_view(template_name='subscription/subscription_cancel.html'), name='subscription_cancel'),
@@ -1,6 +1,14 @@
 import datetime
 import calendar
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+UNITS = ('D', 'W', 'M', 'Y')
+
+
 def extend_date_by(date, amount, unit):
     """Extend date `date' by `amount' of time units `unit'.
 
@@ -39,26 +47,101 @@ def extend_date_by(date, amount, unit):
     >>> subscription.utils.extend_date_by(datetime.date(2007,12,30),5,'D')
     datetime.date(2008, 1, 4)
 
+    >>> subscription.utils.extend_date_by(datetime.date(2008,2,29),1,'Y')
+    datetime.date(2009, 2, 28)
+
     >>> subscription.utils.extend_date_by(datetime.date(2007,10,7),99,'Q')
     Traceback (most recent call last):
        ...
-    Unknown unit.
+    ValueError: Unknown unit.
     """
     if unit == 'D':
         return date + datetime.timedelta(1)*amount
     elif unit == 'W':
         return date + datetime.timedelta(7)*amount
-    elif unit == 'M':
+    elif unit in ('M', 'Y'):
+        if unit == 'Y':
+            amount *= 12
         y, m, d = date.year, date.month, date.day
         m += amount
-        y += m / 12
+        y += m // 12
         m %= 12
         if not m: m, y = 12, y-1
         r = calendar.monthrange(y, m)[1]
         if d > r:
             d = r
         return datetime.date(y, m, d)
-    elif unit == 'Y':
-        y, m, d = date.year, date.month, date.day
-        return datetime.date(y+amount, m, d)
-    else: raise "Unknown unit."
+    else: raise ValueError("Unknown unit.")
+
+
+def _civil_from_days(days):
+    """Split NumPy array of days since 1970-01-01 into (year, month,
+    day) arrays.  See http://howardhinnant.github.io/date_algorithms.html"""
+    days = days + 719468
+    era = days // 146097
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    month = numpy.where(mp < 10, mp + 3, mp - 9)
+    return yoe + era * 400 + (month <= 2), month, doy - (153 * mp + 2) // 5 + 1
+
+
+def _days_from_civil(year, month, day):
+    """Inverse of _civil_from_days()."""
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * numpy.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+
+def extend_dates_by(dates, amounts, units):
+    """Extend each of `dates' by corresponding `amounts' of `units'.
+
+    Batch version of `extend_date_by()', returning exactly the same
+    dates.  `dates' is a NumPy `datetime64[D]' array or a sequence of
+    datetime.date objects; `amounts' and `units' are sequences of the
+    same length, or single values used for all dates.  If NumPy is
+    available, dates are computed with vectorized integer arithmetic;
+    NumPy array is returned for NumPy array input, list of
+    datetime.date objects otherwise.
+    """
+    if numpy is None:
+        if isinstance(amounts, (int, long)):
+            amounts = [amounts] * len(dates)
+        if isinstance(units, basestring):
+            units = [units] * len(dates)
+        return [extend_date_by(date, amount, unit)
+                for date, amount, unit in zip(dates, amounts, units)]
+
+    as_list = not isinstance(dates, numpy.ndarray)
+    days = numpy.asarray(dates, dtype='datetime64[D]').view('int64')
+    amounts = numpy.asarray(amounts, dtype='int64')
+    units = numpy.ascontiguousarray(units, dtype='S1').view('uint8')
+    by_day, by_week, by_month, by_year = [units == ord(unit) for unit in UNITS]
+    if not (by_day | by_week | by_month | by_year).all():
+        raise ValueError("Unknown unit.")
+
+    by_months = numpy.zeros(days.shape, dtype='int64')
+    if len(days):
+        # calendar arithmetic is done once per distinct day and month
+        # in range, and looked up for each of the dates
+        first_day = days.min()
+        year, month, day = _civil_from_days(numpy.arange(first_day, days.max() + 1))
+        i = days - first_day
+        months = (year * 12 + month - 1)[i] + numpy.where(by_year, amounts * 12, amounts)
+        first_month = months.min()
+        month_starts = numpy.arange(first_month, months.max() + 2)
+        month_starts = _days_from_civil(month_starts // 12, month_starts % 12 + 1, 1)
+        j = months - first_month
+        by_months = month_starts[j] + numpy.minimum(
+            day[i], month_starts[j + 1] - month_starts[j]) - 1
+
+    rv = numpy.where(by_month | by_year, by_months,
+                     days + numpy.where(by_week, amounts * 7, amounts))
+    rv = numpy.broadcast_to(rv, numpy.broadcast(days, amounts, units).shape
+                            ).view('datetime64[D]')
+    if as_list:
+        return rv.tolist()
+    return rv
@@ -3,21 +3,22 @@ import urllib
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.sites.models import Site
+from django.core.paginator import InvalidPage, Paginator
 from django.core.urlresolvers import reverse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import Http404
 from django.dispatch import Signal
-
-import django
-if django.VERSION <= (1, 5, 0):
-    from django.views.generic.simple import direct_to_template
+from django.utils import translation
+from django.views.decorators.http import condition
 
 _formclass = getattr(settings, 'SUBSCRIPTION_PAYPAL_FORM', 'paypal.standard.forms.PayPalPaymentsForm')
 _formclass_dot = _formclass.rindex('.')
 _formclass_module = __import__(_formclass[:_formclass_dot], {}, {}, [''])
 PayPalForm = getattr(_formclass_module, _formclass[_formclass_dot + 1:])
 
-from models import Subscription, UserSubscription
+from catalog import get_catalog
+from instrumentation import instrumented
+from models import Subscription, subscription_cache
 
 get_paypal_extra_args = Signal(providing_args=['user', 'subscription', 'extra_args'])
 
@@ -31,12 +32,12 @@ else:
 # https://cms.paypal.com/us/cgi-bin/?cmd=_render-content&content_ID=developer/e_howto_html_Appx_websitestandard_htmlvariables
 
 
-def _paypal_form_args(upgrade_subscription=False, **kwargs):
+def _paypal_form_args(site, upgrade_subscription=False, **kwargs):
     "Return PayPal form arguments derived from kwargs."
     def _url(rel):
         if not rel.startswith('/'):
             rel = '/' + rel
-        return 'http://%s%s' % (Site.objects.get_current().domain, rel)
+        return 'http://%s%s' % (site.domain, rel)
 
     if upgrade_subscription:
         returl = reverse('subscription_change_done')
@@ -51,16 +52,11 @@ def _paypal_form_args(upgrade_subscription=False, **kwargs):
     return rv
 
 
-def _paypal_form(subscription, user, upgrade_subscription=False, **extra_args):
-    if not user.is_authenticated:
-        return None
-
-    if subscription.price <= 0:
-        # Handles the scenario when subscription price is set to 0 or negative
-        # value.  This means it is a "free plan" and should be handled
-        # appropriately by user of this library
-        return None
-    elif subscription.recurrence_unit:
+def _paypal_subscription_args(subscription, upgrade_subscription=False):
+    "Return PayPal form arguments for `subscription' that do not depend on user."
+    site = Site.objects.get_current()
+    item_name = '%s: %s' % (site.name, subscription.name)
+    if subscription.recurrence_unit:
         if subscription.trial_unit == '0':
             trial = {}
         else:
@@ -69,40 +65,116 @@ def _paypal_form(subscription, user, upgrade_subscription=False, **extra_args):
                 'p1': subscription.trial_period,
                 't1': subscription.trial_unit,
                 }
-        kwargs = {}
-        kwargs.update(trial)
-        kwargs.update(extra_args)
-        return PayPalForm(
-                initial=_paypal_form_args(
-                cmd='_xclick-subscriptions',
-                item_name='%s: %s' % (Site.objects.get_current().name, subscription.name),
-                item_number=subscription.id,
-                custom=user.id,
-                a3=subscription.price,
-                p3=subscription.recurrence_period,
-                t3=subscription.recurrence_unit,
-                src=1,            # make payments recur
-                sra=1,            # reattempt payment on payment error
-                upgrade_subscription=upgrade_subscription,
-                # subscription modification (upgrade/downgrade)
-                modify=upgrade_subscription and 2 or 0, **kwargs),
-                button_type='subscribe'
-            )
+        return _paypal_form_args(
+            site,
+            cmd='_xclick-subscriptions',
+            item_name=item_name,
+            item_number=subscription.id,
+            a3=subscription.price,
+            p3=subscription.recurrence_period,
+            t3=subscription.recurrence_unit,
+            src=1,            # make payments recur
+            sra=1,            # reattempt payment on payment error
+            upgrade_subscription=upgrade_subscription,
+            # subscription modification (upgrade/downgrade)
+            modify=upgrade_subscription and 2 or 0, **trial)
     else:
-        return PayPalForm(
-                initial=_paypal_form_args(
-                item_name='%s: %s' % (Site.objects.get_current().name, subscription.name),
-                item_number=subscription.id,
-                custom=user.id,
-                amount=subscription.price))
+        return _paypal_form_args(
+            site,
+            item_name=item_name,
+            item_number=subscription.id,
+            amount=subscription.price)
 
 
-def subscription_list(request):
-    return direct_to_template(
-        request, template='subscription/subscription_list.html',
-        extra_context=dict(object_list=Subscription.objects.all()))
+def _paypal_settings_key():
+    """Return key of settings PayPal form arguments are computed with:
+    current site and SUBSCRIPTION_PAYPAL_SETTINGS."""
+    return '%s:%x' % (settings.SITE_ID, hash(repr(sorted(
+        settings.SUBSCRIPTION_PAYPAL_SETTINGS.items()))) & 0xffffffff)
 
 
+def _paypal_form(subscription, user, upgrade_subscription=False, **extra_args):
+    if not user.is_authenticated():
+        return None
+
+    if subscription.price <= 0:
+        # Handles the scenario when subscription price is set to 0 or negative
+        # value.  This means it is a "free plan" and should be handled
+        # appropriately by user of this library
+        return None
+
+    kwargs = {}
+    if subscription.recurrence_unit:
+        kwargs['button_type'] = 'subscribe'
+
+    def load():
+        return _paypal_subscription_args(subscription, upgrade_subscription)
+
+    # only `custom' and extra arguments are set on each request; a new
+    # form (with its own fields) is created from cached arguments, which
+    # are dropped whenever any Subscription changes, and kept apart for
+    # changed settings
+    initial = subscription_cache.get_paypal_button(
+        subscription.id, _paypal_settings_key(), upgrade_subscription, load)
+    return PayPalForm(initial=dict(initial, custom=user.id, **extra_args), **kwargs)
+
+
+def _user_subscriptions(user, subscription):
+    """Return pair of `user''s active UserSubscription and of one for
+    `subscription', or None in place of missing ones.  All of user's
+    UserSubscriptions are loaded, along with their subscriptions, in a
+    single query."""
+    active = current = None
+    if user.is_authenticated():
+        for us in user.usersubscription_set.select_related(
+                'subscription').order_by('pk'):
+            if us.active and active is None:
+                active = us
+            if us.subscription_id == subscription.id:
+                current = us
+    return active, current
+
+
+def _authenticated(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return user
+
+
+def _subscription_list_etag(request):
+    # rendered page may depend on language, on logged in user and on
+    # user's subscription
+    user = _authenticated(request)
+    subscription = user and user.get_subscription()
+    return '%s-%s-%s-%s' % (get_catalog().version, translation.get_language(),
+                            user and user.pk or 0, subscription and subscription.id or 0)
+
+
+def _subscription_list_modified(request):
+    # catalog's time does not cover changes of user's subscription
+    if _authenticated(request) is None:
+        return get_catalog().modified
+
+
+@instrumented('views.subscription_list')
+@condition(etag_func=_subscription_list_etag,
+           last_modified_func=_subscription_list_modified)
+def subscription_list(request):
+    object_list = get_catalog().plans
+    context = dict(object_list=object_list)
+    paginate_by = getattr(settings, 'SUBSCRIPTION_LIST_PAGINATE_BY', None)
+    if paginate_by:
+        paginator = Paginator(object_list, paginate_by)
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except InvalidPage:
+            raise Http404
+        context.update(object_list=page.object_list, paginator=paginator,
+                       page_obj=page, is_paginated=page.has_other_pages())
+    return render(request, 'subscription/subscription_list.html', context)
+
+
+@instrumented('views.subscription_detail')
 def subscription_detail(request, object_id, payment_method="standard"):
 
     FREE_SUBSCRIPTION_URL_NAME = getattr(settings, 'FREE_SUBSCRIPTION_URL_NAME', None)
@@ -111,25 +183,19 @@ def subscription_detail(request, object_id, payment_method="standard"):
 
     s = get_object_or_404(Subscription, id=object_id)
 
-    try:
-        user = request.user.usersubscription_set.get(
-            active=True)
-    except UserSubscription.DoesNotExist:
+    user, s_us = _user_subscriptions(request.user, s)
+    if user is None:
         change_denied_reasons = None
-        user = None
     else:
         change_denied_reasons = user.try_change(s)
 
     if change_denied_reasons:
         form = None
     else:
-        get_paypal_extra_args.send(sender=None, user=user, subscription=s, extra_args={})
-        form = _paypal_form(s, request.user, upgrade_subscription=(user is not None) and (user.subscription != s))
-
-    try:
-        s_us = request.user.usersubscription_set.get(subscription=s)
-    except UserSubscription.DoesNotExist:
-        s_us = None
+        extra_args = {}
+        get_paypal_extra_args.send(sender=None, user=user, subscription=s, extra_args=extra_args)
+        form = _paypal_form(s, request.user, upgrade_subscription=(user is not None) and (user.subscription_id != s.id),
+                            **extra_args)
 
     from subscription.providers import PaymentMethodFactory
     # See PROPOSALS section in providers.py
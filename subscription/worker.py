@@ -0,0 +1,140 @@
+"""Handling of PayPal IPNs queued as IPNJob objects.
+
+With SUBSCRIPTION_IPN_QUEUE setting set to True, django-paypal signal
+handlers only store an IPNJob for each IPN, and `subscription_worker'
+management command hands jobs over to `process()' in a thread or
+process pool.  Jobs of one user (IPN's `custom' field) are always
+handled in order, by one worker at a time: a user's jobs are claimed
+only if user's first waiting job is ready, and user's chain of jobs
+stops at the first failure.  Failed jobs are retried with exponential
+backoff.
+"""
+import datetime
+import os
+import socket
+import time
+import traceback
+import uuid
+from multiprocessing.pool import Pool, ThreadPool
+
+from django.db import connections
+from django.db.models import Min, Q
+
+from models import IPNJob, IPN_HANDLERS
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _unlocked(now):
+    return Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+
+
+def claim(worker, limit=100, lease=300):
+    """Lease ready jobs of at most `limit' users to `worker' for
+    `lease' seconds.
+
+    Returns list of lists of job ids, one list per user, in order in
+    which they need to be handled."""
+    now = datetime.datetime.now()
+    waiting = IPNJob.objects.filter(failed=False)
+    ready = waiting.filter(run_after__lte=now).filter(_unlocked(now))
+    first_ready = dict(ready.values_list('user_key').annotate(
+        first=Min('id')).order_by('first')[:limit])
+    if not first_ready:
+        return []
+
+    # user's first waiting job may be locked or waiting for retry
+    first = dict(waiting.filter(user_key__in=first_ready.keys()).values_list(
+        'user_key').annotate(first=Min('id')).order_by())
+    user_keys = [user_key for user_key, job_id in first_ready.items()
+                 if first.get(user_key) == job_id]
+    if not user_keys:
+        return []
+
+    token = '%s:%s' % (worker, uuid.uuid4().hex)
+    ready.filter(user_key__in=user_keys).update(
+        worker=token, locked_until=now + datetime.timedelta(seconds=lease))
+
+    chains = {}
+    for job_id, user_key in IPNJob.objects.filter(worker=token).order_by(
+            'id').values_list('id', 'user_key'):
+        chains.setdefault(user_key, []).append(job_id)
+    lost = []
+    for user_key, job_ids in chains.items():
+        if job_ids[0] != first[user_key]:
+            # other worker got to user's first job in the meantime
+            lost.extend(chains.pop(user_key))
+    release(lost)
+    return sorted(chains.values())
+
+
+def release(job_ids):
+    """Give up lease of jobs `job_ids'."""
+    if job_ids:
+        IPNJob.objects.filter(pk__in=job_ids).update(worker='', locked_until=None)
+
+
+def process(job_ids, max_attempts=5, backoff=60):
+    """Handle jobs `job_ids' of a single user in order.
+
+    Handled jobs are deleted.  On first failure, the job is scheduled
+    for retry after `backoff' seconds, doubled with each attempt, or
+    marked as failed after `max_attempts' attempts, and remaining jobs
+    are released.  Handlers are idempotent, so a job that was handled
+    but not deleted because of a crash is harmless.  Returns
+    (handled, failed) pair of counts."""
+    for i, job_id in enumerate(job_ids):
+        job = IPNJob.objects.select_related('ipn').get(pk=job_id)
+        try:
+            IPN_HANDLERS[job.signal](job.ipn)
+        except Exception:
+            job.attempts += 1
+            job.failed = job.attempts >= max_attempts
+            job.last_error = traceback.format_exc()
+            job.run_after = datetime.datetime.now() + datetime.timedelta(
+                seconds=backoff * 2 ** (job.attempts - 1))
+            job.worker, job.locked_until = '', None
+            job.save()
+            release(job_ids[i + 1:])
+            return i, 1
+        job.delete()
+    return len(job_ids), 0
+
+
+def _process(args):
+    job_ids, kwargs = args
+    return process(job_ids, **kwargs)
+
+
+def make_pool(threads=1, processes=0):
+    """Return pool of `processes' processes, or `threads' threads."""
+    if processes:
+        # children must not share parent's database connection
+        for connection in connections.all():
+            connection.close()
+        return Pool(processes)
+    return ThreadPool(threads)
+
+
+def run(pool, worker=None, batch_size=100, lease=300, max_attempts=5,
+        backoff=60, sleep=5, once=False, log=None):
+    """Claim and handle jobs in `pool' until queue is empty (if `once'
+    is true) or forever.  Returns (handled, failed) pair of counts."""
+    worker = worker or worker_name()
+    kwargs = dict(max_attempts=max_attempts, backoff=backoff)
+    handled = failed = 0
+    while True:
+        chains = claim(worker, batch_size, lease)
+        if not chains:
+            if once:
+                return handled, failed
+            time.sleep(sleep)
+            continue
+        for chain_handled, chain_failed in pool.imap_unordered(
+                _process, [(job_ids, kwargs) for job_ids in chains]):
+            handled += chain_handled
+            failed += chain_failed
+        if log:
+            log('%d handled, %d failed' % (handled, failed))